@@ -0,0 +1,125 @@
+"""Measures how fast the python database reads the records of a run.
+
+Compares, on the same records:
+
+- the previous reader of the zlib records files, which was reading them
+  1 KiB at a time and splitting them on the zlib markers;
+- the memory-mapped reader of the same files (read_zfile);
+- the memory-mapped reader of the segment files.
+
+The records holding a zlib marker once compressed are left out, as the
+previous reader can't read them.
+
+Usage: python benchmarks/dbread.py [number of records]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from loads.db._python import read_zfile, ZLIB_START, ZLIB_END
+from loads.db._segments import SegmentedStore
+from loads.util import json
+
+
+def legacy_read_zfile(filename):
+    remaining = ''
+
+    with open(filename, 'rb') as f:
+        while True:
+            data = remaining + f.read(1024)
+            if not data:
+                raise StopIteration()
+
+            size = len(data)
+            pos = 0
+
+            while pos < size:
+                rstart = data.find(ZLIB_START, pos)
+                rend = data.find(ZLIB_END, rstart + 1)
+
+                if rend == -1 or rstart == rend:
+                    break
+
+                line = data[rstart:rend]
+                if not line:
+                    break
+
+                try:
+                    line = zlib.decompress(line)
+                except zlib.error:
+                    raise ValueError(line)
+
+                yield json.loads(line), line
+                pos = rend + len(ZLIB_END)
+
+            if pos < size:
+                remaining = data[pos:]
+            else:
+                remaining = ''
+
+
+def get_records(number):
+    started = datetime.utcnow()
+    for i in range(number):
+        yield {'0': 'add_hit', '1': 200, '2': [1, 10, i, 3],
+               '3': str(started + timedelta(microseconds=i * 100)),
+               '4': 0.0086 + i * 1e-7, '5': 'http://127.0.0.1:9000/',
+               '6': 1727, '7': 'GET', '8': 'run'}
+
+
+def bench(name, reader, size):
+    best = None
+    for i in range(3):
+        start = time.time()
+        count = 0
+        for record in reader():
+            count += 1
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+
+    print('%-22s %10d %12.0f %10.1f' % (name, size, count / best,
+                                        size / best / 1024 / 1024))
+
+
+def main(number=100000):
+    tmp = tempfile.mkdtemp()
+    try:
+        records = []
+        filename = os.path.join(tmp, 'run-db.json')
+        with open(filename, 'wb') as f:
+            for record in get_records(number):
+                compressed = zlib.compress(json.dumps(record))
+                if (compressed.find(ZLIB_START, 1) != -1 or
+                        compressed.find(ZLIB_END) != -1):
+                    continue
+                f.write(compressed + ZLIB_END)
+                records.append(('add_hit', record))
+
+        store = SegmentedStore(tmp, 'run')
+        store.append(records)
+        segments = sum(os.path.getsize(store.get_segment_path(block))
+                       for block in set(block.segment
+                                        for block in store.blocks))
+
+        print('Scan of %d records (%d left out)' % (len(records),
+                                                    number - len(records)))
+        print('%-22s %10s %12s %10s' % ('reader', 'bytes', 'records/s',
+                                        'MiB/s'))
+        zsize = os.path.getsize(filename)
+        bench('legacy read_zfile', lambda: legacy_read_zfile(filename), zsize)
+        bench('read_zfile', lambda: read_zfile(filename), zsize)
+        bench('segments', store.read, segments)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
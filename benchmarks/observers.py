@@ -0,0 +1,72 @@
+"""Measures the overhead of the observers dispatch on TestResult.add_hit.
+
+Compares the current TestResult with the previous implementation, which was
+wrapping the observed methods in a new closure on every attribute access.
+
+Usage: python benchmarks/observers.py [number of hits]
+"""
+import sys
+import timeit
+from datetime import datetime
+
+from loads.results.base import TestResult, OBSERVED_METHODS
+
+
+class LegacyTestResult(TestResult):
+    """TestResult with the per-call wrapping done in __getattribute__."""
+
+    def __getattribute__(self, name):
+        attr = object.__getattribute__(self, name)
+        if name in OBSERVED_METHODS:
+
+            def wrapper(*args, **kwargs):
+                ret = attr(*args, **kwargs)
+                for obs in self.observers:
+                    obs.push(name, *args, **kwargs)
+                return ret
+            return wrapper
+        return attr
+
+    def add_observer(self, observer):
+        self.observers.append(observer)
+
+
+class Observer(object):
+    def push(self, called_method, *args, **data):
+        pass
+
+
+HIT = {'url': 'http://127.0.0.1:9000/', 'method': 'GET', 'status': 200,
+       'started': datetime.utcnow(), 'elapsed': 0.01,
+       'loads_status': (1, 1, 1, 1)}
+
+
+def bench(klass, observers, number):
+    test_result = klass(args={'aggregate_hits': True})
+    for i in range(observers):
+        test_result.add_observer(Observer())
+
+    def add_hit():
+        test_result.add_hit(**HIT)
+
+    best = min(timeit.repeat(add_hit, number=number, repeat=3))
+    return best / number * 1e6
+
+
+def main(number=100000):
+    print('Time per add_hit call, in microseconds (%d calls)' % number)
+    print('%-10s %10s %10s %10s' % ('observers', 'before', 'after', 'gain'))
+
+    for observers in (0, 1, 3):
+        before = bench(LegacyTestResult, observers, number)
+        after = bench(TestResult, observers, number)
+        print('%-10d %10.3f %10.3f %9.1f%%' % (observers, before, after,
+                                               (before - after) / before *
+                                               100))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,123 @@
+"""Measures how fast the Redis database stores the events of a run.
+
+Compares, on the same events:
+
+- the previous RedisDB.add, which was sending a pipeline per event, after
+  up to three SISMEMBER round trips;
+- the current RedisDB.add, which buffers the events and sends them in
+  batches.
+
+Needs a Redis server on localhost:6379, or fakeredis when --fake is used.
+The keys of the runs "bench-legacy" and "bench" are deleted.
+
+Usage: python benchmarks/redisadd.py [--fake] [number of events]
+"""
+import hashlib
+import sys
+import time
+from datetime import datetime, timedelta
+
+import redis
+from zmq.green.eventloop import ioloop
+
+from loads.db._redis import RedisDB
+from loads.results.aggregate import RollupStats
+from loads.util import json
+
+
+def legacy_add(db, data):
+    run_id = data['run_id']
+    data_type = data['data_type'] = data.get('data_type', 'unknown')
+    size = data.get('size', 1)
+
+    pipeline = db._redis.pipeline()
+    pipeline.sadd('runs', run_id)
+
+    counters = 'counters:%s' % run_id
+    counter = 'count:%s:%s' % (run_id, data_type)
+    if not db._redis.sismember(counters, counter):
+        pipeline.sadd(counters, counter)
+    pipeline.incrby(counter, size)
+
+    if 'url' in data:
+        url = data['url']
+        urls = 'urls:%s' % run_id
+        if not db._redis.sismember(urls, url):
+            pipeline.sadd(urls, url)
+        pipeline.incrby('url:%s:%s' % (run_id, url), 1)
+
+    rollups = RollupStats()
+    rollups.add(int(time.time()), data)
+    for rollup in rollups.dump():
+        member = json.dumps([rollup['second'], rollup['url']])
+        pipeline.sadd('rollups:%s' % run_id, member)
+        key = 'rollup:%s:%s' % (run_id, member)
+        pipeline.hincrby(key, 'hits', rollup['hits'])
+        pipeline.hincrby(key, 'errors', rollup['errors'])
+        pipeline.hincrbyfloat(key, 'total', rollup['histogram']['total'])
+        for index, count in rollup['histogram']['buckets'].items():
+            pipeline.hincrby(key, 'bucket:%d' % index, count)
+
+    dumped = json.dumps(data)
+    pipeline.lpush('data:%s' % run_id, dumped)
+
+    md5 = hashlib.md5(dumped).hexdigest()
+    pipeline.incrby('bcount:%s:%s' % (run_id, md5), size)
+    pipeline.set('bvalue:%s:%s' % (run_id, md5), dumped)
+    bcounters = 'bcounters:%s' % run_id
+    if not db._redis.sismember(bcounters, md5):
+        pipeline.sadd(bcounters, md5)
+
+    pipeline.execute()
+
+
+def get_events(run_id, number):
+    started = datetime.utcnow()
+    for i in range(number):
+        yield {'data_type': 'add_hit', 'status': 200,
+               'loads_status': [1, 10, i, 3],
+               'started': str(started + timedelta(microseconds=i * 100)),
+               'elapsed': 0.0086 + i * 1e-7, 'url': 'http://127.0.0.1:9000/',
+               'agent_id': 1727, 'method': 'GET', 'run_id': run_id}
+
+
+def clean(client):
+    for pattern in ('*bench-legacy*', '*bench'):
+        keys = client.keys(pattern)
+        if keys:
+            client.delete(*keys)
+
+
+def bench(name, add, flush, run_id, number):
+    events = list(get_events(run_id, number))
+    start = time.time()
+    for event in events:
+        add(event)
+    flush()
+    duration = time.time() - start
+    print('%-12s %10d %12.0f' % (name, number, number / duration))
+
+
+def main(number=10000):
+    db = RedisDB(ioloop.IOLoop())
+    clean(db._redis)
+    try:
+        print('%-12s %10s %12s' % ('add', 'events', 'events/s'))
+        bench('legacy', lambda event: legacy_add(db, event), lambda: None,
+              'bench-legacy', number)
+        bench('batched', db.add, db.flush, 'bench', number)
+    finally:
+        db.close()
+        clean(db._redis)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if '--fake' in args:
+        import fakeredis
+        args.remove('--fake')
+        redis.StrictRedis = fakeredis.FakeStrictRedis
+    if args:
+        main(int(args[0]))
+    else:
+        main()
@@ -1,8 +1,7 @@
 import unittest
 
-from requests.adapters import HTTPAdapter
-
-from loads.measure import Session, TestApp
+from loads.dns import get_resolver
+from loads.measure import Session, TestApp, get_adapter
 from loads.results import LoadsTestResult, UnitTestTestResult
 
 
@@ -17,9 +16,6 @@ class FakeTestApp(object):
         return wrapper
 
 
-MAX_CON = 1000
-
-
 class TestCase(unittest.TestCase):
 
     server_url = None
@@ -33,10 +29,12 @@ class TestCase(unittest.TestCase):
             self.server_url = config['server_url']
         self._test_result = test_result
         dns_resolve = not config.get('no_dns_resolve', False)
+        resolver = get_resolver(config.get('dns_ttl'),
+                                config.get('dns_policy'))
         self.session = Session(test=self, test_result=test_result,
-                               dns_resolve=dns_resolve)
-        http_adapter = HTTPAdapter(pool_maxsize=MAX_CON,
-                                   pool_connections=MAX_CON)
+                               dns_resolve=dns_resolve, resolver=resolver)
+        http_adapter = get_adapter(config.get('connection_pool') or 'user',
+                                   config.get('pool_size'))
         self.session.mount('http://', http_adapter)
         self.session.mount('https://', http_adapter)
 
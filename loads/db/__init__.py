@@ -1,4 +1,6 @@
 from loads.util import logger
+from loads.results.aggregate import (get_event_counts, add_timings,
+                                     merge_timings)
 
 
 class BaseDB(object):
@@ -47,6 +49,49 @@ class BaseDB(object):
     def get_urls(self, run_id):
         raise NotImplementedError()
 
+    def get_timings(self, run_id):
+        raise NotImplementedError()
+
+    def get_rollups(self, run_id, url=None, start=None, end=None, step=1):
+        raise NotImplementedError()
+
+    def get_metrics(self):
+        return {}
+
+
+def add_counters(data, counts, urls, timings, rollups, second):
+    """Adds an event to the counters of its run: the *counts* of each type
+    of event, the hits per url in *urls*, the sums of the *timings* per url,
+    and the *rollups* of the given second.
+    """
+    data_type = data.get('data_type', 'unknown')
+
+    if data_type in ('add_hits', 'add_tests', 'add_lags', 'connection_open',
+                     'relay_stats'):
+        # summaries sent by the agents
+        counts_ = get_event_counts(data)
+        hits = data.get('histogram', {}).get('count', 0)
+    else:
+        counts_ = {data_type: data.get('size', 1)}
+        hits = 1
+
+    for data_type_, count in counts_.items():
+        counts[data_type_] += count
+
+    if 'url' in data:
+        urls[data['url']] += hits
+
+    if data.get('timings') is not None:
+        sums = timings[data['url']]
+        if data_type == 'add_hits':
+            merge_timings(sums, data['timings'])
+        else:
+            add_timings(sums, data['timings'], data.get('sent'),
+                        data.get('received'))
+
+    if data_type in ('add_hit', 'add_hits'):
+        rollups.add(second, data)
+
 
 def get_database(name='python', loop=None, **options):
     if name == 'python':
@@ -55,6 +100,9 @@ def get_database(name='python', loop=None, **options):
     elif name == 'redis':
         from loads.db._redis import RedisDB
         klass = RedisDB
+    elif name == 'sqlite':
+        from loads.db._sqlite import SQLiteDB
+        klass = SQLiteDB
     else:
         raise NotImplementedError(name)
 
@@ -75,6 +123,13 @@ def get_backends():
     from loads.db._python import BrokerDB
     backends.append((BrokerDB.name, _options(BrokerDB)))
 
+    try:
+        from loads.db._sqlite import SQLiteDB
+    except ImportError:
+        pass
+    else:
+        backends.append((SQLiteDB.name, _options(SQLiteDB)))
+
     try:
         from loads.db._redis import RedisDB
     except ImportError:
@@ -1,11 +1,17 @@
 import zlib
 import os
+import sys
+import time
 from collections import defaultdict
+from itertools import islice, izip
 
-from gevent.queue import Queue
+from gevent.monkey import get_original
 from zmq.green.eventloop import ioloop
-from loads.db import BaseDB
-from loads.util import json, dict_hash
+from loads.db import BaseDB, add_counters
+from loads.db._segments import (SegmentedStore, DEFAULT_SEGMENT_SIZE,
+                                DEFAULT_BLOCK_SIZE, map_file)
+from loads.util import json, dict_hash, logger
+from loads.results.aggregate import new_timings, average_timings, RollupStats
 
 
 DEFAULT_DBDIR = os.path.join('/tmp', 'loads')
@@ -13,46 +19,133 @@ ZLIB_START = 'x\x9c'
 ZLIB_END = 'x\x8c'
 GIGA = 1024. * 1024. * 1024.
 
+# the writes bypass the gevent patching, if any
+_start_new_thread = get_original('thread', 'start_new_thread')
+_allocate_lock = get_original('thread', 'allocate_lock')
+
+
+def _read_zrecord(data, pos):
+    # decompresses up to the next markers until zlib tells the record is over.
+    decompressor = zlib.decompressobj()
+    chunks = []
+    end = pos
+    while not decompressor.unused_data:
+        marker = data.find(ZLIB_END, end + 1)
+        if marker == -1:
+            # not a full record
+            return None, None
+        chunk = buffer(data, end, marker + len(ZLIB_END) - end)
+        try:
+            chunks.append(decompressor.decompress(chunk))
+        except zlib.error:
+            raise ValueError(data[pos:marker])
+        end = marker + len(ZLIB_END)
+
+    return ''.join(chunks), end - len(decompressor.unused_data)
+
 
 def read_zfile(filename):
-    remaining = ''
+    """Yields the (record, line) couples of a file of zlib records.
 
-    with open(filename, 'rb') as f:
-        while True:
-            data = remaining + f.read(1024)
-            if not data:
-                raise StopIteration()
+    The markers may also appear inside the compressed records: when the data
+    up to the next ZLIB_END marker is not a full record, the following
+    markers are tried.
+    """
+    data = map_file(filename)
+    if data is None:
+        return
 
-            size = len(data)
-            pos = 0
+    try:
+        pos = 0
+        while True:
+            pos = data.find(ZLIB_START, pos)
+            if pos == -1:
+                return
+
+            end = data.find(ZLIB_END, pos + 1)
+            if end == -1:
+                return
+
+            try:
+                line = zlib.decompress(buffer(data, pos, end - pos))
+            except zlib.error:
+                line, end = _read_zrecord(data, pos)
+                if line is None:
+                    return
 
-            while pos < size:
-                # grabbing a record
-                rstart = data.find(ZLIB_START, pos)
-                rend = data.find(ZLIB_END, rstart+1)
+            yield json.loads(line), line
+            pos = end + len(ZLIB_END)
+    finally:
+        data.close()
 
-                if rend == -1 or rstart == rend:
-                    # not a full record
-                    break
 
-                line = data[rstart:rend]
-                if not line:
-                    break
+class Schema(object):
+    """The keys of the records of a run, and their layouts.
 
-                try:
-                    line = zlib.decompress(line)
-                except zlib.error:
-                    raise ValueError(line)
+    Each key gets an id, in the order they are seen, and each set of keys
+    found in a record gets a layout: the list of the ids of its keys. A
+    record is stored as the id of its layout followed by its values, in
+    the order of the layout, so the keys are not repeated in each record.
 
-                record = json.loads(line)
-                yield record, line
+    The new keys and layouts are appended to the schema file when *save*
+    is called, and never written again.
+    """
 
-                pos = rend + len(ZLIB_END)
+    def __init__(self, path):
+        self.path = path
+        self.keys = []
+        self.layouts = []
+        self._ids = {}
+        self._layout_ids = {}
+        self._saved = 0, 0
+
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    line = json.loads(line)
+                    for key in line['keys']:
+                        self._add_key(key)
+                    for layout in line['layouts']:
+                        self._add_layout(tuple(self.keys[id_]
+                                               for id_ in layout))
+            self._saved = len(self.keys), len(self.layouts)
+
+    def _add_key(self, key):
+        self._ids[key] = len(self.keys)
+        self.keys.append(key)
+
+    def _add_layout(self, keys):
+        for key in keys:
+            if key not in self._ids:
+                self._add_key(key)
+        self._layout_ids[keys] = layout = len(self.layouts)
+        self.layouts.append(keys)
+        return layout
+
+    def compress(self, record):
+        keys = tuple(record)
+        layout = self._layout_ids.get(keys)
+        if layout is None:
+            layout = self._add_layout(keys)
+        values = record.values()
+        values.insert(0, layout)
+        return values
+
+    def uncompress(self, record):
+        return dict(izip(self.layouts[record[0]], islice(record, 1, None)))
+
+    def save(self):
+        """Appends the keys and layouts added since the last save."""
+        keys, layouts = self._saved
+        if (keys, layouts) == (len(self.keys), len(self.layouts)):
+            return
 
-            if pos < size:
-                remaining = data[pos:]
-            else:
-                remaining = ''
+        line = {'keys': self.keys[keys:],
+                'layouts': [[self._ids[key] for key in layout]
+                            for layout in self.layouts[layouts:]]}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(line) + '\n')
+        self._saved = len(self.keys), len(self.layouts)
 
 
 def get_dir_size(path):
@@ -66,38 +159,97 @@ def get_dir_size(path):
     return total_size / GIGA
 
 
+class Writer(object):
+    """Runs a write in a native thread, and keeps its error for the caller.
+
+    The original thread functions are used even when gevent patched them,
+    so the write never goes through the gevent hub, which would otherwise
+    run behind the back of the broker's loop.
+    """
+    def __init__(self, write, data):
+        self._done = _allocate_lock()
+        self._done.acquire()
+        self._error = None
+        _start_new_thread(self._run, (write, data))
+
+    def _run(self, write, data):
+        try:
+            write(data)
+        except Exception:
+            self._error = sys.exc_info()
+        finally:
+            self._done.release()
+
+    def ready(self):
+        return not self._done.locked()
+
+    def get(self):
+        """Waits for the write, and raises its error if it failed."""
+        with self._done:
+            pass
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+
 class BrokerDB(BaseDB):
     """A simple DB that's synced on disc eventually
+
+    The files are written by a thread, so the broker keeps on receiving the
+    data meanwhile. Every *sync_delay* milliseconds, the records received
+    since the last write and the current counters are handed to the writer,
+    and new buffers are started. When the writer is still busy, the records
+    are kept until it's done, up to *queue_size* records: *add* then waits
+    for the writer.
     """
     name = 'python'
     options = {'directory': (DEFAULT_DBDIR, 'DB path.', str),
                'sync_delay': (2000, 'Sync delay', int),
-               'max_size': (-1, 'Max Size in Gigabytes', float)}
+               'max_size': (-1, 'Max Size in Gigabytes', float),
+               'segment_size': (DEFAULT_SEGMENT_SIZE,
+                                'Size of the data files, in bytes', int),
+               'block_size': (DEFAULT_BLOCK_SIZE,
+                              'Records compressed together', int),
+               'queue_size': (100000, 'Max records waiting to be written',
+                              int)}
 
     def _initialize(self):
         self.directory = self.params['directory']
         self.sync_delay = self.params['sync_delay']
         self.max_size = self.params['max_size']
+        self.segment_size = self.params['segment_size']
+        self.block_size = self.params['block_size']
+        self.queue_size = self.params['queue_size']
 
         if not os.path.exists(self.directory):
             os.makedirs(self.directory)
 
-        self._buffer = defaultdict(Queue)
-        self._errors = defaultdict(Queue)
-        self._callback = ioloop.PeriodicCallback(self.flush, self.sync_delay,
+        # the records and rollups received since the last write
+        self._buffer = defaultdict(list)
+        self._errors = defaultdict(list)
+        self._rollups = defaultdict(RollupStats)
+        self._pending = 0
+        self._received = None
+
+        self._writing = None
+        self._callback = ioloop.PeriodicCallback(self._write, self.sync_delay,
                                                  self.loop)
         self._callback.start()
         self._counts = defaultdict(lambda: defaultdict(int))
         self._dirty = False
         self._metadata = defaultdict(dict)
         self._urls = defaultdict(lambda: defaultdict(int))
+        self._timings = defaultdict(lambda: defaultdict(new_timings))
         self._headers = defaultdict(dict)
-        self._key_headers = defaultdict(dict)
+        self._schemas = {}
+        self._stores = {}
+        self._metrics = {'writes': 0, 'flush_duration': [0, 0., 0.],
+                         'ingest_latency': [0, 0., 0.]}
 
     def ping(self):
         return True
 
     def _update_headers(self, run_id):
+        # the keys of the records stored before the schemas
         filename = os.path.join(self.directory, run_id + '-headers.json')
         if os.path.exists(filename):
             with open(filename) as f:
@@ -108,34 +260,20 @@ class BrokerDB(BaseDB):
                             for key, value in headers.items()])
             self._headers[run_id].update(headers)
 
-            for key, value in self._headers[run_id].items():
-                self._key_headers[run_id][value] = key
+    def _get_schema(self, run_id):
+        schema = self._schemas.get(run_id)
+        if schema is None:
+            path = os.path.join(self.directory, run_id + '-schema.json')
+            schema = self._schemas[run_id] = Schema(path)
+        return schema
 
     def _compress_headers(self, run_id, data):
-        result = {}
-        headers = self._headers[run_id]
-
-        for key, value in data.items():
-            if key not in self._key_headers[run_id]:
-                self._dirty = True
-                compressed_keys = headers.keys()
-                if len(compressed_keys) == 0:
-                    next_compressed_key = 0
-                else:
-                    compressed_keys.sort()
-                    next_compressed_key = compressed_keys[-1] + 1
-
-                self._headers[run_id][next_compressed_key] = key
-                self._key_headers[run_id][key] = next_compressed_key
-                key = next_compressed_key
-            else:
-                key = self._key_headers[run_id][key]
-
-            result[key] = value
-
-        return result
+        return self._get_schema(run_id).compress(data)
 
     def _uncompress_headers(self, run_id, data):
+        if isinstance(data, list):
+            return self._get_schema(run_id).uncompress(data)
+
         result = {}
         for key, value in data.items():
             result[self._headers[run_id][int(key)]] = value
@@ -147,6 +285,7 @@ class BrokerDB(BaseDB):
         # reload existing file if any
         if existing == {}:
             filename = os.path.join(self.directory, run_id + '-metadata.json')
+            self._wait()
             if os.path.exists(filename):
                 with open(filename) as f:
                     existing = json.load(f)
@@ -172,40 +311,57 @@ class BrokerDB(BaseDB):
         run_id = data['run_id']
         self.update_metadata(run_id, has_data=1)
         data_type = data.get('data_type', 'unknown')
-        self._counts[run_id][data_type] += data.get('size', 1)
-        self._buffer[run_id].put(dict(data))
 
-        if 'url' in data:
-            self._urls[run_id][data['url']] += 1
+        add_counters(data, self._counts[run_id], self._urls[run_id],
+                     self._timings[run_id], self._rollups[run_id],
+                     int(time.time()))
+        self._buffer[run_id].append(dict(data))
 
         if data_type in ('addError', 'addFailure'):
-            self._errors[run_id].put(dict(data))
+            self._errors[run_id].append(dict(data))
 
+        if self._received is None:
+            self._received = time.time()
+        self._pending += 1
         self._dirty = True
 
-    def _dump_queue(self, run_id, queue, filename, compress=True):
-        # lines
-        qsize = queue.qsize()
-        if qsize == 0:
-            return
+        if self._pending >= self.queue_size:
+            self._wait()
+            self._write()
 
+    def _get_store(self, run_id):
+        store = self._stores.get(run_id)
+        if store is None:
+            store = SegmentedStore(self.directory, run_id, self.segment_size,
+                                   self.block_size)
+            self._stores[run_id] = store
+        return store
+
+    def _read_lines(self, run_id, lines):
         if run_id is None:
             run_id = 'unknown'
 
+        for line in lines:
+            if 'run_id' not in line:
+                line['run_id'] = run_id
+            yield line
+
+    def _compress_lines(self, schema, run_id, lines):
+        return [schema.compress(line)
+                for line in self._read_lines(run_id, lines)]
+
+    def _dump_lines(self, lines, filename):
+        if not lines:
+            return
+
         with open(filename, 'ab+') as f:
-            for i in range(qsize):
-                line = queue.get()
-                if 'run_id' not in line:
-                    line['run_id'] = run_id
-                line = self._compress_headers(run_id, line)
-                if compress:
-                    f.write(zlib.compress(json.dumps(line)) + ZLIB_END)
-                else:
-                    f.write(json.dumps(line) + '\n')
+            for line in lines:
+                f.write(json.dumps(line) + '\n')
 
     def prepare_run(self):
         if self.max_size == -1:
             return
+        self._wait()
         current_size = get_dir_size(self.directory)
         runs = self.get_runs()
         if current_size >= self.max_size:
@@ -216,77 +372,172 @@ class BrokerDB(BaseDB):
                     return
 
     def delete_run(self, run_id):
+        self._wait()
         for suffix in ('metadata', 'errors', 'db', 'counts', 'urls',
-                       'headers'):
+                       'timings', 'rollups', 'headers', 'schema'):
 
             filename = os.path.join(self.directory,
                                     '%s-%s.json' % (run_id, suffix))
             if os.path.exists(filename):
                 os.remove(filename)
 
+        self._get_store(run_id).delete()
+        del self._stores[run_id]
+
         for mapping in (self._counts, self._metadata, self._urls,
-                        self._headers, self._key_headers):
+                        self._timings, self._rollups, self._headers,
+                        self._schemas):
             if run_id in mapping:
                 del mapping[run_id]
 
     def is_summarized(self, run_id):
+        self._wait()
         db = os.path.join(self.directory, '%s-db.json' % run_id)
         meta = os.path.join(self.directory, '%s-metadata.json' % run_id)
-        return os.path.exists(meta) and not os.path.exists(db)
+        return (os.path.exists(meta) and not os.path.exists(db) and
+                not self._get_store(run_id).exists())
 
     def summarize_run(self, run_id):
-        # we just remove the -db file
-        # XXX in the future we'll want to move it to another
+        # we just remove the data files
+        # XXX in the future we'll want to move them to another
         # storage so we keep the details.
+        self.flush()
         filename = os.path.join(self.directory,
                                 '%s-db.json' % run_id)
         if os.path.exists(filename):
             os.remove(filename)
+        self._get_store(run_id).delete()
 
-    def flush(self):
+    def _wait(self):
+        """Waits for the writer to be done with the data handed to it."""
+        if self._writing is not None:
+            writing, self._writing = self._writing, None
+            writing.get()
+
+    def _write(self):
+        """Hands the data received since the last write to the writer, unless
+        it's still busy with the previous data."""
         if not self._dirty:
             return
+        if self._writing is not None and not self._writing.ready():
+            return
+        self._wait()
+
+        # the new records are handed over, the counters are copied.
+        data = {'records': self._buffer, 'errors': self._errors,
+                'rollups': self._rollups, 'received': self._received,
+                'metadata': {}, 'counts': {}, 'urls': {}, 'timings': {},
+                'schemas': {}, 'stores': {}}
+
+        for run_id, metadata in self._metadata.items():
+            data['metadata'][run_id] = dict(metadata)
+
+        for run_id in self._buffer:
+            # created here, as the writer must not change the mappings
+            data['schemas'][run_id] = self._get_schema(run_id)
+            data['stores'][run_id] = self._get_store(run_id)
+            data['counts'][run_id] = dict(self._counts[run_id])
+            data['urls'][run_id] = dict(self._urls[run_id])
+            if run_id in self._timings:
+                data['timings'][run_id] = dict([
+                    (url, dict(sums))
+                    for url, sums in self._timings[run_id].items()])
+
+        self._buffer = defaultdict(list)
+        self._errors = defaultdict(list)
+        self._rollups = defaultdict(RollupStats)
+        self._pending = 0
+        self._received = None
+        self._dirty = False
+        self._writing = Writer(self._write_files, data)
+
+    def _write_files(self, data):
+        # called in the writer thread
+        started = time.time()
 
         # saving metadata files
-        for run_id in self._metadata:
-            # metadata
+        for run_id, metadata in data['metadata'].items():
             filename = os.path.join(self.directory, run_id + '-metadata.json')
             with open(filename, 'w') as f:
-                json.dump(self._metadata[run_id], f)
+                json.dump(metadata, f)
 
-        if len(self._buffer) == 0:
-            return
+        for run_id, lines in data['records'].items():
+            schema = data['schemas'][run_id]
+            records = zip([line.get('data_type', 'unknown')
+                           for line in lines],
+                          self._compress_lines(schema, run_id, lines))
+            errors = self._compress_lines(schema, run_id,
+                                          data['errors'].get(run_id, []))
+
+            # the new keys are saved before the records using them
+            schema.save()
 
-        for run_id, queue in self._errors.items():
             # error lines
             filename = os.path.join(self.directory, run_id + '-errors.json')
-            self._dump_queue(run_id, queue, filename, compress=False)
+            self._dump_lines(errors, filename)
 
-        for run_id, queue in self._buffer.items():
             # all lines
-            filename = os.path.join(self.directory, run_id + '-db.json')
-            self._dump_queue(run_id, queue, filename)
+            data['stores'][run_id].append(records)
 
             # counts
             filename = os.path.join(self.directory, run_id + '-counts.json')
-            counts = dict(self._counts[run_id])
             with open(filename, 'w') as f:
-                json.dump(counts, f)
+                json.dump(data['counts'][run_id], f)
 
             # urls
             filename = os.path.join(self.directory, run_id + '-urls.json')
             with open(filename, 'w') as f:
-                json.dump(self._urls[run_id], f)
-
-            # headers
-            filename = os.path.join(self.directory, run_id + '-headers.json')
-            with open(filename, 'w') as f:
-                json.dump(self._headers[run_id], f)
+                json.dump(data['urls'][run_id], f)
+
+            # timings
+            if run_id in data['timings']:
+                filename = os.path.join(self.directory,
+                                        run_id + '-timings.json')
+                with open(filename, 'w') as f:
+                    json.dump(data['timings'][run_id], f)
+
+            # rollups, appended as they may come late for a given second
+            rollups = data['rollups'].get(run_id)
+            if rollups:
+                filename = os.path.join(self.directory,
+                                        run_id + '-rollups.json')
+                with open(filename, 'a') as f:
+                    for rollup in rollups.dump():
+                        f.write(json.dumps(rollup) + '\n')
+
+        ended = time.time()
+        self._metrics['writes'] += 1
+        self._add_metric('flush_duration', ended - started)
+        if data['received'] is not None:
+            self._add_metric('ingest_latency', ended - data['received'])
+
+    def _add_metric(self, name, value):
+        metric = self._metrics[name]
+        metric[0] += 1
+        metric[1] += value
+        metric[2] = max(metric[2], value)
+
+    def get_metrics(self):
+        metrics = {'writes': self._metrics['writes'],
+                   'pending': self._pending}
+        for name in ('flush_duration', 'ingest_latency'):
+            count, total, max_ = self._metrics[name]
+            metrics[name] = {'average': count and total / count,
+                             'max': max_}
+        return metrics
 
-        self._dirty = False
+    def flush(self):
+        """Writes the data received so far, and waits until it's done."""
+        self._wait()
+        self._write()
+        self._wait()
 
     def close(self):
         self._callback.stop()
+        try:
+            self._wait()
+        except Exception:
+            logger.exception('Could not write the data')
 
     def get_urls(self, run_id):
         self.flush()
@@ -298,6 +549,33 @@ class BrokerDB(BaseDB):
         with open(filename) as f:
             return json.load(f)
 
+    def get_timings(self, run_id):
+        self.flush()
+        filename = os.path.join(self.directory, run_id + '-timings.json')
+
+        if not os.path.exists(filename):
+            return {}
+
+        with open(filename) as f:
+            timings = json.load(f)
+
+        return dict([(url, average_timings(sums))
+                     for url, sums in timings.items()])
+
+    def get_rollups(self, run_id, url=None, start=None, end=None, step=1):
+        self.flush()
+        filename = os.path.join(self.directory, run_id + '-rollups.json')
+
+        if not os.path.exists(filename):
+            return []
+
+        rollups = RollupStats()
+        with open(filename) as f:
+            for line in f:
+                rollups.load(json.loads(line))
+
+        return rollups.get(url, start, end, step)
+
     def get_counts(self, run_id):
         self.flush()
         filename = os.path.join(self.directory, run_id + '-counts.json')
@@ -319,36 +597,29 @@ class BrokerDB(BaseDB):
         runs.sort()
         return [path[:-len('-metadata.json')] for created, path in runs]
 
-    def _batch(self, filename, start=None, size=None, filter=None,
-               run_id=None, decompress=True):
-        if start is not None and size is not None:
-            end = start + size
-        else:
-            end = None
+    def _batch(self, records, start=None, size=None, data_type=None,
+               run_id=None, first=0):
+        """Yields *size* records from the *start* one.
 
-        # XXX suboptimal iterates until start is reached.
+        With a *data_type*, the other records are skipped and the records
+        of that type are numbered among themselves, from *first*.
+        """
         sent = 0
-        current = 0
 
-        def _reader():
-            if decompress:
-                for record, line in read_zfile(filename):
-                    yield record, line
-            else:
-                with open(filename, 'rb') as f:
-                    for line in f:
-                        yield json.loads(line), line
+        for current, record in records:
+            if sent == size:
+                raise StopIteration()
 
-        for current, (record, line) in enumerate(_reader()):
             record = self._uncompress_headers(run_id, record)
 
             # filtering
-            if filter is not None and filter(record):
-                continue
+            if data_type is not None:
+                if data_type != record.get('data_type'):
+                    continue
+                current, first = first, first + 1
+
             if start is not None and current < start:
                 continue
-            elif end is not None and current > end or sent == size:
-                raise StopIteration()
 
             yield record
 
@@ -366,8 +637,13 @@ class BrokerDB(BaseDB):
 
         self._update_headers(run_id)
 
-        for data in self._batch(filename, start, size, run_id=run_id,
-                                decompress=False):
+        def _reader():
+            with open(filename, 'rb') as f:
+                for line in f:
+                    yield json.loads(line)
+
+        for data in self._batch(enumerate(_reader()), start, size,
+                                run_id=run_id):
             yield data
 
     def get_data(self, run_id, data_type=None, groupby=False, start=None,
@@ -376,27 +652,38 @@ class BrokerDB(BaseDB):
             start = 0
 
         self.flush()
+        store = self._get_store(run_id)
         filename = os.path.join(self.directory, run_id + '-db.json')
 
-        if not os.path.exists(filename):
+        first = 0
+        if store.exists():
+            if data_type is None:
+                records = store.read(start or 0)
+            else:
+                # the pages are within the records of that type: the index
+                # tells in which block the page starts, and the blocks
+                # without that type are not even read.
+                number, first = store.locate(data_type, start or 0)
+                records = store.read(number, data_type)
+        elif os.path.exists(filename):
+            # runs stored before the segments, one zlib record at a time.
+            records = enumerate(record for record, line
+                                in read_zfile(filename))
+        else:
             raise StopIteration()
 
         self._update_headers(run_id)
 
-        def _filtered(data):
-            return (data_type is not None and
-                    data_type != data.get('data_type'))
-
         if not groupby:
-            for data in self._batch(filename, start, size, _filtered,
-                                    run_id=run_id):
+            for data in self._batch(records, start, size, data_type,
+                                    run_id=run_id, first=first):
                 yield data
         else:
 
             result = {}
 
-            for data in self._batch(filename, start, size, _filtered,
-                                    run_id=run_id):
+            for data in self._batch(records, start, size, data_type,
+                                    run_id=run_id, first=first):
                 data_hash = dict_hash(data, ['count'])
                 if data_hash in result:
                     result[data_hash]['count'] += 1
@@ -4,21 +4,61 @@ except ImportError:
     raise ImportError("You need to install http://pypi.python.org/pypi/redis")
 
 import hashlib
+import time
+from collections import defaultdict
 
-from loads.db import BaseDB
+from zmq.green.eventloop import ioloop
+from loads.db import BaseDB, add_counters
 from loads.util import json
+from loads.results.aggregate import (new_timings, average_timings,
+                                     RollupStats, DEFAULT_PRECISION)
 
 
 class RedisDB(BaseDB):
+    """A DB that stores the data in Redis.
+
+    The events are buffered, and sent to Redis in a single pipeline every
+    *sync_delay* milliseconds, or once *batch_size* events are waiting.
+    The counters of the buffered events are summed before being sent, so
+    each counter is only incremented once per pipeline.
+
+    The events of a run are numbered from the first one, and stored once in
+    the *events:<run>* hash. The *index:<run>:<type>* lists have the numbers
+    of the events of each type, newest first. The runs stored before that,
+    in the *data:<run>* list, can still be read.
+    """
     name = 'redis'
     options = {'host': ('localhost', 'Redis host', str),
-               'port': (6379, 'Redis port', int)}
+               'port': (6379, 'Redis port', int),
+               'sync_delay': (200, 'Sync delay', int),
+               'batch_size': (1000, 'Events sent to Redis at once', int),
+               'read_size': (1000, 'Events read from Redis at once', int)}
 
     def _initialize(self):
         self.host = self.params['host']
         self.port = self.params['port']
+        self.sync_delay = self.params['sync_delay']
+        self.batch_size = self.params['batch_size']
+        self.read_size = self.params['read_size']
         self._redis = redis.StrictRedis(host=self.host, port=self.port,
                                         db=0)
+        self._reset()
+        self._callback = ioloop.PeriodicCallback(self.flush, self.sync_delay,
+                                                 self.loop)
+        self._callback.start()
+
+    def _reset(self):
+        # the events received since the last flush
+        self._pending = 0
+        self._data = defaultdict(list)
+        # the position of the events of each type in self._data
+        self._types = defaultdict(lambda: defaultdict(list))
+        self._counts = defaultdict(lambda: defaultdict(int))
+        self._urls = defaultdict(lambda: defaultdict(int))
+        self._timings = defaultdict(lambda: defaultdict(new_timings))
+        self._rollups = defaultdict(RollupStats)
+        # the number of identical events, by event
+        self._groups = defaultdict(lambda: defaultdict(int))
 
     def ping(self):
         try:
@@ -51,125 +91,282 @@ class RedisDB(BaseDB):
         data_type = data['data_type'] = data.get('data_type', 'unknown')
         size = data.get('size', 1)
 
-        pipeline = self._redis.pipeline()
-        pipeline.sadd('runs', run_id)
-
-        # adding counts
-        counter = 'count:%s:%s' % (run_id, data_type)
-        counters = 'counters:%s' % run_id
-        if not self._redis.sismember(counters, counter):
-            pipeline.sadd(counters, counter)
-
-        pipeline.incrby('count:%s:%s' % (run_id, data_type), size)
-
-        # adding urls
-        if 'url' in data:
-            url = data['url']
-            urls = 'urls:%s' % run_id
-            if not self._redis.sismember(urls, url):
-                pipeline.sadd(urls, url)
-            pipeline.incrby('url:%s:%s' % (run_id, url), 1)
+        # adding the counters
+        add_counters(data, self._counts[run_id], self._urls[run_id],
+                     self._timings[run_id], self._rollups[run_id],
+                     int(time.time()))
 
         # adding data
         dumped = json.dumps(data)
-        pipeline.lpush('data:%s' % run_id, dumped)
-
-        # adding errors
-        if data_type == 'addError':
-            pipeline.lpush('errors:%s' % run_id, dumped)
+        self._types[run_id][data_type].append(len(self._data[run_id]))
+        self._data[run_id].append(dumped)
 
         # adding group by
-        md5 = hashlib.md5(dumped).hexdigest()
-        pipeline.incrby('bcount:%s:%s' % (run_id, md5), size)
-        pipeline.set('bvalue:%s:%s' % (run_id, md5), dumped)
-        bcounters = 'bcounters:%s' % run_id
-        if not self._redis.sismember(bcounters, md5):
-            pipeline.sadd(bcounters, md5)
+        self._groups[run_id][dumped] += size
 
-        pipeline.execute()
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
 
     def flush(self):
-        pass
+        """Sends the buffered events to Redis."""
+        if self._pending == 0:
+            return
+
+        pipeline = self._redis.pipeline(transaction=False)
+        pipeline.sadd('runs', *self._data.keys())
+
+        for run_id, lines in self._data.items():
+            # the numbers of the events are reserved first, so several
+            # brokers can write in the same run.
+            first = self._redis.incrby('nevents:%s' % run_id,
+                                       len(lines)) - len(lines)
+            pipeline.hmset('events:%s' % run_id,
+                           dict([(first + index, line)
+                                 for index, line in enumerate(lines)]))
+
+            # the lists are read from the newest event
+            for data_type, indexes in self._types[run_id].items():
+                pipeline.lpush('index:%s:%s' % (run_id, data_type),
+                               *[first + index for index in indexes])
+
+            counts = 'counts:%s' % run_id
+            for data_type, count in self._counts[run_id].items():
+                pipeline.hincrby(counts, data_type, count)
+
+            urls = 'urls:%s' % run_id
+            for url, hits in self._urls[run_id].items():
+                pipeline.hincrby(urls, url, hits)
+
+            for url, sums in self._timings[run_id].items():
+                key = 'timings:%s:%s' % (run_id, url)
+                for name, value in sums.items():
+                    if value:
+                        pipeline.hincrbyfloat(key, name, value)
+
+            for rollup in self._rollups[run_id].dump():
+                member = json.dumps([rollup['second'], rollup['url']])
+                pipeline.sadd('rollups:%s' % run_id, member)
+                key = 'rollup:%s:%s' % (run_id, member)
+                pipeline.hincrby(key, 'hits', rollup['hits'])
+                pipeline.hincrby(key, 'errors', rollup['errors'])
+                histogram = rollup['histogram']
+                pipeline.hincrbyfloat(key, 'total', histogram['total'])
+                for index, count in histogram['buckets'].items():
+                    pipeline.hincrby(key, 'bucket:%d' % index, count)
+
+            bcounts = 'bcounts:%s' % run_id
+            bvalues = 'bvalues:%s' % run_id
+            for dumped, count in self._groups[run_id].items():
+                md5 = hashlib.md5(dumped).hexdigest()
+                pipeline.hincrby(bcounts, md5, count)
+                pipeline.hsetnx(bvalues, md5, dumped)
+
+        self._reset()
+        pipeline.execute()
 
     def close(self):
-        pass
+        self._callback.stop()
+        self.flush()
 
-    def get_urls(self, run_id):
-        urls = {}
-        for url in self._redis.smembers('urls:%s' % run_id):
-            urls[url] = int(self._redis.get('url:%s:%s' % (run_id, url)))
+    def _is_old(self, run_id):
+        # the runs stored before the events were numbered
+        return bool(self._redis.exists('data:%s' % run_id))
 
-        return urls
+    def get_urls(self, run_id):
+        self.flush()
+        key = 'urls:%s' % run_id
+        if self._redis.type(key) == 'set':
+            # runs stored before the hits were kept in a hash
+            return dict([(url, int(self._redis.get('url:%s:%s' %
+                                                   (run_id, url))))
+                         for url in self._redis.smembers(key)])
+
+        urls = self._redis.hgetall(key)
+        return dict([(url, int(hits)) for url, hits in urls.items()])
+
+    def get_timings(self, run_id):
+        self.flush()
+        timings = {}
+        if self._redis.type('urls:%s' % run_id) == 'set':
+            # runs stored before the timings
+            return timings
+
+        for url in self._redis.hkeys('urls:%s' % run_id):
+            sums = self._redis.hgetall('timings:%s:%s' % (run_id, url))
+            if sums:
+                sums = dict([(name, float(value))
+                             for name, value in sums.items()])
+                timings[url] = average_timings(sums)
+
+        return timings
+
+    def get_rollups(self, run_id, url=None, start=None, end=None, step=1):
+        self.flush()
+        rollups = RollupStats()
+        for member in self._redis.smembers('rollups:%s' % run_id):
+            second, url_ = json.loads(member)
+            if url is not None and url_ != url:
+                continue
+            if start is not None and second < start:
+                continue
+            if end is not None and second > end:
+                continue
+
+            values = self._redis.hgetall('rollup:%s:%s' % (run_id, member))
+            buckets = dict([(name.split(':')[1], int(count))
+                            for name, count in values.items()
+                            if name.startswith('bucket:')])
+            hits = int(values['hits'])
+            histogram = {'precision': DEFAULT_PRECISION, 'buckets': buckets,
+                         'count': hits, 'total': float(values['total'])}
+            rollups.load({'second': second, 'url': url_, 'hits': hits,
+                          'errors': int(values['errors']),
+                          'histogram': histogram})
+
+        return rollups.get(step=step)
 
     def get_counts(self, run_id):
-        counts = {}
-        counters = 'counters:%s' % run_id
-        for member in self._redis.smembers(counters):
-            name = member.split(':')[-1]
-            counts[name] = int(self._redis.get(member))
-        return counts
+        self.flush()
+        counts = self._redis.hgetall('counts:%s' % run_id)
+        if not counts:
+            # runs stored before the counters were kept in a hash
+            for key in self._redis.smembers('counters:%s' % run_id):
+                counts[key.split(':')[-1]] = self._redis.get(key)
+
+        return dict([(name, int(count)) for name, count in counts.items()])
 
     def get_runs(self):
+        self.flush()
         return self._redis.smembers('runs')
 
-    def get_errors(self, run_id, start=None, size=None):
-        key = 'errors:%s' % run_id
-        len = self._redis.llen(key)
-        if len == 0:
-            raise StopIteration()
-
+    def _read_list(self, key, start=None, size=None):
+        # reads the list by chunks of read_size elements
         if start is None:
             start = 0
+        if size is None:
+            end = -1
+        else:
+            end = start + size - 1
+
+        while end == -1 or start <= end:
+            last = start + self.read_size - 1
+            if end != -1:
+                last = min(last, end)
+
+            lines = self._redis.lrange(key, start, last)
+            for line in lines:
+                yield json.loads(line)
+
+            if len(lines) < last - start + 1:
+                return
+            start = last + 1
+
+    def _read_events(self, run_id, numbers):
+        # reads the events by chunks of read_size numbers
+        key = 'events:%s' % run_id
+        chunk = []
+
+        def _read(chunk):
+            for line in self._redis.hmget(key, chunk):
+                yield json.loads(line)
+
+        for number in numbers:
+            chunk.append(number)
+            if len(chunk) == self.read_size:
+                for data in _read(chunk):
+                    yield data
+                chunk = []
 
+        if chunk:
+            for data in _read(chunk):
+                yield data
+
+    def _get_numbers(self, run_id, data_type=None, start=None, size=None):
+        """Returns the numbers of the events of the run, newest first."""
+        if data_type is not None:
+            return self._read_list('index:%s:%s' % (run_id, data_type),
+                                   start, size)
+
+        last = int(self._redis.get('nevents:%s' % run_id) or 0) - 1
+        last -= start or 0
         if size is None:
-            end = len
+            end = -1
         else:
-            end = start + size
-            if end > len:
-                end = len
+            end = max(last - size, -1)
+        return xrange(last, end, -1)
+
+    def _read_old_data(self, run_id, data_type=None, start=None, size=None):
+        # the old runs have no index: the data is filtered once read, so
+        # the pages are over all the events.
+        for data in self._read_list('data:%s' % run_id, start, size):
+            if data_type is None or data_type == data.get('data_type'):
+                yield data
+
+    def get_errors(self, run_id, start=None, size=None):
+        self.flush()
+        if self._is_old(run_id):
+            return self._read_list('errors:%s' % run_id, start, size)
+
+        numbers = self._get_numbers(run_id, 'addError', start, size)
+        return self._read_events(run_id, numbers)
+
+    def _read_groups(self, run_id):
+        # the values are read by chunks of read_size hashes
+        bcounts = 'bcounts:%s' % run_id
+        bvalues = 'bvalues:%s' % run_id
+        chunk = []
+
+        def _read(chunk):
+            hashes = [hash for hash, counter in chunk]
+            values = self._redis.hmget(bvalues, hashes)
+            for (hash, counter), value in zip(chunk, values):
+                data = json.loads(value)
+                data['count'] = int(counter)
+                yield data
+
+        for group in self._redis.hscan_iter(bcounts, count=self.read_size):
+            chunk.append(group)
+            if len(chunk) == self.read_size:
+                for data in _read(chunk):
+                    yield data
+                chunk = []
+
+        if chunk:
+            for data in _read(chunk):
+                yield data
 
-        for index in range(start, end):
-            yield json.loads(self._redis.lindex(key, index))
+    def _read_old_groups(self, run_id):
+        for hash in self._redis.smembers('bcounters:%s' % run_id):
+            data = json.loads(self._redis.get('bvalue:%s:%s' %
+                                              (run_id, hash)))
+            counter = self._redis.get('bcount:%s:%s' % (run_id, hash))
+            data['count'] = int(counter)
+            yield data
 
     def get_data(self, run_id, data_type=None, groupby=False, start=None,
                  size=None):
-        key = 'data:%s' % run_id
-        len = self._redis.llen(key)
-        if len == 0:
-            raise StopIteration()
+        self.flush()
 
         if not groupby:
-            if start is None:
-                start = 0
-
-            if size is None:
-                end = len
-            else:
-                end = start + size
-                if end > len:
-                    end = len
-
-            for index in range(start, end):
-                data = json.loads(self._redis.lindex(key, index))
-                if data_type is None or data_type == data.get('data_type'):
-                    yield data
+            if self._is_old(run_id):
+                return self._read_old_data(run_id, data_type, start, size)
+
+            numbers = self._get_numbers(run_id, data_type, start, size)
+            return self._read_events(run_id, numbers)
+
+        # XXX not sure how to batch this yet
+        if start is not None or size is not None:
+            raise NotImplementedError()
+
+        if self._is_old(run_id):
+            groups = self._read_old_groups(run_id)
         else:
-            # XXX not sure how to batch this yet
-            if start is not None or size is not None:
-                raise NotImplementedError()
-
-            bcounters = 'bcounters:%s' % run_id
-            for hash in self._redis.smembers(bcounters):
-                data = json.loads(self._redis.get('bvalue:%s:%s' %
-                                  (run_id, hash)))
-                filtered = (data_type is not None and
-                            data_type != data.get('data_type'))
-                if filtered:
-                    continue
-
-                counter = self._redis.get('bcount:%s:%s' % (run_id, hash))
-                data['count'] = int(counter)
-                yield data
+            groups = self._read_groups(run_id)
+        if data_type is None:
+            return groups
+        return (data for data in groups
+                if data.get('data_type') == data_type)
 
     def prepare_run(self):
         pass
@@ -0,0 +1,241 @@
+""" Segmented storage for the records of a run (see loads.db._python).
+
+The records are written in blocks of up to *block_size* records. A block is a
+frame made of its compressed size and its number of records, followed by the
+records compressed together with zlib, one JSON mapping per line. The records
+of a run share most of their keys and values, so compressing them together
+gives much better ratios than compressing them one by one.
+
+The blocks are appended to segment files, and a new segment is started once
+the current one grows over *segment_size* bytes. Each block is indexed in a
+sidecar file, with its position, the number of its first record and the
+number of records of each data type it holds. The readers seek straight to
+the block holding a given record, and skip the blocks without the data type
+they look for.
+
+The files are read through memory maps: the compressed blocks are handed to
+zlib as buffers over the maps, without being copied first.
+"""
+import bisect
+import glob
+import mmap
+import os
+import struct
+import zlib
+from collections import defaultdict
+
+from loads.util import json
+
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_BLOCK_SIZE = 1000
+
+# compressed size, number of records
+FRAME = struct.Struct('<II')
+
+
+def map_file(path):
+    """Returns a read-only memory map of the file, or None if it's empty."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_frames(path):
+    """Yields the (count, data) couples of the blocks of a segment file,
+    *data* being a buffer over the compressed records of the block."""
+    data = map_file(path)
+    if data is None:
+        return
+
+    try:
+        pos, size = 0, len(data)
+        while pos + FRAME.size <= size:
+            length, count = FRAME.unpack_from(data, pos)
+            pos += FRAME.size
+            if pos + length > size:
+                # the last block is still being written.
+                break
+            yield count, buffer(data, pos, length)
+            pos += length
+    finally:
+        data.close()
+
+
+def read_segment(path):
+    """Yields the records of a segment file, without using the index."""
+    for count, data in read_frames(path):
+        for line in zlib.decompress(data).split('\n'):
+            yield json.loads(line)
+
+
+class Block(object):
+    """The index entry of a block."""
+    __slots__ = ('segment', 'offset', 'size', 'start', 'count', 'types')
+
+    def __init__(self, segment, offset, size, start, count, types):
+        self.segment = segment
+        self.offset = offset
+        self.size = size
+        self.start = start
+        self.count = count
+        self.types = types
+
+    @property
+    def end(self):
+        """The offset of the next block in the segment."""
+        return self.offset + FRAME.size + self.size
+
+    def dump(self):
+        return [self.segment, self.offset, self.size, self.start, self.count,
+                self.types]
+
+
+class SegmentedStore(object):
+    """The records of a run, stored in segment files."""
+
+    def __init__(self, directory, run_id, segment_size=DEFAULT_SEGMENT_SIZE,
+                 block_size=DEFAULT_BLOCK_SIZE):
+        self.directory = directory
+        self.run_id = run_id
+        self.segment_size = segment_size
+        self.block_size = block_size
+        self.index_path = os.path.join(directory, run_id + '-index.json')
+        self._blocks = None
+        self._starts = []
+
+    def get_segment_path(self, segment):
+        return os.path.join(self.directory,
+                            '%s-segment-%05d.db' % (self.run_id, segment))
+
+    def exists(self):
+        return os.path.exists(self.index_path)
+
+    def _load(self):
+        if self._blocks is not None:
+            return
+
+        self._blocks = []
+        if self.exists():
+            with open(self.index_path) as f:
+                for line in f:
+                    self._blocks.append(Block(*json.loads(line)))
+        self._starts = [block.start for block in self._blocks]
+
+    @property
+    def blocks(self):
+        self._load()
+        return self._blocks
+
+    @property
+    def count(self):
+        """The number of records stored."""
+        if not self.blocks:
+            return 0
+        last = self._blocks[-1]
+        return last.start + last.count
+
+    def append(self, records):
+        """Stores the given (data_type, record) couples."""
+        if not records:
+            return
+
+        segment, offset, start = 0, 0, self.count
+        if self._blocks:
+            last = self._blocks[-1]
+            segment, offset = last.segment, last.end
+
+        blocks = []
+        f = None
+        try:
+            for pos in range(0, len(records), self.block_size):
+                chunk = records[pos:pos + self.block_size]
+
+                if offset >= self.segment_size:
+                    segment, offset = segment + 1, 0
+                    if f is not None:
+                        f.close()
+                        f = None
+                if f is None:
+                    f = open(self.get_segment_path(segment), 'ab')
+
+                types = defaultdict(int)
+                lines = []
+                for data_type, record in chunk:
+                    types[data_type] += 1
+                    lines.append(json.dumps(record))
+
+                data = zlib.compress('\n'.join(lines))
+                f.write(FRAME.pack(len(data), len(chunk)))
+                f.write(data)
+
+                block = Block(segment, offset, len(data), start, len(chunk),
+                              dict(types))
+                blocks.append(block)
+                offset, start = block.end, start + block.count
+        finally:
+            if f is not None:
+                f.close()
+
+        with open(self.index_path, 'a') as f:
+            for block in blocks:
+                f.write(json.dumps(block.dump()) + '\n')
+
+        self._blocks.extend(blocks)
+        self._starts.extend([block.start for block in blocks])
+
+    def locate(self, data_type, start=0):
+        """Returns the number of the first record of the block holding the
+        *start* record of *data_type*, counted among the records of that
+        type, and the number of records of that type before that block.
+        """
+        self._load()
+        before = 0
+        for block in self._blocks:
+            count = block.types.get(data_type, 0)
+            if before + count > start:
+                return block.start, before
+            before += count
+        return self.count, before
+
+    def read(self, start=0, data_type=None):
+        """Yields the (number, record) couples from the *start* record.
+
+        When a *data_type* is given, the blocks that have no record of that
+        type are skipped, but the records of the other blocks are all
+        returned.
+        """
+        self._load()
+        first = max(bisect.bisect_right(self._starts, start) - 1, 0)
+        segment, data = None, None
+
+        try:
+            for block in self._blocks[first:]:
+                if data_type is not None and data_type not in block.types:
+                    continue
+
+                if block.segment != segment:
+                    if data is not None:
+                        data.close()
+                    segment = block.segment
+                    data = map_file(self.get_segment_path(segment))
+
+                compressed = buffer(data, block.offset + FRAME.size,
+                                    block.size)
+                lines = zlib.decompress(compressed).split('\n')
+
+                for number, line in enumerate(lines, block.start):
+                    if number >= start:
+                        yield number, json.loads(line)
+        finally:
+            if data is not None:
+                data.close()
+
+    def delete(self):
+        pattern = os.path.join(self.directory, self.run_id + '-segment-*.db')
+        for path in glob.glob(pattern) + [self.index_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        self._blocks = None
+        self._starts = []
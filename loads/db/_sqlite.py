@@ -0,0 +1,371 @@
+try:
+    import sqlite3
+except ImportError:
+    raise ImportError("You need Python built with SQLite support")
+
+import hashlib
+import os
+import time
+from collections import defaultdict
+
+from zmq.green.eventloop import ioloop
+from loads.db import BaseDB, add_counters
+from loads.util import json
+from loads.results.aggregate import (get_seconds, new_timings,
+                                     average_timings, RollupStats)
+
+
+DEFAULT_PATH = os.path.join('/tmp', 'loads.db')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    metadata TEXT,
+    summarized INTEGER DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT,
+    data_type TEXT,
+    url TEXT,
+    agent_id TEXT,
+    second INTEGER,
+    status INTEGER,
+    elapsed REAL,
+    hash TEXT,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS events_type ON events (run_id, data_type);
+CREATE INDEX IF NOT EXISTS events_url ON events (run_id, url, second);
+CREATE INDEX IF NOT EXISTS events_hash ON events (run_id, hash);
+
+CREATE TABLE IF NOT EXISTS counts (
+    run_id TEXT,
+    data_type TEXT,
+    count INTEGER DEFAULT 0,
+    PRIMARY KEY (run_id, data_type)
+);
+
+CREATE TABLE IF NOT EXISTS urls (
+    run_id TEXT,
+    url TEXT,
+    hits INTEGER DEFAULT 0,
+    PRIMARY KEY (run_id, url)
+);
+
+CREATE TABLE IF NOT EXISTS timings (
+    run_id TEXT,
+    url TEXT,
+    name TEXT,
+    value REAL DEFAULT 0,
+    PRIMARY KEY (run_id, url, name)
+);
+
+CREATE TABLE IF NOT EXISTS rollups (
+    run_id TEXT,
+    second INTEGER,
+    url TEXT,
+    agent_id TEXT,
+    hits INTEGER,
+    errors INTEGER,
+    histogram TEXT
+);
+CREATE INDEX IF NOT EXISTS rollups_url ON rollups (run_id, url, second);
+"""
+
+_ERRORS = ('addError', 'addFailure')
+
+
+class SQLiteDB(BaseDB):
+    """A DB that stores the data in a SQLite file.
+
+    The events are buffered, and inserted in a single transaction every
+    *sync_delay* milliseconds, or once *batch_size* events are waiting.
+    The run, data type, url, agent, second, status and latency of each
+    event have their own columns, and the group-by reads are done by
+    SQLite.
+
+    The reads go through a second connection: in the *wal* journal mode,
+    they don't wait for the inserts, and the file can be queried by other
+    processes while the broker writes in it.
+    """
+    name = 'sqlite'
+    options = {'path': (DEFAULT_PATH, 'Database file', str),
+               'journal_mode': ('wal', 'SQLite journal mode', str),
+               'sync_delay': (200, 'Sync delay', int),
+               'batch_size': (1000, 'Events inserted at once', int),
+               'read_size': (1000, 'Events read at once', int)}
+
+    def _initialize(self):
+        self.path = self.params['path']
+        self.journal_mode = self.params['journal_mode']
+        self.sync_delay = self.params['sync_delay']
+        self.batch_size = self.params['batch_size']
+        self.read_size = self.params['read_size']
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute('PRAGMA journal_mode = %s' % self.journal_mode)
+        self._conn.executescript(_SCHEMA)
+        # the reads are never part of a transaction
+        self._reader = sqlite3.connect(self.path, isolation_level=None)
+
+        self._reset()
+        self._callback = ioloop.PeriodicCallback(self.flush, self.sync_delay,
+                                                 self.loop)
+        self._callback.start()
+
+    def _reset(self):
+        # the events received since the last flush
+        self._events = []
+        self._counts = defaultdict(lambda: defaultdict(int))
+        self._urls = defaultdict(lambda: defaultdict(int))
+        self._timings = defaultdict(lambda: defaultdict(new_timings))
+        # the rollups are kept per run and agent
+        self._rollups = defaultdict(RollupStats)
+
+    def _query(self, sql, *args):
+        return self._reader.execute(sql, args)
+
+    def _stream(self, cursor):
+        while True:
+            rows = cursor.fetchmany(self.read_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    def ping(self):
+        try:
+            self._query('SELECT 1')
+            return True
+        except sqlite3.Error:
+            return False
+
+    #
+    # APIs
+    #
+    def save_metadata(self, run_id, metadata):
+        with self._conn:
+            self._conn.execute('INSERT OR IGNORE INTO runs (run_id) '
+                               'VALUES (?)', (run_id,))
+            self._conn.execute('UPDATE runs SET metadata = ? '
+                               'WHERE run_id = ?',
+                               (json.dumps(metadata), run_id))
+
+    def update_metadata(self, run_id, **metadata):
+        existing = self.get_metadata(run_id)
+        existing.update(metadata)
+        self.save_metadata(run_id, existing)
+
+    def get_metadata(self, run_id):
+        row = self._query('SELECT metadata FROM runs WHERE run_id = ?',
+                          run_id).fetchone()
+        if row is None or row[0] is None:
+            return {}
+        return json.loads(row[0])
+
+    def add(self, data):
+        data = dict(data)
+        run_id = data['run_id']
+        data_type = data['data_type'] = data.get('data_type', 'unknown')
+        now = int(time.time())
+
+        # adding the counters, with the rollups of each agent
+        add_counters(data, self._counts[run_id], self._urls[run_id],
+                     self._timings[run_id],
+                     self._rollups[run_id, data.get('agent_id')], now)
+
+        # adding data
+        try:
+            elapsed = get_seconds(data['elapsed'])
+        except (KeyError, TypeError, ValueError):
+            elapsed = None
+
+        # the keys are sorted so the same events get the same hash
+        dumped = json.dumps(data, sort_keys=True)
+        self._events.append((run_id, data_type, data.get('url'),
+                             data.get('agent_id'), now, data.get('status'),
+                             elapsed, hashlib.md5(dumped).hexdigest(),
+                             dumped))
+
+        if len(self._events) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Inserts the buffered events in a single transaction."""
+        if not self._events:
+            return
+
+        runs = set([event[0] for event in self._events])
+        counts = [(run_id, data_type, count)
+                  for run_id, counts_ in self._counts.items()
+                  for data_type, count in counts_.items()]
+        urls = [(run_id, url, hits)
+                for run_id, urls_ in self._urls.items()
+                for url, hits in urls_.items()]
+        timings = [(run_id, url, name, value)
+                   for run_id, urls_ in self._timings.items()
+                   for url, sums in urls_.items()
+                   for name, value in sums.items()]
+        rollups = [(run_id, rollup['second'], rollup['url'], agent_id,
+                    rollup['hits'], rollup['errors'],
+                    json.dumps(rollup['histogram']))
+                   for (run_id, agent_id), rollups_ in self._rollups.items()
+                   for rollup in rollups_.dump()]
+        events = self._events
+        self._reset()
+
+        with self._conn as conn:
+            conn.executemany('INSERT OR IGNORE INTO runs (run_id) '
+                             'VALUES (?)', [(run_id,) for run_id in runs])
+            conn.executemany('INSERT INTO events (run_id, data_type, url, '
+                             'agent_id, second, status, elapsed, hash, data) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', events)
+
+            conn.executemany('INSERT OR IGNORE INTO counts (run_id, '
+                             'data_type) VALUES (?, ?)',
+                             [count[:2] for count in counts])
+            conn.executemany('UPDATE counts SET count = count + ? '
+                             'WHERE run_id = ? AND data_type = ?',
+                             [(count[2],) + count[:2] for count in counts])
+
+            conn.executemany('INSERT OR IGNORE INTO urls (run_id, url) '
+                             'VALUES (?, ?)', [url[:2] for url in urls])
+            conn.executemany('UPDATE urls SET hits = hits + ? '
+                             'WHERE run_id = ? AND url = ?',
+                             [(url[2],) + url[:2] for url in urls])
+
+            conn.executemany('INSERT OR IGNORE INTO timings (run_id, url, '
+                             'name) VALUES (?, ?, ?)',
+                             [timing[:3] for timing in timings])
+            conn.executemany('UPDATE timings SET value = value + ? '
+                             'WHERE run_id = ? AND url = ? AND name = ?',
+                             [(timing[3],) + timing[:3]
+                              for timing in timings])
+
+            # rollups, appended as they may come late for a given second
+            conn.executemany('INSERT INTO rollups VALUES '
+                             '(?, ?, ?, ?, ?, ?, ?)', rollups)
+
+    def close(self):
+        self._callback.stop()
+        self.flush()
+        self._reader.close()
+        self._conn.close()
+
+    def get_urls(self, run_id):
+        self.flush()
+        return dict(self._query('SELECT url, hits FROM urls '
+                                'WHERE run_id = ?', run_id))
+
+    def get_timings(self, run_id):
+        self.flush()
+        sums = defaultdict(dict)
+        for url, name, value in self._query('SELECT url, name, value '
+                                            'FROM timings WHERE run_id = ?',
+                                            run_id):
+            sums[url][name] = value
+
+        return dict([(url, average_timings(sums_))
+                     for url, sums_ in sums.items()])
+
+    def get_rollups(self, run_id, url=None, start=None, end=None, step=1,
+                    agent_id=None):
+        """Returns the rollups of the run, like the other DBs, or only the
+        ones of the hits of the given agent."""
+        self.flush()
+        sql = ['SELECT second, url, hits, errors, histogram FROM rollups '
+               'WHERE run_id = ?']
+        args = [run_id]
+        for column, operator, value in (('url', '=', url),
+                                        ('second', '>=', start),
+                                        ('second', '<=', end),
+                                        ('agent_id', '=', agent_id)):
+            if value is not None:
+                sql.append('AND %s %s ?' % (column, operator))
+                args.append(value)
+
+        rollups = RollupStats()
+        for second, url_, hits, errors, histogram in self._query(
+                ' '.join(sql), *args):
+            rollups.load({'second': second, 'url': url_, 'hits': hits,
+                          'errors': errors,
+                          'histogram': json.loads(histogram)})
+
+        return rollups.get(step=step)
+
+    def get_counts(self, run_id):
+        self.flush()
+        return dict(self._query('SELECT data_type, count FROM counts '
+                                'WHERE run_id = ?', run_id))
+
+    def get_runs(self):
+        self.flush()
+        return [run_id for run_id, in
+                self._query('SELECT run_id FROM runs ORDER BY rowid')]
+
+    def _window(self, sql, args, start=None, size=None):
+        # the paging of the events, in the order they were added
+        sql += ' ORDER BY id'
+        if start is not None or size is not None:
+            sql += ' LIMIT ? OFFSET ?'
+            args = args + [size is None and -1 or size, start or 0]
+        return sql, args
+
+    def get_errors(self, run_id, start=None, size=None):
+        self.flush()
+        sql, args = self._window('SELECT data FROM events WHERE run_id = ? '
+                                 'AND data_type IN (?, ?)',
+                                 [run_id] + list(_ERRORS), start, size)
+        for data, in self._stream(self._query(sql, *args)):
+            yield json.loads(data)
+
+    def get_data(self, run_id, data_type=None, groupby=False, start=None,
+                 size=None):
+        self.flush()
+        sql = 'SELECT id, data, hash FROM events WHERE run_id = ?'
+        args = [run_id]
+        if data_type is not None:
+            sql += ' AND data_type = ?'
+            args.append(data_type)
+        sql, args = self._window(sql, args, start, size)
+
+        if not groupby:
+            for id, data, hash in self._stream(self._query(sql, *args)):
+                yield json.loads(data)
+        else:
+            sql = ('SELECT data, COUNT(*) FROM (%s) GROUP BY hash '
+                   'ORDER BY MIN(id)' % sql)
+            for data, count in self._stream(self._query(sql, *args)):
+                data = json.loads(data)
+                data['count'] = count
+                yield data
+
+    def prepare_run(self):
+        pass
+
+    def is_summarized(self, run_id):
+        row = self._query('SELECT summarized FROM runs WHERE run_id = ?',
+                          run_id).fetchone()
+        return row is not None and bool(row[0])
+
+    def summarize_run(self, run_id):
+        # the events are removed, the counters and rollups are kept.
+        self.flush()
+        with self._conn as conn:
+            conn.execute('DELETE FROM events WHERE run_id = ?', (run_id,))
+            conn.execute('UPDATE runs SET summarized = 1 WHERE run_id = ?',
+                         (run_id,))
+
+    def delete_run(self, run_id):
+        self.flush()
+        with self._conn as conn:
+            for table in ('runs', 'events', 'counts', 'urls', 'timings',
+                          'rollups'):
+                conn.execute('DELETE FROM %s WHERE run_id = ?' % table,
+                             (run_id,))
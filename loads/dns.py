@@ -0,0 +1,141 @@
+""" DNS resolver cache used by the sessions (see loads.measure).
+
+The addresses of a host are resolved once, then kept for *ttl* seconds. Once
+they expired, the next lookup still gets them while a greenlet resolves the
+host again in the background, so the users never wait for the DNS after the
+first request. The failed resolutions are cached too, for *negative_ttl*
+seconds.
+
+When a host has several addresses, each lookup picks one of them according
+to the policy:
+
+- **round-robin**: each address in turn.
+- **least-loaded**: the address with the fewest requests in progress. The
+  sessions release the address once the request is done.
+- **random**: an address at random.
+"""
+import os
+import random
+import socket
+import time
+
+import gevent
+
+from loads.util import gevent_socket, logger
+
+
+DEFAULT_TTL = 60.
+DEFAULT_NEGATIVE_TTL = 5.
+POLICIES = ('round-robin', 'least-loaded', 'random')
+
+
+class _Entry(object):
+    """The cached resolution of a host."""
+    __slots__ = ('addresses', 'error', 'expires', 'refreshing', 'next')
+
+    def __init__(self):
+        self.addresses = None
+        self.error = None
+        self.expires = 0
+        self.refreshing = None
+        self.next = 0
+
+
+def _lookup(host):
+    try:
+        return gevent_socket.gethostbyname_ex(host)[2]
+    except AttributeError:
+        # gethostbyname_ex was introduced by gevent 1.0,
+        # fallback on gethostbyname instead.
+        logger.info('gevent.socket.gethostbyname_ex is not present, '
+                    'Falling-back on gevent.socket.gethostbyname')
+        return [gevent_socket.gethostbyname(host)]
+
+
+class Resolver(object):
+    """Resolves the hosts and caches their addresses."""
+
+    def __init__(self, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL,
+                 policy='round-robin'):
+        if policy not in POLICIES:
+            raise ValueError('Unknown DNS policy %r' % policy)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.policy = policy
+        self._entries = {}
+        # the number of requests in progress on each address
+        self._load = {}
+
+    def _resolve(self, host, entry):
+        try:
+            addresses = _lookup(host)
+        except socket.error as e:
+            # the addresses we had, if any, are still used meanwhile.
+            entry.error = e
+            entry.expires = time.time() + self.negative_ttl
+        else:
+            entry.addresses = addresses
+            entry.error = None
+            entry.expires = time.time() + self.ttl
+        finally:
+            entry.refreshing = None
+
+    def _get_entry(self, host):
+        entry = self._entries.get(host)
+        if entry is None:
+            entry = self._entries[host] = _Entry()
+
+        if entry.expires <= time.time() and entry.refreshing is None:
+            entry.refreshing = gevent.spawn(self._resolve, host, entry)
+
+        if entry.addresses is None:
+            # there's nothing to use until the host is resolved.
+            if entry.refreshing is not None:
+                entry.refreshing.join()
+            if entry.addresses is None:
+                raise entry.error
+        return entry
+
+    def resolve(self, host):
+        """Returns the address to use for the host."""
+        entry = self._get_entry(host)
+        addresses = entry.addresses
+
+        if len(addresses) == 1:
+            address = addresses[0]
+        elif self.policy == 'round-robin':
+            address = addresses[entry.next % len(addresses)]
+            entry.next += 1
+        elif self.policy == 'least-loaded':
+            address = min(addresses,
+                          key=lambda address: self._load.get(address, 0))
+        else:
+            address = random.choice(addresses)
+
+        self._load[address] = self._load.get(address, 0) + 1
+        return address
+
+    def release(self, address):
+        """Tells that the request sent to the address is done."""
+        load = self._load.get(address)
+        if load:
+            self._load[address] = load - 1
+
+    def clear(self):
+        self._entries.clear()
+        self._load.clear()
+
+
+# the resolvers shared by the users of a process, by settings.
+_resolvers = {}
+
+
+def get_resolver(ttl=None, policy=None):
+    """Returns the resolver shared by the users of the process."""
+    if ttl is None:
+        ttl = DEFAULT_TTL
+    key = os.getpid(), ttl, policy or 'round-robin'
+    resolver = _resolvers.get(key)
+    if resolver is None:
+        resolver = _resolvers[key] = Resolver(ttl, policy=key[2])
+    return resolver
@@ -7,6 +7,8 @@ from datetime import datetime
 from konfig import Config
 
 from loads import __version__
+from loads.dns import DEFAULT_TTL, POLICIES as DNS_POLICIES
+from loads.measure import CONNECTION_POOLS
 from loads.output import output_list
 from loads.runners import (LocalRunner, DistributedRunner, ExternalRunner,
                            RUNNERS)
@@ -133,6 +135,40 @@ def _parse(sysargs=None):
     parser.add_argument('-u', '--users', help='Number of virtual users',
                         type=str, default='1')
 
+    parser.add_argument('--ramp-up', type=float, default=None,
+                        help='Number of seconds over which the users of '
+                             'each cycle are started.')
+
+    parser.add_argument('--ramp-down', type=float, default=None,
+                        help='Number of seconds over which the users of '
+                             'each cycle are stopped, at the end of the '
+                             'duration. The next cycle starts with it.')
+
+    parser.add_argument('--ramp-profile', type=str, default='linear',
+                        help='How the users are started and stopped: '
+                             '"linear", "exponential" or the path of a '
+                             'file of "time users" fractions.')
+
+    parser.add_argument('--rate', type=str, default=None,
+                        help='Number of tests launched per second, whatever '
+                             'the time they take. The users are the maximum '
+                             'number of tests running at the same time.')
+
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of processes the users are split '
+                             'across, to use several cores.')
+
+    parser.add_argument('--connection-pool', default='user',
+                        choices=CONNECTION_POOLS,
+                        help='Whether the HTTP connections are kept per '
+                             '"user", shared by the users of a "process", '
+                             'or shared and capped per "host".')
+
+    parser.add_argument('--pool-size', type=int, default=None,
+                        help='Maximum number of HTTP connections kept per '
+                             'host. With "--connection-pool host", the users '
+                             'wait for a free one.')
+
     parser.add_argument('--test-dir', help='Directory to run the test from',
                         type=str, default=None)
 
@@ -192,6 +228,14 @@ def _parse(sysargs=None):
     parser.add_argument('--project-name', help='Project name.',
                         default='N/A')
 
+    parser.add_argument('--aggregate-hits', action='store_true',
+                        default=False,
+                        help='Only keep streaming statistics about the hits '
+                             'instead of every hit. Uses a bounded amount '
+                             'of memory, but the quantiles are approximated. '
+                             'The agents also send summaries instead of '
+                             'every event.')
+
     #
     # distributed options
     #
@@ -206,6 +250,32 @@ def _parse(sysargs=None):
                         help='ZMQ socket where the test results messages '
                              'are published.')
 
+    parser.add_argument('--zmq-encoding', default=None,
+                        choices=('json', 'binary'),
+                        help='Encoding of the events sent by the agents. '
+                             'Defaults to the most compact encoding the '
+                             'broker supports.')
+
+    parser.add_argument('--zmq-overload', default='block',
+                        choices=('block', 'drop', 'sample'),
+                        help='What to do with the events when the broker '
+                             'can\'t keep up with them.')
+
+    parser.add_argument('--zmq-spill-size', default=10000, type=int,
+                        help='Number of events kept when the broker '
+                             'can\'t keep up, before dropping them.')
+
+    parser.add_argument('--zmq-sample-rate', default=10, type=int,
+                        help='With the sample overload policy, one event '
+                             'out of this number replaces the oldest one '
+                             'once the spill queue is full.')
+
+    parser.add_argument('--shared-memory', action='store_true',
+                        default=False,
+                        help='Collect the results of the local worker '
+                             'processes through shared memory instead of '
+                             'ZMQ.')
+
     parser.add_argument('--ping-broker', action='store_true', default=False,
                         help='Pings the broker to get info, display it and '
                              'exits.')
@@ -244,6 +314,15 @@ def _parse(sysargs=None):
     parser.add_argument('--no-dns-resolve', help='Do not resolve the domain.',
                         action='store_true', default=False)
 
+    parser.add_argument('--dns-ttl', type=float, default=DEFAULT_TTL,
+                        help='Number of seconds the resolved addresses of '
+                             'the hosts are kept.')
+
+    parser.add_argument('--dns-policy', default='round-robin',
+                        choices=DNS_POLICIES,
+                        help='How the address is chosen when a host has '
+                             'several.')
+
     # Adds the per-output and per-runner options.
     add_options(RUNNERS, parser, fmt='--{name}-{option}')
     add_options(output_list(), parser, fmt='--output-{name}-{option}')
@@ -328,6 +407,15 @@ def main(sysargs=None):
                 print('We have %d run(s) right now:' % len(runs))
                 for run_id, agents in runs.items():
                     print('  - %s with %d agent(s)' % (run_id, len(agents)))
+
+            metrics = ping.get('metrics')
+            if metrics and 'flush_duration' in metrics:
+                print('database: %d writes, %d records waiting' %
+                      (metrics['writes'], metrics['pending']))
+                for name in ('flush_duration', 'ingest_latency'):
+                    print('  - %s: %.3fs on average, %.3fs max' %
+                          (name, metrics[name]['average'],
+                           metrics[name]['max']))
             sys.exit(0)
 
         elif args.check_cluster:
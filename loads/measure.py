@@ -1,15 +1,27 @@
 import datetime
+import time
 import urlparse
 import os
 
+from gevent import getcurrent
+from requests.adapters import HTTPAdapter as _HTTPAdapter
+from requests.packages.urllib3.connection import (HTTPConnection,
+                                                  HTTPSConnection)
+from requests.packages.urllib3.connectionpool import (HTTPConnectionPool,
+                                                      HTTPSConnectionPool)
 from requests.sessions import Session as _Session
 from webtest.app import TestApp as _TestApp
 from wsgiproxy.proxies import HostProxy as _HostProxy
 from wsgiproxy.requests_client import HttpClient
 
+from loads.dns import get_resolver
 from loads.util import dns_resolve
 
 
+MAX_CON = 1000
+CONNECTION_POOLS = ('user', 'process', 'host')
+
+
 class TestApp(_TestApp):
     """A subclass of webtest.TestApp which uses the requests backend per
     default.
@@ -59,27 +71,193 @@ class HostProxy(_HostProxy):
         return self.uri
 
 
+# the measures of the request each greenlet is sending, if any (see
+# HTTPAdapter.send): the connections only know the greenlet using them.
+_measures = {}
+
+
+class _TimedConnection(object):
+    """Counts the connections opened for the request being sent, and times
+    the TCP connection, which includes the DNS resolution when the host was
+    not resolved by the session."""
+    loads_connect = 0
+
+    def _measure(self, name, value):
+        measures = _measures.get(getcurrent())
+        if measures is not None:
+            measures[name] += value
+
+    def _new_conn(self):
+        start = time.time()
+        conn = super(_TimedConnection, self)._new_conn()
+        self.loads_connect = time.time() - start
+        self._measure('connect', self.loads_connect)
+        return conn
+
+    def connect(self):
+        super(_TimedConnection, self).connect()
+        self._measure('opened', 1)
+
+
+class _HTTPConnection(_TimedConnection, HTTPConnection):
+    pass
+
+
+class _HTTPSConnection(_TimedConnection, HTTPSConnection):
+
+    def connect(self):
+        start = time.time()
+        super(_HTTPSConnection, self).connect()
+        # the TLS handshake comes after the TCP connection.
+        self._measure('tls', max(time.time() - start - self.loads_connect, 0))
+
+
+class _HTTPPool(HTTPConnectionPool):
+    ConnectionCls = _HTTPConnection
+
+
+class _HTTPSPool(HTTPSConnectionPool):
+    ConnectionCls = _HTTPSConnection
+
+
+def _headers_size(headers):
+    # each header is followed by CRLF, and so are the headers.
+    return sum([len(name) + len(value) + 4
+                for name, value in headers.items()]) + 2
+
+
+def _request_size(request):
+    # "METHOD path HTTP/1.1\r\n"
+    size = len(request.method) + len(request.path_url) + 12
+    size += _headers_size(request.headers)
+    if isinstance(request.body, basestring):
+        size += len(request.body)
+    elif request.body is not None:
+        size += int(request.headers.get('Content-Length', 0))
+    return size
+
+
+class HTTPAdapter(_HTTPAdapter):
+    """Extends Requests' HTTPAdapter to count the connections opened to send
+    a request: the *opened* attribute of the responses is 0 when they were
+    received on a reused connection. The connections opened through a proxy
+    are not counted.
+
+    The *timings* attribute of the responses has the duration, in seconds, of
+    the phases of the request:
+
+    - **connect**: the TCP connection, when one was opened.
+    - **tls**: the TLS handshake of the new HTTPS connections.
+    - **ttfb**: from the request being sent to the first byte of the
+      response.
+    - **download**: the reading of the body, unless the response is
+      streamed.
+
+    The *sent* and *received* attributes are the sizes of the request and of
+    the response, headers included. The body of the response is counted as
+    received from the server, before decompression.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        _HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _HTTPPool,
+                                                   'https': _HTTPSPool}
+
+    def send(self, request, stream=False, **kwargs):
+        key = getcurrent()
+        _measures[key] = measures = {'opened': 0, 'connect': 0, 'tls': 0}
+        start = time.time()
+        try:
+            response = _HTTPAdapter.send(self, request, stream=stream,
+                                         **kwargs)
+        finally:
+            del _measures[key]
+        headers = time.time()
+
+        response.opened = measures['opened']
+        connect, tls = measures['connect'], measures['tls']
+
+        if not stream:
+            # the session would read it right after.
+            response.content
+
+        response.timings = {'connect': connect, 'tls': tls,
+                            'ttfb': max(headers - start - connect - tls, 0),
+                            'download': time.time() - headers}
+        response.sent = _request_size(request)
+        response.received = (len(response.reason or '') + 15 +
+                             _headers_size(response.raw.headers) +
+                             response.raw.tell())
+        return response
+
+
+# the adapters shared by all the users of a process, by policy and size.
+_shared_adapters = {}
+
+
+def get_adapter(policy='user', pool_size=None):
+    """Returns the adapter a user mounts in its session, for the given
+    connection pool policy:
+
+    - **user**: each user gets its own adapter, so its own connections.
+    - **process**: all the users of the process share the connections.
+    - **host**: like *process*, but there are at most *pool_size*
+      connections per host. The users wait for a free one if needed.
+    """
+    if policy not in CONNECTION_POOLS:
+        raise ValueError('Unknown connection pool policy %r' % policy)
+
+    if policy == 'host':
+        kwargs = {'pool_connections': MAX_CON,
+                  'pool_maxsize': pool_size or MAX_CON, 'pool_block': True}
+    else:
+        kwargs = {'pool_connections': MAX_CON,
+                  'pool_maxsize': pool_size or MAX_CON}
+
+    if policy == 'user':
+        return HTTPAdapter(**kwargs)
+
+    # the connections of the parent can't be used by its forked children.
+    key = os.getpid(), policy, pool_size
+    adapter = _shared_adapters.get(key)
+    if adapter is None:
+        adapter = _shared_adapters[key] = HTTPAdapter(**kwargs)
+    return adapter
+
+
 class Session(_Session):
     """Extends Requests' Session object in order to send information to the
     test_result.
     """
 
-    def __init__(self, test, test_result, dns_resolve=True):
+    def __init__(self, test, test_result, dns_resolve=True, resolver=None):
         _Session.__init__(self)
         self.verify = not os.getenv('BYPASS_SSL_CHECK')
         self.test = test
         self.test_result = test_result
         self.loads_status = None, None, None, None
         self.dns_resolve = dns_resolve
+        self.resolver = resolver or get_resolver()
+        # how late the test was launched, when launched at a given rate.
+        self.lag = None
+        self._dns = 0
 
     def request(self, method, url, headers=None, **kwargs):
-        if not url.startswith('https://') and self.dns_resolve:
-            url, original, resolved = dns_resolve(url)
-            if headers is None:
-                headers = {}
-            headers['Host'] = original
-        return super(Session, self).request(
-            method, url, headers=headers, **kwargs)
+        if url.startswith('https://') or not self.dns_resolve:
+            return super(Session, self).request(
+                method, url, headers=headers, **kwargs)
+
+        start = time.time()
+        url, original, resolved = dns_resolve(url, self.resolver)
+        self._dns = time.time() - start
+        if headers is None:
+            headers = {}
+        headers['Host'] = original
+        try:
+            return super(Session, self).request(
+                method, url, headers=headers, **kwargs)
+        finally:
+            self.resolver.release(resolved)
 
     def send(self, request, **kwargs):
         """Do the actual request from within the session, doing some
@@ -87,9 +265,13 @@ class Session(_Session):
         """
         # attach some information to the request object for later use.
         start = datetime.datetime.utcnow()
+        # the redirections are sent without going through *request*.
+        dns, self._dns = self._dns, 0
         res = _Session.send(self, request, **kwargs)
         res.started = start
         res.method = request.method
+        if getattr(res, 'timings', None) is not None:
+            res.timings['dns'] = dns
         self._analyse_request(res)
         return res
 
@@ -100,9 +282,19 @@ class Session(_Session):
         :param req: the request to analyse.
         """
         if self.test_result is not None:
-            self.test_result.add_hit(elapsed=req.elapsed,
-                                     started=req.started,
-                                     status=req.status_code,
-                                     url=req.url,
-                                     method=req.method,
-                                     loads_status=self.loads_status)
+            for __ in range(getattr(req, 'opened', 0)):
+                self.test_result.connection_open()
+
+            hit = dict(elapsed=req.elapsed,
+                       started=req.started,
+                       status=req.status_code,
+                       url=req.url,
+                       method=req.method,
+                       loads_status=self.loads_status)
+            if self.lag is not None:
+                hit['lag'] = self.lag
+            if getattr(req, 'timings', None) is not None:
+                hit['timings'] = req.timings
+                hit['sent'] = req.sent
+                hit['received'] = req.received
+            self.test_result.add_hit(**hit)
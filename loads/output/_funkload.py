@@ -141,7 +141,7 @@ class FunkloadOutput(object):
         Adds the new XML node to the list of nodes for this output.
 
         """
-        hit, user, current_hit, current_user = loads_status
+        hit, user, current_hit, current_user = loads_status[:4]
 
         self.nodes.append(_RESPONSE.format(
             cycle=self.cycle_ids[user],
@@ -184,7 +184,7 @@ class FunkloadOutput(object):
         Adds new XML nodes to the list of nodes for this output.
 
         """
-        hit, user, current_hit, current_user = loads_status
+        hit, user, current_hit, current_user = loads_status[:4]
         t = self._get_test(test, loads_status, agent_id)
         t.end = datetime.utcnow()
         try:
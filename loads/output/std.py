@@ -4,6 +4,7 @@ import traceback
 from collections import defaultdict
 
 from loads.results import ZMQTestResult
+from loads.results.aggregate import TIMING_PHASES
 
 
 def get_terminal_width(fd=1):
@@ -48,12 +49,29 @@ class StdOutput(object):
               self.results.requests_per_second())
         write("\nAverage request time: %.2fs" %
               self.results.average_request_time())
+        phases = self.results.phases
+        if phases:
+            write("\nAverage request time by ramp phase: %s" % ', '.join([
+                '%s %.2fs' % (phase,
+                              self.results.average_request_time(phase=phase))
+                for phase in ('up', 'steady', 'down') if phase in phases]))
+        if self.results.opened_connections:
+            write("\nOpened HTTP connections: %d (%d hits reused one)" %
+                  (self.results.opened_connections,
+                   self.results.reused_connections))
         write("\nOpened web sockets: %d" % self.results.opened_sockets)
         write("\nBytes received via web sockets : %d\n" %
               self.results.socket_data_received)
         write("\nSuccess: %d" % self.results.nb_success)
         write("\nErrors: %d" % self.results.nb_errors)
         write("\nFailures: %d" % self.results.nb_failures)
+        if self.results.relay_dropped or self.results.relay_delayed:
+            write("\nEvents dropped by the relays: %d (%d delayed)" %
+                  (self.results.relay_dropped, self.results.relay_delayed))
+        if self.results.nb_lags:
+            write("\nAverage launch lag: %.2fs" % self.results.average_lag())
+            write("\nCorrected average request time: %.2fs" %
+                  self.results.average_corrected_request_time())
         write("\n\n")
 
         if self.results.nb_errors:
@@ -95,6 +113,14 @@ class StdOutput(object):
                                            value))
                 write('%s' % '\t'.join(res))
 
+            self._print_timings([url for url, metric in metrics])
+
+            addresses = self.results.get_address_counts()
+            if len(addresses) > 1:
+                write("\n\nHits by address:")
+                for address, count in sorted(addresses.items()):
+                    write("\n- %s: %d" % (address, count))
+
         write('\n')
         counters = self.results.get_counters()
         if len(counters) > 0:
@@ -107,6 +133,26 @@ class StdOutput(object):
         sys.stdout.flush()
         sys.stderr.flush()
 
+    def _print_timings(self, urls):
+        # by number of users, to show which phase of the requests degrades
+        # first when the load increases.
+        users = self.results.timed_users
+        if not users:
+            return
+
+        write = sys.stdout.write
+        write("\n\nRequest phases by URLs and users:")
+        for url in urls:
+            for count in users:
+                timings = self.results.get_timings(url, count)
+                if not timings:
+                    continue
+                phases = ', '.join(['%s %.3fs' % (phase, timings[phase])
+                                    for phase in TIMING_PHASES])
+                write("\n- %s\t%s users: %s\t%d bytes sent, %d received" %
+                      (url, count, phases, timings['sent'],
+                       timings['received']))
+
     def _print_tb(self, data):
         # 3 most commons
         errors = defaultdict(int)
@@ -0,0 +1,618 @@
+import math
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from loads.util import total_seconds
+
+
+# latencies under a microsecond all land in the "zero" bucket.
+MIN_LATENCY = 1e-6
+DEFAULT_PRECISION = 0.01
+
+# the phases of a request, in order (see loads.measure), and the sizes, in
+# bytes, of the request and the response.
+TIMING_PHASES = ('dns', 'connect', 'tls', 'ttfb', 'download')
+TIMING_SIZES = ('sent', 'received')
+
+
+def get_seconds(elapsed):
+    """Returns the elapsed time in seconds, whatever its representation."""
+    if isinstance(elapsed, timedelta):
+        return total_seconds(elapsed)
+    return float(elapsed)
+
+
+class LatencyHistogram(object):
+    """Log-bucketed histogram of latencies (in seconds).
+
+    Each bucket covers a range of values growing geometrically, so the memory
+    used only depends on the spread of the latencies and not on the number of
+    values added. Quantiles are computed in O(buckets) and are accurate to
+    within the given relative :param precision:.
+
+    The smallest and biggest values are kept as-is, so the 0 and 1 quantiles
+    are exact.
+    """
+    def __init__(self, precision=DEFAULT_PRECISION):
+        self.precision = precision
+        self._log_base = math.log(1 + 2 * precision)
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        if value < MIN_LATENCY:
+            return 0
+        return int(math.log(value / MIN_LATENCY) / self._log_base) + 1
+
+    def _value(self, index):
+        if index == 0:
+            return 0.
+        return MIN_LATENCY * math.exp((index - .5) * self._log_base)
+
+    def add(self, value, count=1):
+        self.buckets[self._index(value)] += count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Adds the values of another histogram to this one."""
+        if other.count == 0:
+            return
+        if other.precision != self.precision:
+            for index, count in other.buckets.items():
+                self.buckets[self._index(other._value(index))] += count
+        else:
+            for index, count in other.buckets.items():
+                self.buckets[index] += count
+        self.count += other.count
+        self.total += other.total
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+
+    @property
+    def average(self):
+        if self.count == 0:
+            return 0
+        return self.total / self.count
+
+    def get_quantiles(self, quantiles):
+        """Returns the approximated values for the given quantiles."""
+        if self.count == 0:
+            return [None for q in quantiles]
+
+        buckets = sorted(self.buckets.items())
+        results = []
+
+        for q in quantiles:
+            if q <= 0:
+                results.append(self.min)
+                continue
+            if q >= 1:
+                results.append(self.max)
+                continue
+
+            rank = q * self.count
+            seen = 0
+            for index, count in buckets:
+                seen += count
+                if seen >= rank:
+                    break
+
+            value = self._value(index)
+            results.append(min(max(value, self.min), self.max))
+
+        return results
+
+    def to_dict(self):
+        return {'precision': self.precision,
+                'buckets': dict(self.buckets),
+                'count': self.count,
+                'total': self.total,
+                'min': self.min,
+                'max': self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data.get('precision', DEFAULT_PRECISION))
+        for index, count in data['buckets'].items():
+            # JSON turns the integer keys into strings.
+            histogram.buckets[int(index)] += count
+        histogram.count = data['count']
+        histogram.total = data['total']
+        histogram.min = data.get('min')
+        histogram.max = data.get('max')
+
+        # without them, the extreme values are the ones of their buckets.
+        if histogram.min is None and histogram.buckets:
+            histogram.min = histogram._value(min(histogram.buckets))
+        if histogram.max is None and histogram.buckets:
+            histogram.max = histogram._value(max(histogram.buckets))
+        return histogram
+
+
+class HitAggregate(object):
+    """Running aggregates for the hits sharing the same url and series."""
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        self.count = 0
+        self.success = 0
+        self.statuses = defaultdict(int)
+        self.histogram = LatencyHistogram(precision)
+
+    def add(self, status, elapsed, count=1):
+        self.count += count
+        if 200 <= status < 400:
+            self.success += count
+        self.statuses[status] += count
+        self.histogram.add(elapsed, count)
+
+    def merge(self, status, histogram):
+        """Adds the hits summarized in the given histogram."""
+        self.count += histogram.count
+        if 200 <= status < 400:
+            self.success += histogram.count
+        self.statuses[status] += histogram.count
+        self.histogram.merge(histogram)
+
+
+class HitStats(object):
+    """Keeps streaming statistics about the hits, per url, series and ramp
+    phase.
+
+    Memory is bounded by the number of distinct (url, series, phase), and
+    every query is done in O(urls * series * phases) whatever the number of
+    hits.
+    """
+    def __init__(self, precision=DEFAULT_PRECISION):
+        self.precision = precision
+        self._aggregates = {}
+        self.count = 0
+
+    def _get_aggregate(self, url, series, phase=None):
+        key = url, series, phase
+        aggregate = self._aggregates.get(key)
+        if aggregate is None:
+            aggregate = self._aggregates[key] = HitAggregate(self.precision)
+        return aggregate
+
+    def add(self, url, series, status, elapsed, phase=None):
+        self._get_aggregate(url, series, phase).add(status, elapsed)
+        self.count += 1
+
+    def merge(self, url, series, status, histogram, phase=None):
+        """Adds hits already summarized in a latency histogram."""
+        self._get_aggregate(url, series, phase).merge(status, histogram)
+        self.count += histogram.count
+
+    def _filter(self, url=None, series=None, phase=None):
+        for (url_, series_, phase_), aggregate in self._aggregates.items():
+            if url is not None and url_ != url:
+                continue
+            if series is not None and series_ != series:
+                continue
+            if phase is not None and phase_ != phase:
+                continue
+            yield aggregate
+
+    @property
+    def urls(self):
+        return set([url for url, series, phase in self._aggregates])
+
+    @property
+    def phases(self):
+        return set([phase for url, series, phase in self._aggregates
+                    if phase is not None])
+
+    def get_count(self, url=None, series=None, phase=None):
+        if url is None and series is None and phase is None:
+            return self.count
+        return sum([agg.count for agg in self._filter(url, series, phase)])
+
+    def average(self, url=None, series=None, phase=None):
+        count = total = 0
+        for aggregate in self._filter(url, series, phase):
+            count += aggregate.count
+            total += aggregate.histogram.total
+
+        if count:
+            return float(total) / count
+        return 0
+
+    def success_rate(self, url=None, series=None, phase=None):
+        count = success = 0
+        for aggregate in self._filter(url, series, phase):
+            count += aggregate.count
+            success += aggregate.success
+
+        if count:
+            return float(success) / count
+        return 0
+
+    def get_statuses(self, url=None, series=None, phase=None):
+        statuses = defaultdict(int)
+        for aggregate in self._filter(url, series, phase):
+            for status, count in aggregate.statuses.items():
+                statuses[status] += count
+        return statuses
+
+    def get_histogram(self, url=None, series=None, phase=None):
+        histogram = LatencyHistogram(self.precision)
+        for aggregate in self._filter(url, series, phase):
+            histogram.merge(aggregate.histogram)
+        return histogram
+
+    def get_quantiles(self, quantiles, url=None, series=None, phase=None):
+        histogram = self.get_histogram(url, series, phase)
+        if histogram.count == 0:
+            return []
+        return histogram.get_quantiles(quantiles)
+
+
+def new_timings():
+    """Returns empty sums of the phases and sizes of the hits."""
+    return dict([(name, 0) for name in ('count',) + TIMING_PHASES +
+                 TIMING_SIZES])
+
+
+def add_timings(sums, timings, sent=0, received=0):
+    """Adds the phases durations and the sizes of a hit to the sums."""
+    sums['count'] += 1
+    for phase in TIMING_PHASES:
+        sums[phase] += timings.get(phase) or 0
+    sums['sent'] += sent or 0
+    sums['received'] += received or 0
+
+
+def merge_timings(sums, other):
+    """Adds sums of phases and sizes to other sums."""
+    for name, value in other.items():
+        sums[name] = sums.get(name, 0) + value
+
+
+def average_timings(sums):
+    """Returns the average duration of each phase and the average sizes."""
+    count = sums.get('count')
+    if not count:
+        return {}
+    return dict([(name, float(sums.get(name, 0)) / count)
+                 for name in TIMING_PHASES + TIMING_SIZES])
+
+
+class TimingStats(object):
+    """Sums of the phases durations and sizes of the hits, per url and
+    number of users.
+
+    Comparing the averages of the cycles, which run with more and more
+    users, tells which phase of the requests degrades first under load.
+    """
+    def __init__(self):
+        self._sums = {}
+
+    def _get_sums(self, url, users):
+        key = url, users
+        sums = self._sums.get(key)
+        if sums is None:
+            sums = self._sums[key] = new_timings()
+        return sums
+
+    def add(self, url, users, timings, sent=0, received=0):
+        add_timings(self._get_sums(url, users), timings, sent, received)
+
+    def merge(self, url, users, sums):
+        merge_timings(self._get_sums(url, users), sums)
+
+    @property
+    def count(self):
+        return sum([sums['count'] for sums in self._sums.values()])
+
+    @property
+    def users(self):
+        return sorted(set([users for url, users in self._sums]))
+
+    def average(self, url=None, users=None):
+        total = new_timings()
+        for (url_, users_), sums in self._sums.items():
+            if url is not None and url_ != url:
+                continue
+            if users is not None and users_ != users:
+                continue
+            merge_timings(total, sums)
+        return average_timings(total)
+
+
+def is_error(status):
+    """Tells if the status of a hit is an error."""
+    return not isinstance(status, (int, long)) or status >= 400
+
+
+class RollupStats(object):
+    """Counts, errors and latency histograms of the hits, per second and url.
+
+    Reading them is enough to draw the requests rate, the error rate or the
+    latencies over time, whatever the length of the run.
+    """
+    def __init__(self, precision=DEFAULT_PRECISION):
+        self.precision = precision
+        self._rollups = {}
+
+    def __len__(self):
+        return len(self._rollups)
+
+    def merge(self, second, url, hits, errors, histogram):
+        key = second, url
+        rollup = self._rollups.get(key)
+        if rollup is None:
+            rollup = self._rollups[key] = [0, 0,
+                                           LatencyHistogram(self.precision)]
+        rollup[0] += hits
+        rollup[1] += errors
+        rollup[2].merge(histogram)
+
+    def add(self, second, data):
+        """Adds a hit, or a summary of hits (see EventsSummary), to the given
+        second. Returns False if it's not a hit."""
+        url = data.get('url')
+        try:
+            if data.get('data_type') == 'add_hits':
+                histogram = LatencyHistogram.from_dict(data['histogram'])
+            else:
+                histogram = LatencyHistogram(self.precision)
+                histogram.add(get_seconds(data['elapsed']))
+        except (KeyError, TypeError, ValueError):
+            return False
+
+        errors = is_error(data.get('status')) and histogram.count or 0
+        self.merge(second, url, histogram.count, errors, histogram)
+        return True
+
+    def load(self, rollup):
+        """Merges a rollup returned by *dump*."""
+        histogram = LatencyHistogram.from_dict(rollup['histogram'])
+        self.merge(rollup['second'], rollup['url'], rollup['hits'],
+                   rollup['errors'], histogram)
+
+    def dump(self):
+        """Returns the rollups as a list of mappings."""
+        return [{'second': second, 'url': url, 'hits': hits,
+                 'errors': errors, 'histogram': histogram.to_dict()}
+                for (second, url), (hits, errors, histogram)
+                in sorted(self._rollups.items())]
+
+    def clear(self):
+        self._rollups.clear()
+
+    def get(self, url=None, start=None, end=None, step=1):
+        """Returns the rollups of the seconds between *start* and *end*,
+        grouped by *step* seconds.
+
+        Each rollup is a mapping with the *second* it starts at, its *url*,
+        its number of *hits* and *errors*, its *error_rate*, the *average*
+        latency and the latency *histogram*.
+        """
+        step = int(step)
+        grouped = RollupStats(self.precision)
+        for (second, url_), (hits, errors, histogram) in self._rollups.items():
+            if url is not None and url_ != url:
+                continue
+            if start is not None and second < start:
+                continue
+            if end is not None and second > end:
+                continue
+            grouped.merge(second - second % step, url_, hits, errors,
+                          histogram)
+
+        rollups = grouped.dump()
+        for rollup in rollups:
+            hits = rollup['hits']
+            rollup['error_rate'] = hits and float(rollup['errors']) / hits
+            rollup['average'] = hits and rollup['histogram']['total'] / hits
+        return rollups
+
+
+class EventsSummary(object):
+    """Folds the events of the runners into summaries.
+
+    The hits are folded into a latency histogram per url, method, status,
+    series, number of users and ramp phase, along with the sums of their
+    timings (see TimingStats) and, for the hits launched late at a given
+    rate, a histogram of their latencies corrected with the lag. The tests
+    that ended without an error or a failure are folded into counts per test
+    and series, the lags of the launches into a latency histogram, and the
+    HTTP connections opened into a count.
+
+    The events of a test are held until the test is stopped: the events of
+    the tests that got an error or a failure are sent as-is, so their details
+    are kept.
+    """
+    def __init__(self, precision=DEFAULT_PRECISION):
+        self.precision = precision
+        self._hits = {}
+        self._corrected = {}
+        self._timings = {}
+        self._tests = {}
+        self._running = {}
+        self._lags = LatencyHistogram(precision)
+        self._connections = 0
+
+    def add(self, data_type, data):
+        """Folds the event.
+
+        Returns the list of the events to send right away, as (data_type,
+        data) tuples.
+        """
+        if data_type == 'add_hit':
+            return self._add_hit(data)
+        elif data_type == 'add_lag':
+            try:
+                self._lags.add(get_seconds(data['lag']))
+            except (KeyError, TypeError, ValueError):
+                return [(data_type, data)]
+            return []
+        elif data_type == 'connection_open':
+            self._connections += 1
+            return []
+
+        loads_status = data.get('loads_status')
+        if 'test' not in data or loads_status is None:
+            return [(data_type, data)]
+
+        key = data['test'], tuple(loads_status)
+        running = self._running.get(key)
+
+        if data_type == 'startTest':
+            if running is not None:
+                # the test is run again, let's send what we got so far.
+                events = self._release(key)
+            else:
+                events = []
+            self._running[key] = {'events': [(data_type, data)],
+                                  'start': time.time(), 'success': 0,
+                                  'detailed': False}
+            return events
+
+        if running is None or running['detailed']:
+            if data_type == 'stopTest':
+                self._running.pop(key, None)
+            return [(data_type, data)]
+
+        if data_type == 'addSuccess':
+            running['success'] += 1
+            running['events'].append((data_type, data))
+            return []
+
+        if data_type == 'stopTest':
+            del self._running[key]
+            summary_key = data['test'], loads_status[0]
+            summary = self._tests.get(summary_key)
+            if summary is None:
+                summary = self._tests[summary_key] = [0, 0, 0.]
+            summary[0] += 1
+            summary[1] += running['success']
+            summary[2] += time.time() - running['start']
+            return []
+
+        if data_type in ('addError', 'addFailure'):
+            events = self._release(key)
+            events.append((data_type, data))
+            return events
+
+        # counters and such are not summarized.
+        return [(data_type, data)]
+
+    def _add_hit(self, data):
+        try:
+            elapsed = get_seconds(data['elapsed'])
+            loads_status = data.get('loads_status') or (None, None)
+            phase = loads_status[4] if len(loads_status) > 4 else None
+            key = (data['url'], data['method'], data['status'],
+                   loads_status[0], loads_status[1], phase)
+            lag = data.get('lag')
+            if lag is not None:
+                lag = get_seconds(lag)
+        except (KeyError, TypeError, ValueError):
+            return [('add_hit', data)]
+
+        histogram = self._hits.get(key)
+        if histogram is None:
+            histogram = self._hits[key] = LatencyHistogram(self.precision)
+        histogram.add(elapsed)
+
+        if lag is not None:
+            corrected = self._corrected.get(key)
+            if corrected is None:
+                corrected = self._corrected[key] = LatencyHistogram(
+                    self.precision)
+            corrected.add(elapsed + lag)
+
+        timings = data.get('timings')
+        if timings is not None:
+            sums = self._timings.get(key)
+            if sums is None:
+                sums = self._timings[key] = new_timings()
+            add_timings(sums, timings, data.get('sent'), data.get('received'))
+        return []
+
+    def _release(self, key):
+        # the next events of this test will be sent as-is.
+        running = self._running[key]
+        running['detailed'] = True
+        events, running['events'] = running['events'], []
+        return events
+
+    def flush(self, final=False):
+        """Returns the summaries of the events folded since the last flush,
+        as (data_type, data) tuples.
+
+        When *final* is True, the events of the tests that are still running
+        are returned as well.
+        """
+        events = []
+
+        for key, histogram in self._hits.items():
+            url, method, status, series, users, phase = key
+            hits = {'url': url, 'method': method, 'status': status,
+                    'series': series, 'users': users, 'phase': phase,
+                    'histogram': histogram.to_dict()}
+            if key in self._corrected:
+                hits['corrected'] = self._corrected[key].to_dict()
+            if key in self._timings:
+                hits['timings'] = self._timings[key]
+            events.append(('add_hits', hits))
+
+        for (test, series), (count, success, duration) in self._tests.items():
+            events.append(('add_tests', {'test': test, 'series': series,
+                                         'count': count, 'success': success,
+                                         'duration': duration}))
+
+        if self._lags.count:
+            events.append(('add_lags', {'histogram': self._lags.to_dict()}))
+            self._lags = LatencyHistogram(self.precision)
+
+        if self._connections:
+            events.append(('connection_open', {'count': self._connections}))
+            self._connections = 0
+
+        self._hits.clear()
+        self._corrected.clear()
+        self._timings.clear()
+        self._tests.clear()
+
+        if final:
+            for key in list(self._running):
+                events.extend(self._release(key))
+            self._running.clear()
+
+        return events
+
+
+def get_event_counts(data):
+    """Returns the number of events of each type a message stands for.
+
+    The summaries built by EventsSummary stand for several events, and the
+    stats of the relays are counted as the events they dropped or delayed.
+    """
+    data_type = data.get('data_type')
+    if data_type == 'add_hits':
+        return {'add_hit': data['histogram']['count']}
+    elif data_type == 'add_tests':
+        return {'startTest': data['count'], 'stopTest': data['count'],
+                'addSuccess': data['success']}
+    elif data_type == 'add_lags':
+        return {'add_lag': data['histogram']['count']}
+    elif data_type == 'connection_open':
+        return {'connection_open': data.get('count', 1)}
+    elif data_type == 'relay_stats':
+        return {'relay_stats': 1,
+                'relay_dropped': data.get('dropped', 0),
+                'relay_delayed': data.get('delayed', 0)}
+    return {data_type: 1}
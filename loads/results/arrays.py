@@ -0,0 +1,84 @@
+""" NumPy arrays of the hits.
+
+NumPy is only imported when the arrays are used (see loads.util.HAS_NUMPY).
+"""
+
+
+class GrowableArray(object):
+    """A NumPy array with an amortized O(1) append."""
+
+    def __init__(self, dtype, capacity=1024):
+        import numpy
+        self._data = numpy.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def append(self, value):
+        if self.size == len(self._data):
+            import numpy
+            self._data = numpy.resize(self._data, self.size * 2)
+        self._data[self.size] = value
+        self.size += 1
+
+    @property
+    def values(self):
+        return self._data[:self.size]
+
+
+class HitArrays(object):
+    """Stores the latencies, urls and series of the hits in NumPy arrays, so
+    they can be queried with vectorized operations.
+
+    The urls and series are stored as integer ids.
+    """
+    def __init__(self):
+        import numpy
+        self.elapsed = GrowableArray(numpy.float64)
+        self.url = GrowableArray(numpy.int32)
+        self.series = GrowableArray(numpy.int32)
+        self._url_ids = {}
+        self._series_ids = {}
+
+    def __len__(self):
+        return self.elapsed.size
+
+    def _get_id(self, ids, value):
+        id_ = ids.get(value)
+        if id_ is None:
+            id_ = ids[value] = len(ids)
+        return id_
+
+    def add(self, url, series, elapsed):
+        self.elapsed.append(elapsed)
+        self.url.append(self._get_id(self._url_ids, url))
+        self.series.append(self._get_id(self._series_ids, series))
+
+    def mask(self, url=None, series=None):
+        """Returns a boolean mask of the hits matching the filters, or None
+        if there are no filters.
+
+        Filtering on an unknown url or series matches nothing.
+        """
+        mask = None
+        for ids, values, value in ((self._url_ids, self.url, url),
+                                   (self._series_ids, self.series, series)):
+            if value is None:
+                continue
+            matching = values.values == ids.get(value, -1)
+            if mask is None:
+                mask = matching
+            else:
+                mask &= matching
+        return mask
+
+    def get_indexes(self, url=None, series=None):
+        import numpy
+        mask = self.mask(url, series)
+        if mask is None:
+            return numpy.arange(len(self))
+        return numpy.flatnonzero(mask)
+
+    def get_elapsed(self, url=None, series=None):
+        mask = self.mask(url, series)
+        if mask is None:
+            return self.elapsed.values
+        return self.elapsed.values[mask]
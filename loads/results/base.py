@@ -1,8 +1,36 @@
 import itertools
+import urlparse
 from collections import defaultdict
 
 from datetime import datetime, timedelta
-from loads.util import get_quantiles, total_seconds, seconds_to_time, unbatch
+from loads.util import (get_quantiles, total_seconds, seconds_to_time,
+                        unbatch, HAS_NUMPY)
+from loads.results.aggregate import (HitStats, LatencyHistogram, TimingStats,
+                                     get_seconds)
+from loads.results.arrays import HitArrays
+
+
+# The methods whose calls are pushed to the observers.
+OBSERVED_METHODS = ('startTestRun', 'stopTestRun', 'startTest', 'stopTest',
+                    'addError', 'addFailure', 'addSuccess', 'add_hit',
+                    'add_hits', 'add_tests', 'socket_open', 'socket_message',
+                    'connection_open', 'incr_counter')
+
+
+def _dispatcher(name, method, pushes):
+    """Returns a function calling the given method, then the observers."""
+    def dispatch(*args, **kwargs):
+        ret = method(*args, **kwargs)
+        for push in pushes:
+            push(name, *args, **kwargs)
+        return ret
+    return dispatch
+
+
+def _get_phase(loads_status):
+    """Returns the ramp phase of the loads_status, if any."""
+    if len(loads_status) > 4:
+        return loads_status[4]
 
 
 class TestResult(object):
@@ -14,6 +42,9 @@ class TestResult(object):
     Consumes the data passed to it and provide convenient APIs to read this
     data back. This can be useful if you want to transform this data to create
     reports, but it doesn't assume any representation for the output.
+
+    The hits update streaming statistics and, unless the *aggregate_hits*
+    option is set, are also kept in memory.
     """
 
     __test__ = False  # This is not something to run as a test.
@@ -21,13 +52,29 @@ class TestResult(object):
     def __init__(self, config=None, args=None):
         self.config = config
         self.hits = []
-        self.tests = {}
+        self.tests = TestsIndex()
         self.opened_sockets = self.closed_sockets = 0
         self.socket_data_received = 0
+        self.opened_connections = 0
+        self.relay_dropped = self.relay_delayed = 0
         self.start_time = None
         self.stop_time = None
         self.observers = []
+        self._observed = None
         self.args = args
+        self.aggregate_hits = bool(args and args.get('aggregate_hits'))
+        self._stats = HitStats()
+        self._summarized = False
+        self._lags = LatencyHistogram()
+        self._corrected = HitStats()
+        self._timings = TimingStats()
+        # the urls and methods are shared by many hits, so we keep a single
+        # instance of each string.
+        self._strings = {}
+        if HAS_NUMPY and not self.aggregate_hits:
+            self._arrays = HitArrays()
+        else:
+            self._arrays = None
 
     def __str__(self):
         duration = seconds_to_time(self.duration)
@@ -53,11 +100,11 @@ class TestResult(object):
 
     @property
     def nb_finished_tests(self):
-        return len(self._get_tests(finished=True))
+        return self.tests.nb_finished
 
     @property
     def nb_hits(self):
-        return len(self.hits)
+        return self._stats.count
 
     @property
     def duration(self):
@@ -69,38 +116,49 @@ class TestResult(object):
 
     @property
     def nb_failures(self):
-        return sum([len(t.failures) for t in self._get_tests()])
+        return self.tests.nb_failures
 
     @property
     def nb_errors(self):
-        return sum([len(t.errors) for t in self._get_tests()])
+        return self.tests.nb_errors
 
     @property
     def nb_success(self):
-        return sum([t.success for t in self._get_tests()])
+        return self.tests.nb_success
 
     @property
     def errors(self):
-        return itertools.chain((t.errors for t in (self._get_tests())))
+        return itertools.chain((t.errors for t in self.tests.with_errors()))
 
     @property
     def failures(self):
-        return itertools.chain((t.failures for t in (self._get_tests())))
+        return itertools.chain((t.failures
+                                for t in self.tests.with_failures()))
 
     @property
     def urls(self):
         """Returns the URLs that had been called."""
-        return set([h.url for h in self.hits])
+        return self._stats.urls
 
     @property
     def nb_tests(self):
-        return len(self.tests)
+        return self.tests.nb_tests
 
     @property
     def sockets(self):
         return self.opened_sockets - self.closed_sockets
 
-    def _get_hits(self, url=None, series=None):
+    @property
+    def reused_connections(self):
+        """The number of hits done on an already opened connection."""
+        return max(self.nb_hits - self.opened_connections, 0)
+
+    @property
+    def phases(self):
+        """Returns the ramp phases the hits were done in."""
+        return self._stats.phases
+
+    def _get_hits(self, url=None, series=None, phase=None):
         """Filters the hits with the given parameters.
 
         :param url:
@@ -109,7 +167,17 @@ class TestResult(object):
 
         :param series:
             Only the hits done during this series will be returned.
+
+        :param phase:
+            Only the hits done during this phase of the ramp will be returned.
         """
+        if self._has_arrays() and phase is None:
+            if url is None and series is None:
+                return list(self.hits)
+            hits = self.hits
+            return [hits[index]
+                    for index in self._arrays.get_indexes(url, series)]
+
         def _filter(_hit):
             if series is not None and _hit.series != series:
                 return False
@@ -117,6 +185,9 @@ class TestResult(object):
             if url is not None and _hit.url != url:
                 return False
 
+            if phase is not None and _hit.phase != phase:
+                return False
+
             return True
 
         return filter(_filter, self.hits)
@@ -136,18 +207,9 @@ class TestResult(object):
         :param user:
             The user key to filter on.
         """
-        def _filter(test):
-            if name is not None and test.name != name:
-                return False
-            if series is not None and test.series != series:
-                return False
-            if finished is not None and test.finished != finished:
-                return False
-            return True
-
-        return filter(_filter, self.tests.values())
+        return self.tests.filter(name, series, finished)
 
-    def average_request_time(self, url=None, series=None):
+    def average_request_time(self, url=None, series=None, phase=None):
         """Computes the average time a request takes (in seconds)
 
         :param url:
@@ -156,37 +218,96 @@ class TestResult(object):
         :param series:
             You can filter by the series, to only know the average request time
             during a particular series.
+        :param phase:
+            You can also filter by the phase of the ramp.
         """
-        elapsed = [total_seconds(h.elapsed)
-                   for h in self._get_hits(url, series)]
+        return self._stats.average(url, series, phase)
+
+    def get_request_time_quantiles(self, url=None, series=None, phase=None):
+        quantiles = (0, 0.1, 0.5, 0.9, 1)
+
+        if self.aggregate_hits or self._summarized:
+            # approximated, using the latency histograms.
+            return self._stats.get_quantiles(quantiles, url, series, phase)
 
-        if elapsed:
-            return float(sum(elapsed)) / len(elapsed)
+        if self._has_arrays() and phase is None:
+            elapsed = self._arrays.get_elapsed(url, series)
         else:
-            return 0
+            elapsed = [h.elapsed_seconds
+                       for h in self._get_hits(url, series, phase)]
+        return get_quantiles(elapsed, quantiles)
+
+    def average_corrected_request_time(self, url=None, series=None):
+        """Like average_request_time, but adds to each hit the lag of its
+        launch."""
+        return self._corrected.average(url, series)
+
+    def get_corrected_request_time_quantiles(self, url=None, series=None):
+        """Like get_request_time_quantiles, but adds to each hit the lag of
+        its launch. Approximated from the latency histograms."""
+        quantiles = (0, 0.1, 0.5, 0.9, 1)
+        return self._corrected.get_quantiles(quantiles, url, series)
+
+    def get_timings(self, url=None, users=None):
+        """Returns the average duration of each phase of the requests (dns,
+        connect, tls, ttfb and download), and the average bytes sent and
+        received, for the filtered hits that were timed.
+
+        :param users: only the hits done when running with this number of
+                      users are used.
+        """
+        return self._timings.average(url, users)
+
+    @property
+    def timed_users(self):
+        """Returns the numbers of users the timed hits were done with."""
+        return self._timings.users
 
-    def get_request_time_quantiles(self, url=None, series=None):
-        elapsed = [total_seconds(h.elapsed)
-                   for h in self._get_hits(url=url, series=series)]
+    @property
+    def nb_lags(self):
+        return self._lags.count
+
+    def average_lag(self):
+        """The average time the launches were late, in seconds."""
+        return self._lags.average
+
+    def get_lag_quantiles(self):
+        return self._lags.get_quantiles((0, 0.1, 0.5, 0.9, 1))
 
-        # XXX Cache these results, they might be long to compute.
-        return get_quantiles(elapsed, (0, 0.1, 0.5, 0.9, 1))
+    def _has_arrays(self):
+        # the arrays can't be used if the hits were changed directly.
+        return (self._arrays is not None and
+                len(self._arrays) == len(self.hits))
 
-    def hits_success_rate(self, url=None, series=None):
+    def hits_success_rate(self, url=None, series=None, phase=None):
         """Returns the success rate for the filtered hits.
 
         (A success is a hit with a status code of 2XX or 3XX).
 
         :param url: the url to filter on.
         :param hit: the hit to filter on.
+        :param phase: the phase of the ramp to filter on.
         """
-        hits = list(self._get_hits(url, series))
-        success = [h for h in hits if 200 <= h.status < 400]
+        return self._stats.success_rate(url, series, phase)
 
-        if hits:
-            return float(len(success)) / len(hits)
-        else:
-            return 0
+    def get_status_codes(self, url=None, series=None, phase=None):
+        """Returns a mapping of the status codes and how many hits got them.
+        """
+        return self._stats.get_statuses(url, series, phase)
+
+    def get_address_counts(self):
+        """Returns a mapping of the addresses the hits were sent to, and how
+        many hits each got.
+
+        The sessions replace the hosts of the urls by the addresses they
+        resolved to (see loads.dns), so this tells how the hits were spread
+        across the addresses of a host.
+        """
+        counts = defaultdict(int)
+        for url in self.urls:
+            counts[urlparse.urlparse(url).hostname] += self._stats.get_count(
+                url)
+        return counts
 
     def get_url_metrics(self):
         urls = defaultdict(dict)
@@ -202,19 +323,32 @@ class TestResult(object):
     def average_test_duration(self, test=None, series=None):
         durations = [t.duration for t in self._get_tests(test, series)
                      if t is not None]
-        if durations:
-            return float(sum(durations)) / len(durations)
+        count, total = len(durations), sum(durations)
+
+        for summary in self.tests.get_summaries(test, series):
+            count += summary.count
+            total += summary.duration
+
+        if count:
+            return float(total) / count
 
     def test_success_rate(self, test=None, series=None):
         rates = [t.success_rate for t in self._get_tests(test, series)]
-        if rates:
-            return sum(rates) / len(rates)
+        count, total = len(rates), sum(rates)
+
+        # the summarized tests had no errors nor failures.
+        for summary in self.tests.get_summaries(test, series):
+            count += summary.count
+            total += summary.count
+
+        if count:
+            return float(total) / count
         return 1
 
     def requests_per_second(self, url=None, hit=None):
         if self.duration == 0:
             return 0
-        return float(len(self.hits)) / self.duration
+        return float(self.nb_hits) / self.duration
 
     # batched results
     def batch(self, **args):
@@ -236,27 +370,33 @@ class TestResult(object):
             self.stop_time = datetime.utcnow()
 
     def startTest(self, test, loads_status, agent_id=None):
-        hit, user, current_hit, current_user = loads_status
+        hit, user, current_hit, current_user = loads_status[:4]
         key = self._get_key(test, loads_status, agent_id)
         if key not in self.tests:
-            self.tests[key] = Test(name=test, hit=hit, user=user)
+            self.tests[key] = Test(name=test, hit=hit, user=user,
+                                   series=hit, phase=_get_phase(loads_status))
 
     def stopTest(self, test, loads_status, agent_id=None):
-        hit, user, current_hit, current_user = loads_status
         t = self._get_test(test, loads_status, agent_id)
         t.end = datetime.utcnow()
+        self.tests.set_finished(self._get_key(test, loads_status, agent_id))
 
     def addError(self, test, exc_info, loads_status, agent_id=None):
+        key = self._get_key(test, loads_status, agent_id)
         test = self._get_test(test, loads_status, agent_id)
         test.errors.append(exc_info)
+        self.tests.add_error(key)
 
     def addFailure(self, test, exc_info, loads_status, agent_id=None):
+        key = self._get_key(test, loads_status, agent_id)
         test = self._get_test(test, loads_status, agent_id)
         test.failures.append(exc_info)
+        self.tests.add_failure(key)
 
     def addSuccess(self, test, loads_status, agent_id=None):
         test = self._get_test(test, loads_status, agent_id)
         test.success += 1
+        self.tests.nb_success += 1
 
     def incr_counter(self, test, loads_status, name, agent_id=None):
         test = self._get_test(test, loads_status, agent_id)
@@ -273,7 +413,72 @@ class TestResult(object):
         return counters
 
     def add_hit(self, **data):
-        self.hits.append(Hit(**data))
+        loads_status = data.get('loads_status') or (None,)
+        elapsed = get_seconds(data['elapsed'])
+        phase = _get_phase(loads_status)
+        self._stats.add(data['url'], loads_status[0], data['status'], elapsed,
+                        phase)
+
+        lag = data.get('lag')
+        if lag is not None:
+            self._corrected.add(data['url'], loads_status[0], data['status'],
+                                elapsed + lag, phase)
+
+        timings = data.get('timings')
+        if timings is not None:
+            users = loads_status[1] if len(loads_status) > 1 else None
+            self._timings.add(data['url'], users, timings, data.get('sent'),
+                              data.get('received'))
+
+        if not self.aggregate_hits:
+            data['url'] = self._strings.setdefault(data['url'], data['url'])
+            data['method'] = self._strings.setdefault(data['method'],
+                                                      data['method'])
+            self.hits.append(Hit(**data))
+            if self._arrays is not None:
+                self._arrays.add(data['url'], loads_status[0], elapsed)
+
+    def add_hits(self, url, method, status, series, histogram, users=None,
+                 timings=None, phase=None, corrected=None, agent_id=None):
+        """Adds hits summarized by an agent in a latency histogram, and the
+        sums of their timings.
+
+        *corrected* is the histogram of their latencies corrected with the
+        lag, when they were launched at a given rate.
+        """
+        self._stats.merge(url, series, status,
+                          LatencyHistogram.from_dict(histogram), phase)
+        if corrected is not None:
+            self._corrected.merge(url, series, status,
+                                  LatencyHistogram.from_dict(corrected), phase)
+        if timings is not None:
+            self._timings.merge(url, users, timings)
+        self._summarized = True
+
+    def add_tests(self, test, series, count, success, duration,
+                  agent_id=None):
+        """Adds tests summarized by an agent.
+
+        *count* tests were run and finished without errors nor failures,
+        in *duration* seconds overall.
+        """
+        self.tests.add_summary(test, series, count, success, duration)
+
+    def add_lag(self, lag, loads_status, agent_id=None):
+        """Records how late, in seconds, a test was launched compared to
+        the arrival rate."""
+        self._lags.add(get_seconds(lag))
+
+    def add_lags(self, histogram, agent_id=None):
+        """Adds the lags of the launches summarized by an agent in a latency
+        histogram."""
+        self._lags.merge(LatencyHistogram.from_dict(histogram))
+
+    def relay_stats(self, dropped=0, delayed=0, agent_id=None):
+        """Counts the events the relays had to drop or delay because the
+        receiver could not keep up."""
+        self.relay_dropped += dropped
+        self.relay_delayed += delayed
 
     def socket_open(self, agent_id=None):
         self.opened_sockets += 1
@@ -284,24 +489,29 @@ class TestResult(object):
     def socket_message(self, size, agent_id=None):
         self.socket_data_received += size
 
-    def __getattribute__(self, name):
-        # call the observer's "push" method after calling the method of the
-        # test_result itself.
-        attr = object.__getattribute__(self, name)
-        if name in ('startTestRun', 'stopTestRun', 'startTest', 'stopTest',
-                    'addError', 'addFailure', 'addSuccess', 'add_hit',
-                    'socket_open', 'socket_message', 'incr_counter'):
-
-            def wrapper(*args, **kwargs):
-                ret = attr(*args, **kwargs)
-                for obs in self.observers:
-                    obs.push(name, *args, **kwargs)
-                return ret
-            return wrapper
-        return attr
+    def connection_open(self, count=1, agent_id=None):
+        """Counts the HTTP connections opened: the other hits reused one."""
+        self.opened_connections += count
 
     def add_observer(self, observer):
+        """Registers an observer, which *push* method gets called after each
+        of the OBSERVED_METHODS.
+
+        The dispatchers are built here once, so there's no extra cost per call
+        when no observer is registered.
+        """
         self.observers.append(observer)
+        self._build_dispatchers()
+
+    def _build_dispatchers(self):
+        if self._observed is None:
+            self._observed = dict([(name, getattr(self, name))
+                                   for name in OBSERVED_METHODS])
+
+        pushes = tuple([observer.push for observer in self.observers])
+
+        for name, method in self._observed.items():
+            self.__dict__[name] = _dispatcher(name, method, pushes)
 
     def _get_key(self, test, loads_status, agent_id):
         return tuple((str(test),) + tuple(loads_status) + (agent_id,))
@@ -317,31 +527,184 @@ class TestResult(object):
         pass
 
 
+class TestsIndex(dict):
+    """The tests of a TestResult, indexed by name, series and state.
+
+    The counts of success, errors, failures and finished tests are maintained
+    as the tests are added and updated, and the filtered queries only look at
+    the matching tests.
+
+    The errors, failures and finished state must be updated through this
+    class so the indexes stay accurate.
+
+    The tests summarized by the agents are only kept as counts per name and
+    series.
+    """
+    def __init__(self):
+        super(TestsIndex, self).__init__()
+        self._by_name = defaultdict(set)
+        self._by_series = defaultdict(set)
+        self._finished = set()
+        self._running = set()
+        self._with_errors = set()
+        self._with_failures = set()
+        self._summaries = {}
+        self.nb_success = self.nb_errors = self.nb_failures = 0
+        self.nb_summarized = 0
+
+    def __setitem__(self, key, test):
+        if key in self:
+            del self[key]
+
+        super(TestsIndex, self).__setitem__(key, test)
+        self._by_name[test.name].add(key)
+        self._by_series[test.series].add(key)
+
+        if test.finished:
+            self._finished.add(key)
+        else:
+            self._running.add(key)
+        if test.errors:
+            self._with_errors.add(key)
+        if test.failures:
+            self._with_failures.add(key)
+
+        self.nb_success += test.success
+        self.nb_errors += len(test.errors)
+        self.nb_failures += len(test.failures)
+
+    def __delitem__(self, key):
+        test = self[key]
+        super(TestsIndex, self).__delitem__(key)
+
+        for index, value in ((self._by_name, test.name),
+                             (self._by_series, test.series)):
+            index[value].discard(key)
+            if not index[value]:
+                del index[value]
+
+        for keys in (self._finished, self._running, self._with_errors,
+                     self._with_failures):
+            keys.discard(key)
+
+        self.nb_success -= test.success
+        self.nb_errors -= len(test.errors)
+        self.nb_failures -= len(test.failures)
+
+    @property
+    def nb_tests(self):
+        return len(self) + self.nb_summarized
+
+    @property
+    def nb_finished(self):
+        return len(self._finished) + self.nb_summarized
+
+    def add_summary(self, name, series, count, success, duration):
+        key = name, series
+        summary = self._summaries.get(key)
+        if summary is None:
+            summary = self._summaries[key] = TestsSummary(name, series)
+        summary.count += count
+        summary.success += success
+        summary.duration += duration
+        self.nb_summarized += count
+        self.nb_success += success
+
+    def get_summaries(self, name=None, series=None):
+        return [summary for summary in self._summaries.values()
+                if (name is None or summary.name == name) and
+                (series is None or summary.series == series)]
+
+    def set_finished(self, key):
+        self._running.discard(key)
+        self._finished.add(key)
+
+    def add_error(self, key):
+        self._with_errors.add(key)
+        self.nb_errors += 1
+
+    def add_failure(self, key):
+        self._with_failures.add(key)
+        self.nb_failures += 1
+
+    def with_errors(self):
+        return [self[key] for key in self._with_errors]
+
+    def with_failures(self):
+        return [self[key] for key in self._with_failures]
+
+    def filter(self, name=None, series=None, finished=None):
+        keys = None
+
+        for index, value in ((self._by_name, name),
+                             (self._by_series, series)):
+            if value is None:
+                continue
+            matching = index.get(value, set())
+            keys = matching if keys is None else keys & matching
+
+        if finished is not None:
+            if finished:
+                matching = self._finished
+            else:
+                matching = self._running
+            keys = matching if keys is None else keys & matching
+
+        if keys is None:
+            return self.values()
+        return [self[key] for key in keys]
+
+
+class TestsSummary(object):
+    """The tests of a name and series summarized by the agents."""
+    __slots__ = ('name', 'series', 'count', 'success', 'duration')
+
+    def __init__(self, name, series):
+        self.name = name
+        self.series = series
+        self.count = self.success = 0
+        self.duration = 0.
+
+
 class Hit(object):
     """Represent a hit.
 
-    Used for later computation.
+    Used for later computation. The elapsed time is stored in seconds, and is
+    also available as a timedelta through the *elapsed* property.
     """
+    __slots__ = ('url', 'method', 'status', 'started', 'elapsed_seconds',
+                 'series', 'user', 'current_hit', 'current_user', 'phase',
+                 'agent_id', 'lag', 'timings', 'sent', 'received')
+
     def __init__(self, url, method, status, started, elapsed, loads_status,
-                 agent_id=None):
+                 agent_id=None, lag=None, timings=None, sent=None,
+                 received=None):
         self.url = url
         self.method = method
         self.status = status
         self.started = started
-        if not isinstance(elapsed, timedelta):
-            elapsed = timedelta(seconds=elapsed)
-
-        self.elapsed = elapsed
+        self.elapsed_seconds = get_seconds(elapsed)
 
         loads_status = loads_status or (None, None, None, None)
         (self.series, self.user, self.current_hit,
-         self.current_user) = loads_status
+         self.current_user) = loads_status[:4]
+        self.phase = _get_phase(loads_status)
 
         self.agent_id = agent_id
+        self.lag = lag
+        self.timings = timings
+        self.sent = sent
+        self.received = received
+
+    @property
+    def elapsed(self):
+        return timedelta(seconds=self.elapsed_seconds)
 
 
 class Test(object):
     """Represent a test that had been run."""
+    __slots__ = ('start', 'end', 'name', 'hit', 'user', 'series', 'phase',
+                 'failures', 'errors', 'success', '_counters')
 
     def __init__(self, start=None, **kwargs):
         self.start = start or datetime.utcnow()
@@ -349,16 +712,21 @@ class Test(object):
         self.name = None
         self.hit = None
         self.user = None
+        self.series = None
+        self.phase = None
 
         self.failures = []
         self.errors = []
         self.success = 0
-        self._counters = defaultdict(int)
+        # most tests don't use counters.
+        self._counters = None
 
         for key, value in kwargs.items():
             setattr(self, key, value)
 
     def incr_counter(self, name):
+        if self._counters is None:
+            self._counters = defaultdict(int)
         self._counters[name] += 1
 
     @property
@@ -399,7 +767,11 @@ class Test(object):
         return self.failures[0]
 
     def get_counter(self, name):
+        if self._counters is None:
+            return 0
         return self._counters[name]
 
     def get_counters(self):
+        if self._counters is None:
+            return {}
         return self._counters
@@ -13,6 +13,7 @@ class RemoteTestResult(TestResult):
     def __init__(self, config=None, args=None):
         super(RemoteTestResult, self).__init__(config, args)
         self.counts = defaultdict(int)
+        self.counts_version = None
         self.run_id = None
         if args is None:
             self.args = {}
@@ -25,7 +26,10 @@ class RemoteTestResult(TestResult):
                       'nb_success': 'addSuccess',
                       'nb_tests': 'startTest',
                       'socket': 'socket_open',
-                      'socket_data_received': 'socket_message'}
+                      'socket_data_received': 'socket_message',
+                      'opened_connections': 'connection_open',
+                      'relay_dropped': 'relay_dropped',
+                      'relay_delayed': 'relay_delayed'}
 
         values = ('errors', 'failures')
 
@@ -59,11 +63,16 @@ class RemoteTestResult(TestResult):
         if self.args.get('agents') is None:
             return
 
+        if run_id != self.run_id:
+            self.counts_version = None
         self.run_id = run_id
 
-        # we're asking the broker about the latest counts
-        self.counts = defaultdict(int)
-
+        # we're asking the broker about the counts changed since the last sync
         client = Client(self.args['broker'])
-        for line in client.get_data(run_id, groupby=True):
-            self.counts[line['data_type']] += line['count']
+        res = client.get_counts_since(run_id, self.counts_version)
+        if not res['delta']:
+            self.counts = defaultdict(int)
+
+        for data_type, count in res['counts'].items():
+            self.counts[data_type] += count
+        self.counts_version = res['version']
@@ -1,7 +1,8 @@
 from cStringIO import StringIO
 import traceback
 import errno
-from collections import defaultdict
+import time
+from collections import defaultdict, deque
 
 try:
     import zmq.green as zmq
@@ -11,30 +12,94 @@ except ImportError:
 try:
     import gevent
     from gevent.queue import Queue
+    sleep = gevent.sleep
 except ImportError:
     from Queue import Queue
+    sleep = time.sleep
 
 from loads.util import DateTimeJSONEncoder
+from loads.results.aggregate import EventsSummary
+from loads.transport import codec
+from loads.transport.ring import RingBuffer, SCHEME as SHM_SCHEME
 from loads.transport.util import get_hostname
 
 
+OVERLOAD_POLICIES = ('block', 'drop', 'sample')
+DEFAULT_SPILL_SIZE = 10000
+DEFAULT_SAMPLE_RATE = 10
+REPORT_INTERVAL = 1.
+
+
 class ZMQTestResult(object):
-    """Relays all the method calls to a zmq endpoint"""
+    """Relays all the method calls to a zmq endpoint.
+
+    The events are encoded in JSON, unless the *zmq_encoding* option is
+    set to "binary" (see loads.transport.codec).
+
+    When the receiver can't keep up, the events are handled according to
+    the *zmq_overload* option:
+
+    - **block**: waits for the socket to be writable. The other greenlets
+      keep running meanwhile.
+    - **drop**: keeps the events in a queue of *zmq_spill_size* events, and
+      drops them once it's full.
+    - **sample**: like drop, but once the queue is full one event out of
+      *zmq_sample_rate* takes the place of the oldest one in the queue.
+
+    The number of dropped and delayed events is sent to the receiver with
+    a *relay_stats* event, at most every REPORT_INTERVAL seconds and when
+    the run is over. The reports don't go through the overload policy: a
+    report that can't be sent is merged into the next one.
+
+    When *zmq_receiver* is a *shm://path* endpoint, the events are written
+    in the ring buffer at that path (see loads.transport.ring) instead, using
+    the binary encoding by default.
+    """
 
     def __init__(self, args):
         self.args = args
         self.context = args.get('zmq_context', zmq.Context())
+        self._ring = None
         self._init_socket()
         self.encoder = DateTimeJSONEncoder()
         self.agent_id = self.args.get('agent_id')
         self.run_id = self.args.get('run_id')
+        if self._ring is not None:
+            default_encoding = 'binary'
+        else:
+            default_encoding = 'json'
+        self.encoding = self.args.get('zmq_encoding') or default_encoding
+        if self.encoding not in codec.ENCODINGS:
+            raise ValueError('Unknown encoding %r' % self.encoding)
+        self._header = codec.encode_header(self.agent_id, get_hostname(),
+                                           self.run_id)
+
+        self.policy = self.args.get('zmq_overload') or 'block'
+        if self.policy not in OVERLOAD_POLICIES:
+            raise ValueError('Unknown overload policy %r' % self.policy)
+        self._spill = deque()
+        self.spill_size = (self.args.get('zmq_spill_size') or
+                           DEFAULT_SPILL_SIZE)
+        self.sample_rate = (self.args.get('zmq_sample_rate') or
+                            DEFAULT_SAMPLE_RATE)
+        self._overflow = 0
+        self.dropped = self.delayed = 0
+        self._reported = 0, 0
+        self._last_report = 0
+        self._detached = False
 
     def _init_socket(self):
         receive = self.args['zmq_receiver']
+        if receive.startswith(SHM_SCHEME):
+            self._ring = RingBuffer.from_endpoint(receive)
+            return
+
         self._push = self.context.socket(zmq.PUSH)
         self._push.set_hwm(8096 * 10)
         self._push.setsockopt(zmq.LINGER, -1)
         self._push.connect(receive)
+        self._poller = zmq.Poller()
+        self._poller.register(self._push, zmq.POLLOUT)
 
     def startTest(self, test, loads_status):
         self.push('startTest',
@@ -45,6 +110,7 @@ class ZMQTestResult(object):
         self.push('startTestRun')
 
     def stopTestRun(self, agent_id=None):
+        self._report(block=True)
         self.push('stopTestRun')
 
     def stopTest(self, test, loads_status):
@@ -82,6 +148,9 @@ class ZMQTestResult(object):
     def add_hit(self, **data):
         self.push('add_hit', **data)
 
+    def add_lag(self, lag, loads_status):
+        self.push('add_lag', lag=lag, loads_status=loads_status)
+
     def socket_open(self):
         self.push('socket_open')
 
@@ -91,71 +160,192 @@ class ZMQTestResult(object):
     def socket_message(self, size):
         self.push('socket_message', size=size)
 
+    def connection_open(self):
+        self.push('connection_open')
+
     def incr_counter(self, test, loads_status, name, agent_id=None):
         self.push(name, test=str(test), loads_status=loads_status,
                   agent_id=str(agent_id))
 
     def push(self, data_type, **data):
+        self._send(self._encode(data_type, data))
+
+    def _encode(self, data_type, data):
+        if self.encoding == 'binary':
+            return codec.encode_event(self._header, data_type, data)
+
         data.update({'data_type': data_type,
                      'agent_id': self.agent_id,
                      'hostname': get_hostname(),
                      'run_id': self.run_id})
-        while True:
-            try:
-                self._push.send(self.encoder.encode(data), zmq.NOBLOCK)
-                return
-            except zmq.ZMQError as e:
-                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
-                    continue
-                else:
-                    raise
+        return self.encoder.encode(data)
+
+    def _try_send(self, message):
+        if self._ring is not None:
+            return self._ring.write(message)
+        try:
+            self._push.send(message, zmq.NOBLOCK)
+            return True
+        except zmq.ZMQError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+
+    def _wait_send(self, message):
+        while not self._try_send(message):
+            # with gevent, the other greenlets run while we wait.
+            if self._ring is not None:
+                sleep(.001)
+            else:
+                self._poller.poll(1000)
+
+    def _flush_spill(self, block=False):
+        while self._spill:
+            if block:
+                self._wait_send(self._spill[0])
+            elif not self._try_send(self._spill[0]):
+                return False
+            self._spill.popleft()
+        return True
+
+    def _send(self, message):
+        """Sends the message, or applies the overload policy if the socket
+        can't take it."""
+        if self._detached:
+            return
+
+        if self._flush_spill() and self._try_send(message):
+            self._overflow = 0
+            if time.time() - self._last_report >= REPORT_INTERVAL:
+                self._report()
+            return
+
+        if self.policy == 'block':
+            self.delayed += 1
+            self._wait_send(message)
+        elif len(self._spill) < self.spill_size:
+            self.delayed += 1
+            self._spill.append(message)
+        elif (self.policy == 'sample' and
+              self._overflow % self.sample_rate == 0):
+            # the sampled event takes the place of the oldest one
+            self._overflow += 1
+            self.delayed += 1
+            self.dropped += 1
+            self._spill.popleft()
+            self._spill.append(message)
+        else:
+            self._overflow += 1
+            self.dropped += 1
+
+    def _report(self, block=False):
+        """Sends the counters of the overload policy that changed since the
+        last report. They are only marked as reported once sent.
+
+        Returns False if the report could not be sent right away.
+        """
+        if self._detached:
+            return True
+
+        self._last_report = time.time()
+        dropped, delayed = self.dropped, self.delayed
+        if (dropped, delayed) == self._reported:
+            return True
+
+        message = self._encode('relay_stats', {
+            'dropped': dropped - self._reported[0],
+            'delayed': delayed - self._reported[1]})
+        if block:
+            self._wait_send(message)
+        elif not self._try_send(message):
+            return False
+
+        self._reported = dropped, delayed
+        return True
 
     def add_observer(self, *args, **kwargs):
         pass  # NOOP
 
+    def detach(self):
+        """Stops sending the events.
+
+        Used in the processes forked by a runner: they get a copy of the
+        relay of their parent, but must not use its socket.
+        """
+        self._detached = True
+        self._spill.clear()
+
     def close(self):
+        if not self._detached:
+            self._flush_spill(block=True)
+            self._report(block=True)
+        if self._ring is not None:
+            self._ring.close()
         self.context.destroy()
 
 
 class ZMQSummarizedTestResult(ZMQTestResult):
+    """Sends the events by batches, every *interval* seconds.
+
+    With the *aggregate_hits* option, the hits and the successful tests of
+    each interval are folded into summaries (see EventsSummary), and only
+    the errors and failures are sent in full.
+    """
     def __init__(self, args):
         super(ZMQSummarizedTestResult, self).__init__(args)
         self.interval = 1.
         self._data = Queue()
+        if args.get('aggregate_hits'):
+            self._summary = EventsSummary()
+        else:
+            self._summary = None
         gevent.spawn_later(self.interval, self._dump_data)
 
     def push(self, data_type, **data):
-        self._data.put_nowait((data_type, data))
+        if self._summary is None:
+            self._data.put_nowait((data_type, data))
+            return
+
+        for event in self._summary.add(data_type, data):
+            self._data.put_nowait(event)
 
     def close(self):
+        if self._summary is not None:
+            for event in self._summary.flush(final=True):
+                self._data.put_nowait(event)
+
         while not self._data.empty():
             self._dump_data(loop=False)
-        self.context.destroy()
+        super(ZMQSummarizedTestResult, self).close()
 
     def _dump_data(self, loop=True):
+        if self._detached:
+            return
+
+        if self._summary is not None:
+            for event in self._summary.flush():
+                self._data.put_nowait(event)
+
         if self._data.empty() and loop:
             gevent.spawn_later(self.interval, self._dump_data)
             return
 
-        data = {'data_type': 'batch',
-                'agent_id': self.agent_id,
-                'hostname': get_hostname(),
-                'run_id': self.run_id,
-                'counts': defaultdict(list)}
+        counts = defaultdict(list)
 
         # grabbing what we have
         for _ in range(self._data.qsize()):
             data_type, message = self._data.get()
-            data['counts'][data_type].append(message)
-
-        while True:
-            try:
-                self._push.send(self.encoder.encode(data), zmq.NOBLOCK)
-                break
-            except zmq.ZMQError as e:
-                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
-                    continue
-                else:
-                    raise
+            counts[data_type].append(message)
+
+        if self.encoding == 'binary':
+            message = codec.encode_batch(self._header, counts)
+        else:
+            message = self.encoder.encode({'data_type': 'batch',
+                                           'agent_id': self.agent_id,
+                                           'hostname': get_hostname(),
+                                           'run_id': self.run_id,
+                                           'counts': counts})
+
+        self._send(message)
         if loop:
             gevent.spawn_later(self.interval, self._dump_data)
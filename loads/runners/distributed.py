@@ -1,5 +1,3 @@
-import json
-
 import zmq.green as zmq
 from zmq.green.eventloop import ioloop, zmqstream
 
@@ -8,6 +6,7 @@ from loads.transport.util import DEFAULT_PUBLISHER, DEFAULT_SSH_PUBLISHER
 from loads.util import logger, split_endpoint
 from loads.results import TestResult, RemoteTestResult
 from loads.transport.client import Client
+from loads.transport import codec
 
 
 class DistributedRunner(LocalRunner):
@@ -77,7 +76,7 @@ class DistributedRunner(LocalRunner):
 
     def _process_result(self, msg):
         try:
-            data = json.loads(msg[0])
+            data = codec.decode(msg[0])
             data_type = data.pop('data_type')
             run_id = data.pop('run_id', None)
 
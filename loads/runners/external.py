@@ -2,12 +2,15 @@ import time
 import os
 import subprocess
 import sys
+import tempfile
 
 import zmq
 from zmq.eventloop import ioloop, zmqstream
 
 from loads.runners.local import LocalRunner
-from loads.util import null_streams, json, logger
+from loads.util import null_streams, logger
+from loads.transport import codec
+from loads.transport.ring import RingBuffer
 
 
 DEFAULT_EXTERNAL_RUNNER_RECEIVER = "ipc:///tmp/loads-external-receiver.ipc"
@@ -22,6 +25,11 @@ class ExternalRunner(LocalRunner):
 
     This runner watches the state of the underlying processes to determine if
     the runs are finished or not. Once all the runs are done, it exits.
+
+    With the *shared_memory* option, each process writes its results in a
+    ring buffer (see loads.transport.ring) that this runner reads every 50ms,
+    instead of sending them via ZMQ. The processes need to use Loads to
+    report their results.
     """
 
     name = 'external'
@@ -66,6 +74,11 @@ class ExternalRunner(LocalRunner):
         self._receiver_socket = (self.args.get('zmq_receiver')
                                  or DEFAULT_EXTERNAL_RUNNER_RECEIVER)
 
+        # in slave mode, the processes report directly to the broker.
+        self._shared_memory = (self.args.get('shared_memory', False)
+                               and not self.slave)
+        self._rings = []
+
     @property
     def step_hits(self):
         """How many hits to perform in the current step."""
@@ -156,7 +169,7 @@ class ExternalRunner(LocalRunner):
         self._loop.add_callback(self._process_result, msg)
 
     def _process_result(self, msg):
-        data = json.loads(msg[0])
+        data = codec.decode(msg[0])
         data_type = data.pop('data_type')
 
         # run_id is only used when in distributed mode, which isn't the
@@ -167,13 +180,33 @@ class ExternalRunner(LocalRunner):
             method = getattr(self.test_result, data_type)
             method(**data)
 
+    def _read_rings(self):
+        """Processes the results written by the processes in their ring
+        buffers."""
+        rings = []
+        for process, ring in self._rings:
+            terminated = process.poll() is not None
+
+            for message in ring.read():
+                self._process_result([message])
+
+            if terminated:
+                ring.unlink()
+            else:
+                rings.append((process, ring))
+
+        self._rings = rings
+
     def _execute(self):
         """Spawn all the tests needed and wait for them to finish.
         """
         # If we're not in slave mode, we need to receive the data ourself
         # and build up a TestResult object.  In slave mode the spawned procs
         # will report directly to the broker.
-        if not self.slave:
+        if self._shared_memory:
+            reader = ioloop.PeriodicCallback(self._read_rings, 50, self._loop)
+            reader.start()
+        elif not self.slave:
             self.context = zmq.Context()
             self._receiver = self.context.socket(zmq.PULL)
             self._receiver.bind(self._receiver_socket)
@@ -187,7 +220,12 @@ class ExternalRunner(LocalRunner):
 
         self._loop.start()
 
-        if not self.slave:
+        if self._shared_memory:
+            reader.stop()
+            for process, ring in self._rings:
+                ring.unlink()
+            self._rings = []
+        elif not self.slave:
             self._receiver.close()
             self.context.destroy()
 
@@ -198,7 +236,8 @@ class ExternalRunner(LocalRunner):
 
             - LOADS_AGENT_ID for the id of the agent.
             - LOADS_ZMQ_RECEIVER for the address of the ZMQ socket to send the
-              results to.
+              results to, or the shm:// address of the ring buffer to write
+              them to.
             - LOADS_RUN_ID for the id of the run (shared among workers of the
               same run).
             - LOADS_TOTAL_USERS for the total number of users in this step
@@ -213,7 +252,13 @@ class ExternalRunner(LocalRunner):
 
         env = os.environ.copy()
         env['LOADS_AGENT_ID'] = str(self.args.get('agent_id'))
-        env['LOADS_ZMQ_RECEIVER'] = self._receiver_socket
+        if self._shared_memory:
+            fd, path = tempfile.mkstemp(prefix='loads-ring-')
+            os.close(fd)
+            ring = RingBuffer(path, create=True)
+            env['LOADS_ZMQ_RECEIVER'] = ring.endpoint
+        else:
+            env['LOADS_ZMQ_RECEIVER'] = self._receiver_socket
         env['LOADS_RUN_ID'] = self.args.get('run_id', '')
         env['LOADS_TOTAL_USERS'] = str(self.step_users)
         env['LOADS_CURRENT_USER'] = str(cur_user)
@@ -234,8 +279,12 @@ class ExternalRunner(LocalRunner):
 
         process = subprocess.Popen(cmd.split(' '), **cmd_args)
         self._processes.append(process)
+        if self._shared_memory:
+            self._rings.append((process, ring))
 
     def stop_run(self):
+        if self._shared_memory:
+            self._read_rings()
         self.test_result.stopTestRun(self.args.get('agent_id'))
         self._loop.stop()
         self.flush()
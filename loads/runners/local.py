@@ -1,17 +1,53 @@
 import os
 import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from itertools import islice
 
 import gevent
+import gevent.os
+from gevent.pool import Pool
 
 from loads.util import (resolve_name, logger, pack_include_files,
                         unpack_include_files, set_logger, install_pkg)
 from loads.results import ZMQTestResult, TestResult, ZMQSummarizedTestResult
 from loads.output import create_output
+from loads.runners.rate import parse_rates, get_launch_times
+from loads.runners.ramp import get_profile, UP, STEADY, DOWN
+from loads.transport import codec
+from loads.transport.ring import RingBuffer
 
 
 DEFAULT_LOGFILE = os.path.join('/tmp', 'loads-worker.log')
 
 
+def _parse_date(value):
+    if '.' in value:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+
+def _decode_event(message):
+    """Decodes an event written by a worker process.
+
+    Returns the name of the TestResult method to call and its arguments, as
+    they would be in a single process.
+    """
+    data = codec.decode(message)
+    data_type = data.pop('data_type')
+    for name in ('agent_id', 'hostname', 'run_id'):
+        data.pop(name, None)
+
+    if data_type == 'add_hit':
+        if data.get('started') is not None:
+            data['started'] = _parse_date(data['started'])
+        if data.get('elapsed') is not None:
+            data['elapsed'] = timedelta(seconds=data['elapsed'])
+
+    return data_type, data
+
+
 def _compute_arguments(args):
     """
     Read the given :param args: and builds up the total number of runs, the
@@ -37,8 +73,14 @@ def _compute_arguments(args):
     # XXX duration based == no total
     total = 0
     if duration is None:
-        for user in users:
-            total += sum([hit * user for hit in hits])
+        if args.get('rate'):
+            # each step of rate runs the hits once, whatever the users.
+            rates = parse_rates(args['rate'])
+            for step in range(max(len(rates), len(hits))):
+                total += hits[min(step, len(hits) - 1)]
+        else:
+            for user in users:
+                total += sum([hit * user for hit in hits])
         if agents is not None:
             total *= agents
 
@@ -56,6 +98,24 @@ class LocalRunner(object):
       outputs.
     - The "slave" mode where the results are sent to a ZMQ endpoint and no
       output is called.
+
+    With the *processes* option, the users of each step are split across
+    that many forked processes. In the classical mode, each process writes
+    its results in a ring buffer (see loads.transport.ring) that is merged
+    back into the test result of this runner. In slave mode, each process
+    sends its results to the ZMQ endpoint itself.
+
+    The *ramp_up* and *ramp_down* options spread the start and the end of
+    the users of each step over that many seconds, following the
+    *ramp_profile* (see loads.runners.ramp). With a ramp-down, the next step
+    starts with it, so the steps overlap. The phase of the step is then
+    added to the loads_status of each test.
+
+    With the *rate* option, the tests are launched at the given arrival
+    rates (see loads.runners.rate) instead of one after the other, by a
+    pool of at most *users* greenlets. How late each launch is compared to
+    its schedule is sent to the test result, and attached to the hits so
+    their latencies can be corrected.
     """
 
     name = 'local'
@@ -74,10 +134,28 @@ class LocalRunner(object):
         self._test_result = None
         self.outputs = []
         self.stop = False
+        self.processes = max(int(args.get('processes') or 1), 1)
+        self.failed_workers = []
+        if args.get('rate'):
+            self.rates = parse_rates(args['rate'])
+        else:
+            self.rates = None
 
         (self.total, self.hits,
          self.duration, self.users, self.agents) = _compute_arguments(args)
 
+        self.ramp_up = args.get('ramp_up') or 0
+        self.ramp_down = args.get('ramp_down') or 0
+        self.ramp_profile = get_profile(args.get('ramp_profile'))
+        if self.ramp_down and self.duration is None:
+            raise ValueError('The ramp-down needs a duration')
+        if (self.duration is not None and
+                self.ramp_up + self.ramp_down > self.duration):
+            raise ValueError('The ramps are longer than the duration')
+        if (self.rates is not None and self.duration is None and
+                any(start != end for start, end in self.rates)):
+            raise ValueError('A ramped rate needs a duration')
+
         self.args['hits'] = self.hits
         self.args['users'] = self.users
         self.args['agents'] = self.agents
@@ -140,6 +218,9 @@ class LocalRunner(object):
         self.running = True
         try:
             self._execute()
+            if self.failed_workers:
+                # the results of these workers are incomplete.
+                return 1
             if (not self.slave and
                     self.test_result.nb_errors + self.test_result.nb_failures):
                 return 1
@@ -152,9 +233,12 @@ class LocalRunner(object):
             self.running = False
             os.chdir(old_location)
 
-    def _run(self, num, user):
+    def _run(self, num, user, step_started=None, duration=None):
         """This method is actually spawned by gevent so there is more than
         one actual test suite running in parallel.
+
+        When ramping, *step_started* is when the step started, and
+        *duration* the time this user runs.
         """
         # creating the test case instance
         test = self.test.im_class(test_name=self.test.__name__,
@@ -171,24 +255,54 @@ class LocalRunner(object):
                                                   (hit, user, 0, num)))
                 for current_hit in range(hit):
                     loads_status[2] = current_hit + 1
-                    test(loads_status=list(loads_status))
+                    test(loads_status=self._get_status(loads_status,
+                                                       step_started))
                     gevent.sleep(0)
         else:
+            if duration is None:
+                duration = self.duration
+            deadline = time.time() + duration
+
             def spawn_test():
                 loads_status = list(self.args.get('loads_status',
                                                   (0, user, 0, num)))
-                while True:
+                # the current test is not interrupted by the end of a ramp.
+                while step_started is None or time.time() < deadline:
                     loads_status[2] += 1
-                    test(loads_status=loads_status)
+                    if step_started is None:
+                        test(loads_status=loads_status)
+                    else:
+                        test(loads_status=self._get_status(loads_status,
+                                                           step_started))
                     gevent.sleep(0)
 
             spawned_test = gevent.spawn(spawn_test)
-            timer = gevent.Timeout(self.duration).start()
+            timer = gevent.Timeout(duration).start()
             try:
                 spawned_test.join(timeout=timer)
-            except (gevent.Timeout, KeyboardInterrupt):
+            except gevent.Timeout:
+                if step_started is not None:
+                    # the user is over once its current test is.
+                    spawned_test.join()
+            except KeyboardInterrupt:
                 pass
 
+    def _get_status(self, loads_status, step_started):
+        """Returns a copy of the status, with the phase of the step when
+        ramping."""
+        if step_started is None:
+            return list(loads_status)
+
+        elapsed = time.time() - step_started
+        if (self.ramp_down and
+                elapsed >= self.duration - self.ramp_down):
+            phase = DOWN
+        elif elapsed < self.ramp_up:
+            phase = UP
+        else:
+            phase = STEADY
+        return list(loads_status[:4]) + [phase]
+
     def _prepare_filesystem(self):
         test_dir = self.args.get('test_dir')
 
@@ -244,16 +358,10 @@ class LocalRunner(object):
             if not self.args.get('externally_managed'):
                 self.test_result.startTestRun(agent_id)
 
-            for user in self.users:
-                if self.stop:
-                    break
-
-                group = []
-                for i in range(user):
-                    group.append(gevent.spawn(self._run, i, user))
-                    gevent.sleep(0)
-
-                gevent.joinall(group)
+            if self.rates is not None:
+                self._run_rate_steps()
+            else:
+                self._run_user_steps()
 
             gevent.sleep(0)
 
@@ -278,6 +386,238 @@ class LocalRunner(object):
                     logger.debug('We had an exception, re-raising it')
                     raise exception
 
+    def _run_user_steps(self):
+        greenlets, workers = [], []
+        try:
+            for user in self.users:
+                if self.stop:
+                    break
+
+                step_started = time.time()
+                if self.processes > 1:
+                    workers += self._start_processes([
+                        (self._run_users, (range(index, user, self.processes),
+                                           user))
+                        for index in range(min(self.processes, user))])
+                else:
+                    greenlets += self._start_users(range(user), user)
+
+                # the next step starts with the ramp-down of this one.
+                until = None
+                if self.ramp_down:
+                    until = step_started + self.duration - self.ramp_down
+                greenlets, workers = self._wait_users(greenlets, workers,
+                                                      until)
+
+            self._wait_users(greenlets, workers)
+        finally:
+            self._unlink_rings(workers)
+
+    def _start_users(self, nums, user):
+        """Spawns the *nums* users of a step of *user* users, over the
+        ramp-up time if any."""
+        group = []
+        if not (self.ramp_up or self.ramp_down):
+            for i in nums:
+                group.append(gevent.spawn(self._run, i, user))
+                gevent.sleep(0)
+            return group
+
+        step_started = time.time()
+        starts = self.ramp_profile.get_offsets(user, self.ramp_up)
+        stops = [self.ramp_down * self.ramp_profile.get_time(
+                 float(user - num) / user) for num in range(user)]
+
+        for num in nums:
+            duration = None
+            if self.duration is not None:
+                # the last users started are the first ones stopped.
+                duration = (self.duration - self.ramp_down + stops[num] -
+                            starts[num])
+            group.append(gevent.spawn_later(starts[num], self._run, num,
+                                            user, step_started, duration))
+        return group
+
+    def _run_users(self, nums, user):
+        gevent.joinall(self._start_users(nums, user))
+
+    def _wait_users(self, greenlets, workers, until=None):
+        """Waits for the users to be over, or until the given time.
+
+        Returns the greenlets and the worker processes still running.
+        """
+        while greenlets or workers:
+            timeout = None
+            if until is not None:
+                timeout = until - time.time()
+                if timeout <= 0:
+                    break
+
+            if workers:
+                gevent.sleep(.05 if timeout is None else min(.05, timeout))
+                workers = [worker for worker in workers
+                           if not self._check_worker(*worker)]
+            else:
+                gevent.joinall(greenlets, timeout=timeout)
+            greenlets = [greenlet for greenlet in greenlets
+                         if not greenlet.ready()]
+
+        return greenlets, workers
+
+    def _run_rate_steps(self):
+        users = max(self.users)
+        if self.processes > 1:
+            # each process gets some of the users and launches, so the
+            # launches still follow the whole schedule.
+            workers = min(self.processes, users)
+            self._run_processes([
+                (self._run_rates, (range(index, users, workers), index,
+                                   workers))
+                for index in range(workers)])
+        else:
+            self._run_rates(range(users))
+
+    def _run_rates(self, nums, index=0, step=1):
+        """Launches the tests at the arrival rates, with one greenlet per
+        user in *nums*.
+
+        Only the launches *index*, *index + step*, etc. of the schedule are
+        done here. When all the greenlets are busy, the next launches wait
+        for one of them and are late.
+        """
+        users = max(self.users)
+        free = [(num, self.test.im_class(test_name=self.test.__name__,
+                                         test_result=self.test_result,
+                                         config=self.args))
+                for num in nums]
+        pool = Pool(len(free))
+
+        if self.duration is None:
+            nb_steps = max(len(self.rates), len(self.hits))
+        else:
+            nb_steps = len(self.rates)
+
+        for series in range(1, nb_steps + 1):
+            if self.stop:
+                break
+
+            # like for the users, the last values are used for the next steps
+            start, end = self.rates[min(series, len(self.rates)) - 1]
+            count = None
+            if self.duration is None:
+                count = self.hits[min(series, len(self.hits)) - 1]
+
+            times = enumerate(get_launch_times(start, end, self.duration,
+                                               count), 1)
+            started = time.time()
+
+            for current_hit, when in islice(times, index, None, step):
+                delay = started + when - time.time()
+                if delay > 0:
+                    gevent.sleep(delay)
+                pool.wait_available()
+                if self.stop:
+                    break
+
+                lag = max(time.time() - started - when, 0)
+                num, test = free.pop()
+                loads_status = [series, users, current_hit, num]
+                pool.spawn(self._launch, free, num, test, loads_status, lag)
+
+            pool.join()
+
+    def _launch(self, free, num, test, loads_status, lag):
+        try:
+            self.test_result.add_lag(lag, loads_status)
+            test.session.lag = lag
+            test(loads_status=loads_status)
+        finally:
+            free.append((num, test))
+
+    def _run_processes(self, jobs):
+        """Runs each job, a function and its arguments, in a forked process,
+        and waits for them to finish."""
+        workers = self._start_processes(jobs)
+        try:
+            self._wait_users([], workers)
+        finally:
+            self._unlink_rings(workers)
+
+    def _start_processes(self, jobs):
+        workers = []
+        for function, args in jobs:
+            ring = None
+            if not self.slave:
+                fd, path = tempfile.mkstemp(prefix='loads-ring-')
+                os.close(fd)
+                ring = RingBuffer(path, create=True)
+
+            pid = gevent.fork()
+            if pid == 0:
+                self._run_worker(function, args, ring)
+            workers.append((pid, ring))
+        return workers
+
+    def _unlink_rings(self, workers):
+        for __, ring in workers:
+            if ring is not None:
+                ring.unlink()
+
+    def _check_worker(self, pid, ring):
+        """Merges the results of a worker. Returns True once it's over."""
+        done, status = gevent.os.waitpid(pid, os.WNOHANG)
+
+        if ring is not None:
+            for message in ring.read():
+                self._merge_event(message)
+
+        if not done:
+            return False
+
+        if status != 0:
+            logger.error('The worker process %d failed (status %d)'
+                         % (pid, status))
+            self.failed_workers.append(pid)
+        if ring is not None:
+            ring.unlink()
+        return True
+
+    def _merge_event(self, message):
+        data_type, data = _decode_event(message)
+        if hasattr(self.test_result, data_type):
+            getattr(self.test_result, data_type)(**data)
+        elif set(data) == set(['test', 'loads_status']):
+            # the relays send the counters as events named after them.
+            self.test_result.incr_counter(name=data_type, **data)
+
+    def _run_worker(self, function, args, ring):
+        """Runs the job in a forked process, then exits."""
+        status = 0
+        try:
+            # the relay of the parent process can't be used here.
+            if self.slave:
+                self.test_result.detach()
+
+            self.outputs = []
+            self.slave = True
+            self.args = dict(self.args)
+            self.args.pop('zmq_context', None)
+            if ring is not None:
+                self.args['zmq_receiver'] = ring.endpoint
+            self._test_result = None
+
+            function(*args)
+        except KeyboardInterrupt:
+            pass
+        except Exception:
+            logger.exception('The worker process failed')
+            status = 1
+        finally:
+            try:
+                self.test_result.close()
+            finally:
+                os._exit(status)
+
     def flush(self):
         for output in self.outputs:
             if hasattr(output, 'flush'):
@@ -0,0 +1,91 @@
+""" Ramp profiles: how the users of a step are started or stopped over time.
+
+A profile gives the fraction of the users started (or stopped) once a
+fraction of the ramp time elapsed. It can be:
+
+- "linear": the users are started at a constant pace.
+- "exponential": a few users are started first, then more and more.
+- the path of a file with one "time users" couple of fractions per line,
+  between 0 and 1. The profile is interpolated linearly between them.
+
+The iterations run by the users are flagged with the phase of the step they
+are in: up, steady or down.
+"""
+import math
+
+
+UP = 'up'
+STEADY = 'steady'
+DOWN = 'down'
+PHASES = (UP, STEADY, DOWN)
+
+_EXPONENTIAL_BASE = 32.
+_EXPONENTIAL_POINTS = 32
+
+
+class RampProfile(object):
+    """A ramp profile, given by the points of its curve."""
+
+    def __init__(self, points):
+        points = sorted(points)
+        if not points or points[0] != (0, 0):
+            points.insert(0, (0., 0.))
+        if points[-1] != (1, 1):
+            points.append((1., 1.))
+
+        for (time0, users0), (time1, users1) in zip(points, points[1:]):
+            if users1 < users0 or not (0 <= time1 <= 1 and 0 <= users1 <= 1):
+                raise ValueError('Invalid ramp profile: %s' % points)
+
+        self.points = points
+
+    def get_time(self, users):
+        """Returns the fraction of the ramp time at which the given fraction
+        of the users is reached."""
+        previous = self.points[0]
+        for point in self.points[1:]:
+            if point[1] >= users:
+                (time0, users0), (time1, users1) = previous, point
+                if users1 == users0:
+                    return time0
+                return time0 + (time1 - time0) * (users - users0) / (users1 -
+                                                                     users0)
+            previous = point
+        return 1.
+
+    def get_offsets(self, users, ramp_time):
+        """Returns when each of the *users* starts, in seconds since the
+        beginning of the ramp."""
+        return [ramp_time * self.get_time(float(num) / users)
+                for num in range(users)]
+
+
+def _exponential_points():
+    scale = _EXPONENTIAL_BASE - 1
+    points = []
+    for index in range(_EXPONENTIAL_POINTS + 1):
+        time = float(index) / _EXPONENTIAL_POINTS
+        points.append((time, (math.pow(_EXPONENTIAL_BASE, time) - 1) / scale))
+    return points
+
+
+def get_profile(name):
+    """Returns the profile of the given name, or read from the given file."""
+    if name in (None, 'linear'):
+        return RampProfile([(0., 0.), (1., 1.)])
+    elif name == 'exponential':
+        return RampProfile(_exponential_points())
+
+    points = []
+    with open(name) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            try:
+                time, users = [float(value) for value in line.split()]
+            except ValueError:
+                raise ValueError('Invalid ramp profile line: %r' % line)
+            points.append((time, users))
+
+    return RampProfile(points)
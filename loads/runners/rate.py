@@ -0,0 +1,73 @@
+""" Arrival rates for the open model (see the *rate* option of LocalRunner).
+
+A rate is a number of test iterations launched per second, whatever the
+time the previous ones take. It can be:
+
+- fixed: "10"
+- ramped linearly over the step: "10-100"
+- stepped, like the users: "10:20:30". Each step lasts the given duration
+  or runs the given number of hits. The steps can be ramped too: "10-50:50".
+"""
+import math
+
+
+def parse_rates(rates):
+    """Returns the (start, end) rates of each step."""
+    if isinstance(rates, (int, long, float)):
+        rates = str(rates)
+    if isinstance(rates, basestring):
+        rates = rates.split(':')
+
+    steps = []
+    for rate in rates:
+        if isinstance(rate, (list, tuple)):
+            start, end = rate
+        else:
+            start, __, end = str(rate).partition('-')
+            end = end or start
+
+        try:
+            start, end = float(start), float(end)
+        except ValueError:
+            raise ValueError('Invalid rate: %r' % (rate,))
+
+        if start < 0 or end < 0 or start == end == 0:
+            raise ValueError('Invalid rate: %r' % (rate,))
+        steps.append((start, end))
+
+    return steps
+
+
+def get_launch_times(start, end, duration=None, count=None):
+    """Yields the times, in seconds since the beginning of the step, at which
+    the iterations have to be launched.
+
+    The step is over after *duration* seconds, or after *count* launches. A
+    ramped rate needs a duration.
+    """
+    if duration is None:
+        if count is None:
+            raise ValueError('A duration or a count is needed')
+        if start != end:
+            raise ValueError('A ramped rate needs a duration')
+        slope = 0
+    else:
+        slope = (end - start) / float(duration)
+
+    launched = 0
+    while count is None or launched < count:
+        # the number of launches at t is start * t + slope * t ** 2 / 2
+        if slope == 0:
+            when = launched / float(start)
+        else:
+            delta = start ** 2 + 2 * slope * launched
+            if delta < 0:
+                # a decreasing rate never reaches that many launches
+                return
+            when = (math.sqrt(delta) - start) / slope
+
+        if duration is not None and when >= duration:
+            return
+
+        yield when
+        launched += 1
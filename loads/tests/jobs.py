@@ -1,9 +1,12 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
+import os
 import time
 import sys
 
+import gevent
+
 from loads.util import logger, set_logger
 from loads.case import TestCase
 
@@ -46,3 +49,16 @@ def timeout_overflow(job):
 class SomeTests(TestCase):
     def test_one(self):
         pass
+
+    def test_counter(self):
+        self.incr_counter('one')
+
+    def test_failure(self):
+        self.fail('failed')
+
+    def test_wait(self):
+        gevent.sleep(.05)
+
+    def test_exit(self):
+        # kills the worker process running the test
+        os._exit(3)
@@ -0,0 +1,247 @@
+from unittest2 import TestCase
+
+from loads.results.aggregate import (LatencyHistogram, HitStats,
+                                     TimingStats, RollupStats, EventsSummary,
+                                     get_event_counts)
+from loads.util import get_quantiles
+
+
+class TestLatencyHistogram(TestCase):
+
+    def test_quantiles_are_close_to_the_exact_ones(self):
+        histogram = LatencyHistogram()
+        values = [0.001 * i for i in range(1, 1001)]
+        for value in values:
+            histogram.add(value)
+
+        quantiles = (0.1, 0.5, 0.9, 0.99)
+        exact = get_quantiles(values, quantiles)
+        approximated = histogram.get_quantiles(quantiles)
+
+        for exact_, approx_ in zip(exact, approximated):
+            self.assertTrue(abs(exact_ - approx_) <= exact_ * 0.02,
+                            (exact_, approx_))
+
+        # the extremes are exact
+        self.assertEqual(histogram.get_quantiles((0, 1)), [0.001, 1.])
+
+    def test_memory_is_bounded(self):
+        histogram = LatencyHistogram()
+        for i in range(10000):
+            histogram.add(0.2)
+            histogram.add(0)
+        self.assertEqual(len(histogram.buckets), 2)
+        self.assertEqual(histogram.count, 20000)
+        self.assertAlmostEqual(histogram.average, 0.1)
+
+    def test_merge_and_serialize(self):
+        one, two = LatencyHistogram(), LatencyHistogram()
+        one.add(0.1)
+        two.add(0.3)
+        two.add(0.5)
+
+        one.merge(LatencyHistogram.from_dict(two.to_dict()))
+        self.assertEqual(one.count, 3)
+        self.assertEqual(one.min, 0.1)
+        self.assertEqual(one.max, 0.5)
+        self.assertAlmostEqual(one.average, 0.3)
+
+    def test_empty(self):
+        self.assertEqual(LatencyHistogram().get_quantiles((0, 1)),
+                         [None, None])
+
+
+class TestHitStats(TestCase):
+
+    def test_filters(self):
+        stats = HitStats()
+        stats.add('http://one', 1, 200, 0.1)
+        stats.add('http://one', 2, 500, 0.3)
+        stats.add('http://two', 1, 200, 0.2)
+
+        self.assertEqual(stats.get_count(), 3)
+        self.assertEqual(stats.get_count(url='http://one'), 2)
+        self.assertEqual(stats.get_count(series=1), 2)
+        self.assertEqual(stats.urls, set(['http://one', 'http://two']))
+        self.assertAlmostEqual(stats.average(series=1), 0.15)
+        self.assertEqual(stats.success_rate(url='http://one'), 0.5)
+        self.assertEqual(stats.get_statuses(), {200: 2, 500: 1})
+        self.assertEqual(stats.get_quantiles((0, 1), series=2), [0.3, 0.3])
+
+    def test_merge(self):
+        histogram = LatencyHistogram()
+        histogram.add(0.1, count=3)
+
+        stats = HitStats()
+        stats.add('http://one', 1, 200, 0.3)
+        stats.merge('http://one', 1, 500, histogram)
+
+        self.assertEqual(stats.get_count(), 4)
+        self.assertEqual(stats.get_statuses(), {200: 1, 500: 3})
+        self.assertEqual(stats.success_rate(), 0.25)
+        self.assertAlmostEqual(stats.average(), 0.15)
+
+
+def _timings(connect=0, ttfb=0.1):
+    return {'dns': 0, 'connect': connect, 'tls': 0, 'ttfb': ttfb,
+            'download': 0.01}
+
+
+class TestTimingStats(TestCase):
+
+    def test_average(self):
+        stats = TimingStats()
+        stats.add('http://one', 1, _timings(connect=0.1), 100, 1000)
+        stats.add('http://one', 1, _timings(), 100, 3000)
+        stats.add('http://one', 2, _timings(ttfb=0.5), 100, 1000)
+
+        self.assertEqual(stats.count, 3)
+        self.assertEqual(stats.users, [1, 2])
+
+        timings = stats.average(users=1)
+        self.assertAlmostEqual(timings['connect'], 0.05)
+        self.assertAlmostEqual(timings['ttfb'], 0.1)
+        self.assertEqual(timings['received'], 2000)
+        self.assertAlmostEqual(stats.average(users=2)['ttfb'], 0.5)
+        self.assertEqual(stats.average(url='http://two'), {})
+
+        other = TimingStats()
+        other.add('http://one', 2, _timings(ttfb=0.3))
+        stats.merge('http://one', 2, other._sums['http://one', 2])
+        self.assertAlmostEqual(stats.average(users=2)['ttfb'], 0.4)
+
+
+class TestRollupStats(TestCase):
+
+    def test_rollups(self):
+        stats = RollupStats()
+        hit = {'data_type': 'add_hit', 'url': 'http://one', 'status': 200,
+               'elapsed': 0.1}
+        self.assertTrue(stats.add(10, hit))
+        self.assertTrue(stats.add(10, dict(hit, status=500, elapsed=0.3)))
+        self.assertTrue(stats.add(11, dict(hit, url='http://two')))
+        self.assertFalse(stats.add(11, {'data_type': 'add_hit'}))
+
+        # the summaries of the agents
+        histogram = LatencyHistogram()
+        histogram.add(0.2, count=4)
+        self.assertTrue(stats.add(12, {'data_type': 'add_hits',
+                                       'url': 'http://one', 'status': 404,
+                                       'histogram': histogram.to_dict()}))
+
+        rollups = stats.get(url='http://one')
+        self.assertEqual([(rollup['second'], rollup['hits'], rollup['errors'])
+                          for rollup in rollups], [(10, 2, 1), (12, 4, 4)])
+        self.assertEqual(rollups[0]['error_rate'], 0.5)
+        self.assertAlmostEqual(rollups[0]['average'], 0.2)
+
+        self.assertEqual(len(stats.get(start=11, end=11)), 1)
+
+        rollups = stats.get(step=5)
+        self.assertEqual([(rollup['second'], rollup['url'], rollup['hits'])
+                          for rollup in rollups],
+                         [(10, 'http://one', 6), (10, 'http://two', 1)])
+
+        # once dumped and loaded back
+        other = RollupStats()
+        for rollup in stats.dump():
+            other.load(rollup)
+        self.assertEqual(other.get(), stats.get())
+
+        stats.clear()
+        self.assertEqual(len(stats), 0)
+
+
+class TestEventsSummary(TestCase):
+
+    def _run_test(self, summary, test, loads_status, *data_types):
+        events = []
+        for data_type in ('startTest',) + data_types + ('stopTest',):
+            data = {'test': test, 'loads_status': loads_status}
+            if data_type in ('addError', 'addFailure'):
+                data['exc_info'] = ('error', 'class', 'tb')
+            events.extend(summary.add(data_type, data))
+        return events
+
+    def test_hits(self):
+        summary = EventsSummary()
+        for status in (200, 200, 500):
+            hit = {'url': 'http://one', 'method': 'GET', 'status': status,
+                   'started': None, 'elapsed': 0.1,
+                   'loads_status': [1, 1, 1, 1]}
+            self.assertEqual(summary.add('add_hit', hit), [])
+
+        events = sorted(summary.flush(), key=lambda e: e[1]['status'])
+        self.assertEqual([data_type for data_type, data in events],
+                         ['add_hits', 'add_hits'])
+        self.assertEqual(events[0][1]['histogram']['count'], 2)
+        self.assertEqual(events[1][1]['series'], 1)
+        self.assertEqual(get_event_counts(dict(events[0][1],
+                                               data_type='add_hits')),
+                         {'add_hit': 2})
+
+        # the summary is reset on every flush
+        self.assertEqual(summary.flush(), [])
+
+    def test_timed_hits(self):
+        summary = EventsSummary()
+        for ttfb in (0.1, 0.3):
+            hit = {'url': 'http://one', 'method': 'GET', 'status': 200,
+                   'started': None, 'elapsed': 0.1,
+                   'loads_status': [1, 1, 1, 1], 'timings': _timings(0, ttfb),
+                   'sent': 10, 'received': 20}
+            summary.add('add_hit', hit)
+
+        (data_type, data), = summary.flush()
+        self.assertEqual(data['users'], 1)
+        self.assertEqual(data['timings']['count'], 2)
+        self.assertAlmostEqual(data['timings']['ttfb'], 0.4)
+        self.assertEqual(data['timings']['received'], 40)
+
+    def test_lags_and_connections(self):
+        summary = EventsSummary()
+        for lag in (0.1, 0.3):
+            self.assertEqual(summary.add('add_lag', {
+                'lag': lag, 'loads_status': [1, 1, 1, 1]}), [])
+            self.assertEqual(summary.add('connection_open', {}), [])
+
+        events = dict(summary.flush())
+        self.assertEqual(events['add_lags']['histogram']['count'], 2)
+        self.assertEqual(events['connection_open'], {'count': 2})
+        self.assertEqual(get_event_counts(dict(events['add_lags'],
+                                               data_type='add_lags')),
+                         {'add_lag': 2})
+        self.assertEqual(get_event_counts(dict(events['connection_open'],
+                                               data_type='connection_open')),
+                         {'connection_open': 2})
+        self.assertEqual(summary.flush(), [])
+
+    def test_tests(self):
+        summary = EventsSummary()
+        for current in range(3):
+            events = self._run_test(summary, 'test', [1, 1, current, 1],
+                                    'addSuccess')
+            self.assertEqual(events, [])
+
+        # the details of the failing tests are kept
+        events = self._run_test(summary, 'test', [1, 1, 4, 1], 'addFailure')
+        self.assertEqual([data_type for data_type, data in events],
+                         ['startTest', 'addFailure', 'stopTest'])
+
+        events = summary.flush()
+        self.assertEqual(len(events), 1)
+        data_type, data = events[0]
+        self.assertEqual(data_type, 'add_tests')
+        self.assertEqual((data['test'], data['series'], data['count'],
+                          data['success']), ('test', 1, 3, 3))
+        self.assertEqual(get_event_counts(dict(data, data_type='add_tests')),
+                         {'startTest': 3, 'stopTest': 3, 'addSuccess': 3})
+
+    def test_running_tests_are_sent_when_closing(self):
+        summary = EventsSummary()
+        summary.add('startTest', {'test': 'test',
+                                  'loads_status': [1, 1, 1, 1]})
+        self.assertEqual(summary.flush(), [])
+        events = summary.flush(final=True)
+        self.assertEqual([data_type for data_type, data in events],
+                         ['startTest'])
@@ -4,11 +4,13 @@ import shutil
 from collections import defaultdict
 import time
 
+import mock
 import psutil
 from zmq.green.eventloop import ioloop
 from loads.util import json
 from loads.transport.brokerctrl import (BrokerController,
                                         NotEnoughWorkersError,
+                                        UnknownCursorError,
                                         _compute_observers)
 
 
@@ -112,6 +114,128 @@ class TestBrokerController(unittest2.TestCase):
         back2 = self.ctrl.get_data(None, {'run_id': 'run'})
         self.assertEqual(back, back2)
 
+        # the rollups of the hits
+        hit = {'data_type': 'add_hit', 'url': 'http://one', 'status': 200,
+               'elapsed': 0.1}
+        self.ctrl.save_data('1', hit)
+        rollups = self.ctrl.get_rollups(None, {'run_id': 'run',
+                                               'url': 'http://one',
+                                               'start': '0', 'step': 60})
+        self.assertEqual([rollup['hits'] for rollup in rollups], [1])
+
+    def test_data_cursors(self):
+        for i in range(5):
+            self.ctrl.save_data('1', {'run_id': 'run', 'data_type': 'add_hit',
+                                      'number': i})
+        self.ctrl.flush_db()
+
+        # the data is sent by chunks
+        res = self.ctrl.get_data(None, {'run_id': 'run', 'chunk_size': 2})
+        self.assertEqual([line['number'] for line in res['data']], [0, 1])
+        cursor = res['cursor']
+
+        res = self.ctrl.get_data(None, {'cursor': cursor})
+        self.assertEqual([line['number'] for line in res['data']], [2, 3])
+        self.assertEqual(res['cursor'], cursor)
+
+        res = self.ctrl.get_data(None, {'cursor': cursor})
+        self.assertEqual([line['number'] for line in res['data']], [4])
+        self.assertEqual(res['cursor'], None)
+        self.assertRaises(UnknownCursorError, self.ctrl.get_data, None,
+                          {'cursor': cursor})
+
+        # the cursors left aside are closed
+        res = self.ctrl.get_data(None, {'run_id': 'run', 'chunk_size': 2,
+                                        'start': 1})
+        self.assertEqual([line['number'] for line in res['data']], [1, 2])
+        self.ctrl.cursor_timeout = 0
+        time.sleep(.01)
+        self.ctrl.clean()
+        self.assertRaises(UnknownCursorError, self.ctrl.get_data, None,
+                          {'cursor': res['cursor']})
+
+        # the chunks can't be empty
+        self.assertRaises(ValueError, self.ctrl.get_data, None,
+                          {'run_id': 'run', 'chunk_size': 0})
+
+    def test_counts_since(self):
+        hit = {'run_id': 'run', 'data_type': 'add_hit'}
+        self.ctrl.save_data('1', dict(hit))
+        self.ctrl.save_data('1', {'run_id': 'run', 'data_type': 'startTest'})
+
+        res = self.ctrl.get_counts_since(None, {'run_id': 'run'})
+        self.assertEqual(res['counts'], {'add_hit': 1, 'startTest': 1})
+        self.assertFalse(res['delta'])
+        version = res['version']
+
+        # nothing was added: the DB is not read
+        with mock.patch.object(self.ctrl._db, 'get_counts') as get_counts:
+            res = self.ctrl.get_counts_since(None, {'run_id': 'run',
+                                                    'since': version})
+        self.assertFalse(get_counts.called)
+        self.assertEqual(res, {'version': version, 'counts': {},
+                               'delta': True})
+
+        # only the changed counts are sent
+        self.ctrl.save_data('1', dict(hit))
+        self.ctrl.save_data('1', dict(hit))
+        res = self.ctrl.get_counts_since(None, {'run_id': 'run',
+                                                'since': version})
+        self.assertEqual(res['counts'], {'add_hit': 2})
+        self.assertTrue(res['delta'])
+        self.assertNotEqual(res['version'], version)
+
+        version2 = res['version']
+
+        # each client gets the changes since its own version
+        self.ctrl.save_data('1', dict(hit))
+        with mock.patch.object(self.ctrl._db, 'get_counts',
+                               wraps=self.ctrl._db.get_counts) as get_counts:
+            res = self.ctrl.get_counts_since(None, {'run_id': 'run',
+                                                    'since': version})
+            self.assertEqual(res['counts'], {'add_hit': 3})
+            self.assertTrue(res['delta'])
+
+            res = self.ctrl.get_counts_since(None, {'run_id': 'run',
+                                                    'since': version2})
+            self.assertEqual(res['counts'], {'add_hit': 1})
+            self.assertTrue(res['delta'])
+
+        # the DB is read once for the current version
+        self.assertEqual(get_counts.call_count, 1)
+
+        # all the counts are sent for an unknown version
+        res = self.ctrl.get_counts_since(None, {'run_id': 'run',
+                                                'since': 'unknown'})
+        self.assertEqual(res['counts'], {'add_hit': 4, 'startTest': 1})
+        self.assertFalse(res['delta'])
+
+    def test_counts_since_snapshots(self):
+        self.ctrl.counts_snapshots = 2
+        versions = []
+        for i in range(3):
+            self.ctrl.save_data('1', {'run_id': 'run',
+                                      'data_type': 'add_hit'})
+            res = self.ctrl.get_counts_since(None, {'run_id': 'run'})
+            versions.append(res['version'])
+
+        # the oldest version was dropped
+        self.ctrl.save_data('1', {'run_id': 'run', 'data_type': 'add_hit'})
+        res = self.ctrl.get_counts_since(None, {'run_id': 'run',
+                                                'since': versions[0]})
+        self.assertFalse(res['delta'])
+        res = self.ctrl.get_counts_since(None, {'run_id': 'run',
+                                                'since': versions[2]})
+        self.assertEqual(res['counts'], {'add_hit': 1})
+        self.assertTrue(res['delta'])
+
+        # the snapshots are dropped when the run ends
+        self.ctrl.test_ended('run')
+        self.assertFalse('run' in self.ctrl._counts)
+        res = self.ctrl.get_counts_since(None, {'run_id': 'run',
+                                                'since': versions[2]})
+        self.assertFalse(res['delta'])
+
     def test_compute_observers(self):
         obs = ['irc', 'loads.observers.irc']
         observers = _compute_observers(obs)
@@ -0,0 +1,21 @@
+from unittest2 import TestCase
+
+import mock
+
+from loads.transport.client import Client
+
+
+class TestClient(TestCase):
+
+    def setUp(self):
+        self.client = Client('ipc:///tmp/loads-test-client.ipc')
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_get_data_chunk_size(self):
+        with mock.patch.object(self.client, 'execute') as execute:
+            for chunk_size in (0, -1):
+                self.assertRaises(ValueError, self.client.get_data, 'run',
+                                  chunk_size=chunk_size)
+        self.assertFalse(execute.called)
@@ -0,0 +1,134 @@
+from datetime import datetime, timedelta
+from unittest2 import TestCase
+
+import mock
+
+from loads.transport import codec
+from loads.util import json, DateTimeJSONEncoder
+
+
+HEADER = codec.encode_header('agent', 'host', 'run')
+
+
+def _json(data_type, data):
+    data = dict(data, data_type=data_type, agent_id='agent', hostname='host',
+                run_id='run')
+    return json.loads(DateTimeJSONEncoder().encode(data))
+
+
+class TestCodec(TestCase):
+
+    def assertSameAsJSON(self, data_type, data):
+        message = codec.encode_event(HEADER, data_type, dict(data))
+        self.assertTrue(codec.is_binary(message))
+        self.assertEqual(codec.decode(message), _json(data_type, data))
+        return message
+
+    def test_add_hit(self):
+        hit = {'url': 'http://127.0.0.1/', 'method': 'GET', 'status': 200,
+               'started': datetime(2013, 6, 26, 10, 11, 12, 838224),
+               'elapsed': timedelta(seconds=0.4521),
+               'loads_status': (1, 2, 3, 4)}
+        message = self.assertSameAsJSON('add_hit', hit)
+        self.assertTrue(len(message) < len(json.dumps(_json('add_hit', hit))))
+
+        # unknown fields are kept
+        hit['size'] = 12
+        hit['loads_status'] = (1, None, 3, 4)
+        self.assertSameAsJSON('add_hit', hit)
+
+    def test_timed_hit(self):
+        hit = {'url': 'http://127.0.0.1/', 'method': 'GET', 'status': 200,
+               'started': datetime(2013, 6, 26, 10, 11, 12, 838224),
+               'elapsed': 0.25, 'loads_status': (1, 2, 3, 4),
+               'timings': {'dns': 0.0, 'connect': 0.01, 'tls': 0.0,
+                           'ttfb': 0.2, 'download': 0.04},
+               'sent': 120, 'received': 4096, 'lag': 0.5}
+        self.assertSameAsJSON('add_hit', hit)
+
+        # incomplete timings are sent as they are
+        hit['timings'] = {'ttfb': 0.2}
+        self.assertSameAsJSON('add_hit', hit)
+
+    def test_tests(self):
+        for data_type in ('startTest', 'stopTest', 'addSuccess'):
+            self.assertSameAsJSON(data_type, {'test': u'test_\xe9',
+                                              'loads_status': [1, 1, 1, 1]})
+
+        for data_type in ('addError', 'addFailure'):
+            self.assertSameAsJSON(data_type, {'test': 'test',
+                                              'loads_status': [1, 1, 1, 1],
+                                              'exc_info': ('a', 'b', 'tb')})
+
+    def test_phased_status(self):
+        hit = {'url': 'http://127.0.0.1/', 'method': 'GET', 'status': 200,
+               'started': datetime(2013, 6, 26, 10, 11, 12, 838224),
+               'elapsed': 0.25, 'loads_status': (1, 2, 3, 4, 'up')}
+        message = self.assertSameAsJSON('add_hit', hit)
+        # the fixed layout is used, not a JSON record
+        self.assertFalse('loads_status' in message)
+
+        for phase in ('steady', 'down'):
+            message = self.assertSameAsJSON('startTest', {
+                'test': 'test', 'loads_status': [1, 1, 1, 1, phase]})
+            self.assertFalse('loads_status' in message)
+
+        # unknown phases are sent as JSON
+        message = self.assertSameAsJSON('startTest', {
+            'test': 'test', 'loads_status': [1, 1, 1, 1, 'other']})
+        self.assertTrue('loads_status' in message)
+
+    def test_socket_message(self):
+        self.assertSameAsJSON('socket_message', {'size': 123})
+
+    def test_other_events_use_json_records(self):
+        self.assertSameAsJSON('startTestRun', {})
+        self.assertSameAsJSON('metric', {'test': 'test', 'agent_id': None,
+                                         'loads_status': (1, 1, 1, 1)})
+        # a loads_status that does not fit in the fixed layout
+        self.assertSameAsJSON('startTest', {'test': 'test',
+                                            'loads_status': ['1', '1', 1, 1]})
+        self.assertSameAsJSON('add_hit', {'url': 'http://127.0.0.1/',
+                                          'status': 'weird'})
+
+    def test_batch(self):
+        hit = {'url': 'http://127.0.0.1/', 'method': 'GET', 'status': 200,
+               'started': datetime(2013, 6, 26, 10, 11, 12),
+               'elapsed': 0.2, 'loads_status': [1, 1, 1, 1]}
+        counts = {'add_hit': [hit] * 10,
+                  'stopTestRun': [{}]}
+        message = codec.encode_batch(HEADER, counts)
+
+        # the url is only sent once
+        self.assertEqual(message.count('http://127.0.0.1/'), 1)
+        self.assertEqual(codec.decode(message), _json('batch',
+                                                      {'counts': counts}))
+
+    def test_json_messages(self):
+        message = json.dumps({'data_type': 'startTestRun'})
+        self.assertFalse(codec.is_binary(message))
+        self.assertEqual(codec.decode(message), {'data_type': 'startTestRun'})
+
+
+class TestBrokerPublisher(TestCase):
+
+    def test_published_in_json(self):
+        from loads.transport.broker import Broker
+
+        broker = mock.Mock()
+        hit = {'url': 'http://127.0.0.1/', 'method': 'GET', 'status': 200,
+               'started': datetime(2013, 6, 26, 10, 11, 12, 838224),
+               'elapsed': timedelta(seconds=0.4521),
+               'loads_status': (1, 2, 3, 4)}
+        message = codec.encode_event(HEADER, 'add_hit', dict(hit))
+        Broker._handle_recv.im_func(broker, [message])
+
+        # the subscribers get JSON, even from the agents sending binary
+        published, = broker._publisher.send.call_args[0]
+        self.assertEqual(json.loads(published), _json('add_hit', hit))
+        broker.ctrl.save_data.assert_called_with('agent',
+                                                 _json('add_hit', hit))
+
+        message = json.dumps(_json('add_hit', hit))
+        Broker._handle_recv.im_func(broker, [message])
+        broker._publisher.send.assert_called_with(message)
@@ -1,3 +1,7 @@
+import os
+import shutil
+import tempfile
+
 import unittest2
 from loads.db import get_backends, get_database, BaseDB
 try:
@@ -17,20 +21,62 @@ class TestDB(unittest2.TestCase):
     def test_get_backends(self):
         backends = get_backends()
         if NO_REDIS_LIB:
-            self.assertEqual(len(backends), 1)
-        else:
             self.assertEqual(len(backends), 2)
+        else:
+            self.assertEqual(len(backends), 3)
+        self.assertEqual(backends[1][0], 'sqlite')
 
     def test_get_database(self):
         db = get_database('python')
         self.assertTrue(db.ping())
 
+        tmp = tempfile.mkdtemp()
+        try:
+            db = get_database('sqlite', path=os.path.join(tmp, 'loads.db'))
+            self.assertTrue(db.ping())
+            db.close()
+        finally:
+            shutil.rmtree(tmp)
+
         if not NO_REDIS_RUNNING:
             db = get_database('redis')
             self.assertTrue(db.ping())
 
         self.assertRaises(NotImplementedError, get_database, 'cobol')
 
+    def _get_page(self, db):
+        try:
+            for i in range(10):
+                data_type = i % 2 and 'add_hit' or 'addError'
+                db.add({'run_id': '1', 'data_type': data_type, 'number': i})
+
+            data = db.get_data('1', data_type='add_hit', start=1, size=2)
+            return [line['number'] for line in data]
+        finally:
+            db.close()
+
+    def test_pages_of_a_data_type(self):
+        # the pages are within the events of the type, in all the backends
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+
+        db = get_database('python', directory=tmp, block_size=3)
+        self.assertEqual(self._get_page(db), [3, 5])
+
+        db = get_database('sqlite', path=os.path.join(tmp, 'loads.db'))
+        self.assertEqual(self._get_page(db), [3, 5])
+
+        if not NO_REDIS_RUNNING:
+            db = get_database('redis')
+            try:
+                # the newest events come first
+                self.assertEqual(self._get_page(db), [7, 5])
+            finally:
+                client = redis.StrictRedis()
+                client.delete('events:1', 'nevents:1', 'index:1:add_hit',
+                              'index:1:addError', 'counts:1', 'bcounts:1',
+                              'bvalues:1')
+
     def test_basedb(self):
         self.assertRaises(ValueError, BaseDB, None)
 
@@ -54,4 +100,6 @@ class TestDB(unittest2.TestCase):
         self.assertRaises(NotImplementedError, db2.get_counts, None)
         self.assertRaises(NotImplementedError, db2.get_data, None)
         self.assertRaises(NotImplementedError, db2.get_urls, None)
+        self.assertRaises(NotImplementedError, db2.get_timings, None)
+        self.assertRaises(NotImplementedError, db2.get_rollups, None)
         self.assertRaises(NotImplementedError, db2.flush)
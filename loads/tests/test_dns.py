@@ -0,0 +1,75 @@
+import socket
+import time
+
+import gevent
+import mock
+from unittest2 import TestCase
+
+from loads import dns
+
+
+_ADDRESSES = ['1.1.1.1', '2.2.2.2', '3.3.3.3']
+
+
+class TestResolver(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('loads.util.gevent_socket.gethostbyname_ex')
+        self.lookup = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.lookup.return_value = ('example.com', [], list(_ADDRESSES))
+
+    def test_round_robin(self):
+        resolver = dns.Resolver()
+        resolved = [resolver.resolve('example.com') for i in range(6)]
+        self.assertEqual(resolved, _ADDRESSES * 2)
+        self.assertEqual(self.lookup.call_count, 1)
+
+    def test_least_loaded(self):
+        resolver = dns.Resolver(policy='least-loaded')
+        first = resolver.resolve('example.com')
+        second = resolver.resolve('example.com')
+        self.assertNotEqual(first, second)
+
+        resolver.release(first)
+        self.assertEqual(resolver.resolve('example.com'), first)
+
+    def test_refreshed_in_the_background(self):
+        resolver = dns.Resolver(ttl=0.1)
+        resolver.resolve('example.com')
+        time.sleep(0.1)
+
+        # the expired addresses are used until the new ones are there.
+        self.lookup.return_value = ('example.com', [], ['4.4.4.4'])
+        self.assertTrue(resolver.resolve('example.com') in _ADDRESSES)
+        gevent.sleep(0)
+        self.assertEqual(resolver.resolve('example.com'), '4.4.4.4')
+        self.assertEqual(self.lookup.call_count, 2)
+
+    def test_negative_caching(self):
+        self.lookup.side_effect = socket.gaierror(-2, 'Name or service not '
+                                                      'known')
+        resolver = dns.Resolver(negative_ttl=0.1)
+        self.assertRaises(socket.gaierror, resolver.resolve, 'example.com')
+        self.assertRaises(socket.gaierror, resolver.resolve, 'example.com')
+        self.assertEqual(self.lookup.call_count, 1)
+
+        time.sleep(0.1)
+        self.lookup.side_effect = None
+        self.assertTrue(resolver.resolve('example.com') in _ADDRESSES)
+        self.assertEqual(self.lookup.call_count, 2)
+
+    def test_failed_refresh(self):
+        resolver = dns.Resolver(ttl=0)
+        resolver.resolve('example.com')
+
+        self.lookup.side_effect = socket.gaierror()
+        resolver.resolve('example.com')
+        gevent.sleep(0)
+        self.assertTrue(resolver.resolve('example.com') in _ADDRESSES)
+
+    def test_policies(self):
+        self.assertRaises(ValueError, dns.Resolver, policy='closest')
+        resolver = dns.get_resolver(policy='random')
+        self.assertTrue(resolver is dns.get_resolver(policy='random'))
+        self.assertFalse(resolver is dns.get_resolver())
@@ -1,10 +1,12 @@
 from unittest import TestCase
+import os
 import time
 
 import mock
 from zmq.eventloop import ioloop
 
 from loads.runners import ExternalRunner as ExternalRunner_
+from loads.transport.ring import RingBuffer
 from loads.util import json
 
 
@@ -216,3 +218,31 @@ class TestExternalRunner(TestCase):
                           ["LOADS_AGENT_ID", "LOADS_CURRENT_USER",
                            "LOADS_DURATION", "LOADS_RUN_ID",
                            "LOADS_TOTAL_USERS", "LOADS_ZMQ_RECEIVER"])
+
+    @mock.patch('loads.runners.external.subprocess.Popen',
+                lambda *args, **kwargs: FakeProcess(options=(args, kwargs)))
+    def test_shared_memory(self):
+        runner = ExternalRunner({'test_runner': 'foobar', 'hits': [1],
+                                 'users': [1], 'fqn': 'baz',
+                                 'shared_memory': True})
+        runner._test_result = mock.MagicMock()
+        runner.spawn_external_runner(1)
+
+        args, kwargs = runner._processes[0].options
+        endpoint = kwargs['env']['LOADS_ZMQ_RECEIVER']
+        self.assertTrue(endpoint.startswith('shm://'))
+
+        writer = RingBuffer.from_endpoint(endpoint)
+        writer.write(json.dumps({'data_type': 'socket_message', 'size': 1,
+                                 'run_id': 1}))
+        writer.close()
+
+        runner._read_rings()
+        runner.test_result.socket_message.assert_called_with(size=1)
+        self.assertEqual(len(runner._rings), 1)
+
+        # the ring is removed once the process is over
+        runner._processes[0]._running = False
+        runner._read_rings()
+        self.assertEqual(runner._rings, [])
+        self.assertFalse(os.path.exists(endpoint[len('shm://'):]))
@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+from unittest2 import TestCase
+
+from loads.runners import LocalRunner
+from loads.runners.local import _decode_event
+from loads.tests.support import get_runner_args
+from loads.transport import codec
+
+
+def _run(fqn, processes, rate=None, ramp_up=None, ramp_down=None,
+         **options):
+    args = get_runner_args(fqn=fqn, output=['null'], **options)
+    args['processes'] = processes
+    args['rate'] = rate
+    args['ramp_up'] = ramp_up
+    args['ramp_down'] = ramp_down
+    args['no_patching'] = True
+    runner = LocalRunner(args)
+    return runner, runner.execute()
+
+
+class TestLocalRunner(TestCase):
+
+    def test_processes(self):
+        for processes in (1, 2, 5):
+            runner, status = _run('loads.tests.jobs.SomeTests.test_counter',
+                                  processes, users='2:3', hits=2)
+            self.assertEqual(status, 0)
+
+            result = runner.test_result
+            self.assertEqual(result.nb_success, 10)
+            self.assertEqual(result.nb_finished_tests, 10)
+            self.assertEqual(result.get_counter('one'), 10)
+            self.assertEqual(sorted(test.user for test in
+                                    result._get_tests()), [2] * 4 + [3] * 6)
+
+    def test_processes_failures(self):
+        runner, status = _run('loads.tests.jobs.SomeTests.test_failure', 2,
+                              users=3)
+        self.assertEqual(status, 1)
+        self.assertEqual(runner.test_result.nb_failures, 3)
+
+    def test_processes_killed(self):
+        runner, status = _run('loads.tests.jobs.SomeTests.test_exit', 2,
+                              users=2)
+        self.assertEqual(status, 1)
+        self.assertEqual(len(runner.failed_workers), 2)
+
+    def test_ramp(self):
+        for processes in (1, 2):
+            runner, status = _run('loads.tests.jobs.SomeTests.test_wait',
+                                  processes, users='2:4', duration=1,
+                                  ramp_up=.3, ramp_down=.3)
+            self.assertEqual(status, 0)
+
+            result = runner.test_result
+            # the second step started with the ramp-down of the first one
+            self.assertTrue(1.6 < result.duration < 2, result.duration)
+            self.assertEqual(result.nb_finished_tests, result.nb_tests)
+
+            phases = [test.phase for test in result._get_tests()]
+            self.assertEqual(set(phases), set(['up', 'steady', 'down']))
+
+    def test_rate(self):
+        for processes in (1, 2):
+            runner, status = _run('loads.tests.jobs.SomeTests.test_counter',
+                                  processes, rate='1000:2000', users=2,
+                                  hits='5:10')
+            self.assertEqual(status, 0)
+
+            result = runner.test_result
+            self.assertEqual(result.nb_success, 15)
+            self.assertEqual(result.nb_lags, 15)
+            self.assertEqual(result.get_counter('one'), 15)
+            self.assertEqual(sorted(test.series for test in
+                                    result._get_tests()), [1] * 5 + [2] * 10)
+
+    def test_ramped_rate_needs_a_duration(self):
+        # rejected before the run starts
+        self.assertRaises(ValueError, _run,
+                          'loads.tests.jobs.SomeTests.test_counter', 1,
+                          rate='10-100', hits=5)
+
+    def test_decode_event(self):
+        started = datetime(2013, 6, 26, 10, 11, 12, 838224)
+        header = codec.encode_header('agent', 'host', 'run')
+        message = codec.encode_event(header, 'add_hit', {
+            'url': 'http://127.0.0.1/', 'method': 'GET', 'status': 200,
+            'started': started, 'elapsed': timedelta(seconds=.5),
+            'loads_status': [1, 1, 1, 1]})
+
+        # the events are the same as in a single process
+        data_type, data = _decode_event(message)
+        self.assertEqual(data_type, 'add_hit')
+        self.assertEqual(data, {'url': 'http://127.0.0.1/', 'method': 'GET',
+                                'status': 200, 'started': started,
+                                'elapsed': timedelta(seconds=.5),
+                                'loads_status': [1, 1, 1, 1]})
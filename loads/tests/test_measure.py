@@ -1,6 +1,9 @@
 import unittest2
 import functools
+import threading
 import mock
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
 
 from loads.measure import Session
 from loads import measure
@@ -54,6 +57,40 @@ class _TestResult(object):
         self.data.append(data)
 
 
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('OK')
+
+    def log_message(self, *args):
+        pass
+
+
+class _CloseHandler(_KeepAliveHandler):
+    protocol_version = 'HTTP/1.0'
+
+
+class _Connections(object):
+    def __init__(self):
+        self.hits = self.opened = 0
+        self.data = []
+
+    def add_hit(self, **data):
+        self.hits += 1
+        self.data.append(data)
+
+    def connection_open(self):
+        self.opened += 1
+
+
 class TestMeasure(unittest2.TestCase):
 
     def setUp(self):
@@ -69,7 +106,7 @@ class TestMeasure(unittest2.TestCase):
     def _send(self, *args, **kw):
         return _FakeResponse()
 
-    def _dns(self, url):
+    def _dns(self, url, resolver=None):
         return url, url, 'meh'
 
     def test_no_dns_resolve(self):
@@ -123,3 +160,79 @@ class TestMeasure(unittest2.TestCase):
 
         app.server_url = 'http://somewhere-else'
         self.assertEquals(app.server_url, 'http://somewhere-else')
+
+    def _serve(self, handler=_KeepAliveHandler):
+        server = _Server(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:%d/' % server.server_address[1]
+
+    def _get(self, url, adapter, count):
+        HTTPAdapter.send = self.old_send
+        test_result = _Connections()
+        session = Session(_FakeTest(), test_result, dns_resolve=False)
+        session.mount('http://', adapter)
+        for i in range(count):
+            session.get(url)
+        return test_result
+
+    def test_reused_connections(self):
+        url = self._serve()
+
+        test_result = self._get(url, measure.get_adapter('user'), 3)
+        self.assertEqual((test_result.hits, test_result.opened), (3, 1))
+
+        # the users of a process share the connections.
+        adapter = measure.get_adapter('process')
+        self._get(url, adapter, 1)
+        test_result = self._get(url, adapter, 2)
+        self.assertEqual((test_result.hits, test_result.opened), (2, 0))
+
+    def test_closed_connections(self):
+        # each request opens a connection
+        url = self._serve(_CloseHandler)
+        test_result = self._get(url, measure.get_adapter('process'), 3)
+        self.assertEqual((test_result.hits, test_result.opened), (3, 3))
+
+    def test_timings(self):
+        url = self._serve()
+        test_result = self._get(url, measure.get_adapter(), 2)
+
+        first, second = test_result.data
+        self.assertEqual(sorted(first['timings']),
+                         ['connect', 'dns', 'download', 'tls', 'ttfb'])
+        self.assertTrue(first['timings']['connect'] > 0)
+        self.assertTrue(first['timings']['ttfb'] > 0)
+        # the connection was reused
+        self.assertEqual(second['timings']['connect'], 0)
+        self.assertTrue(first['sent'] > len(url))
+        self.assertTrue(first['received'] > len('OK'))
+
+    def test_timings_no_connection(self):
+        response = _FakeResponse()
+        response.reason = 'OK'
+        response.raw = mock.Mock(spec=['headers', 'tell'])
+        response.raw.headers = {}
+        response.raw.tell.return_value = 2
+        HTTPAdapter.send = lambda *args, **kw: response
+
+        request = mock.Mock(method='GET', path_url='/', headers={},
+                            body=None)
+        response = measure.get_adapter().send(request)
+        self.assertEqual(response.opened, 0)
+        self.assertEqual((response.timings['connect'],
+                          response.timings['tls']), (0, 0))
+        self.assertEqual(response.received, 21)
+
+    def test_get_adapter(self):
+        self.assertFalse(measure.get_adapter() is measure.get_adapter())
+        adapter = measure.get_adapter('process')
+        self.assertTrue(adapter is measure.get_adapter('process'))
+        self.assertFalse(adapter is measure.get_adapter('process', 10))
+
+        adapter = measure.get_adapter('host', 10)
+        self.assertEqual(adapter._pool_maxsize, 10)
+        self.assertTrue(adapter._pool_block)
+        self.assertRaises(ValueError, measure.get_adapter, 'client')
@@ -28,7 +28,12 @@ class FakeTestResult(object):
         self.average_request_time = lambda: 0
         self.requests_per_second = lambda: 0
         self.opened_sockets = 0
+        self.opened_connections = 0
         self.socket_data_received = 0
+        self.relay_dropped = self.relay_delayed = 0
+        self.nb_lags = 0
+        self.phases = set()
+        self.timed_users = []
         self.nb_success = 0
         self.nb_errors = nb_errors
         self.nb_failures = nb_failures
@@ -38,6 +43,9 @@ class FakeTestResult(object):
         self.hits = []
         self.tests = {}
 
+    def get_address_counts(self):
+        return {}
+
     def get_url_metrics(self):
         return {'http://foo': {'average_request_time': 1.234,
                                'hits_success_rate': 23.},
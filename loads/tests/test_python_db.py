@@ -4,9 +4,16 @@ import os
 import shutil
 import tempfile
 import json
+import random
+import zlib
+
+import mock
+from gevent import monkey
 
 from zmq.green.eventloop import ioloop
-from loads.db._python import BrokerDB, read_zfile, get_dir_size
+from loads.db._python import (BrokerDB, Writer, read_zfile, get_dir_size,
+                              ZLIB_END)
+from loads.db._segments import read_segment
 
 
 _RUN_ID = '8b91dee8-0aec-4bb9-b0a0-87269a9c2874'
@@ -70,13 +77,13 @@ class TestBrokerDB(unittest2.TestCase):
         self.loop.add_timeout(time.time() + 2.1, self.loop.stop)
         self.loop.start()
 
-        # let's check if we got the data in the file
-        db = os.path.join(self.db.directory, '1-db.json')
-        data = [record for record, line in read_zfile(db)]
+        # let's check if we got the data in the files
+        self.assertTrue(os.path.exists(os.path.join(self.db.directory,
+                                                    '1-segment-00000.db')))
+        data = [record for number, record in self.db._get_store('1').read()]
         data.sort()
 
-        db = os.path.join(self.db.directory, '2-db.json')
-        data2 = [record for record, line in read_zfile(db)]
+        data2 = [record for number, record in self.db._get_store('2').read()]
         data2.sort()
 
         self.assertEqual(len(data), 14)
@@ -123,6 +130,105 @@ class TestBrokerDB(unittest2.TestCase):
         batch = list(self.db.get_data('1', start=2, size=5000))
         self.assertEqual(len(batch), 12)
 
+    def test_segments(self):
+        self.db.block_size = 10
+        self.db.segment_size = 300
+
+        for i in range(100):
+            data_type = i % 50 == 0 and 'addError' or 'add_hit'
+            self.db.add({'run_id': '1', 'data_type': data_type, 'number': i})
+            if i % 25 == 0:
+                self.db.flush()
+        self.db.flush()
+
+        store = self.db._get_store('1')
+        self.assertEqual(store.count, 100)
+        self.assertEqual(len(store.blocks), 13)
+        self.assertTrue(os.path.exists(store.get_segment_path(1)))
+
+        data = list(self.db.get_data('1', start=42, size=3))
+        self.assertEqual([line['number'] for line in data], [42, 43, 44])
+
+        data = list(self.db.get_data('1', start=95))
+        self.assertEqual([line['number'] for line in data], range(95, 100))
+
+        # only the blocks with errors are read
+        read = []
+        _read = store.read
+
+        def _reader(*args):
+            for number, record in _read(*args):
+                read.append(number)
+                yield number, record
+
+        store.read = _reader
+        data = list(self.db.get_data('1', data_type='addError'))
+        self.assertEqual([line['number'] for line in data], [0, 50])
+        self.assertEqual(read, [0] + range(46, 51))
+
+        # the index is reloaded from the disk
+        db2 = BrokerDB(self.loop, db='python', directory=self.tmp)
+        data = list(db2.get_data('1', start=49, size=2))
+        self.assertEqual([line['number'] for line in data], [49, 50])
+
+        self.assertFalse(self.db.is_summarized('1'))
+        self.db.summarize_run('1')
+        self.assertTrue(self.db.is_summarized('1'))
+        files = [name for name in os.listdir(self.tmp)
+                 if 'segment' in name or 'index' in name]
+        self.assertEqual(files, [])
+
+    def test_legacy_data(self):
+        # runs stored in a single file, one zlib record at a time.
+        headers = os.path.join(self.tmp, '1-headers.json')
+        with open(headers, 'w') as f:
+            json.dump({'0': 'data_type', '1': 'number'}, f)
+
+        with open(os.path.join(self.tmp, '1-db.json'), 'wb') as f:
+            for i in range(5):
+                line = json.dumps({'0': 'add_hit', '1': i})
+                f.write(zlib.compress(line) + ZLIB_END)
+
+        data = list(self.db.get_data('1', start=1, size=2))
+        self.assertEqual(data, [{'data_type': 'add_hit', 'number': 1},
+                                {'data_type': 'add_hit', 'number': 2}])
+
+        records = read_zfile(os.path.join(self.tmp, '1-db.json'))
+        self.assertEqual(len(list(records)), 5)
+
+    def test_markers_in_records(self):
+        # a compressed record can contain the ZLIB_END marker
+        rand = random.Random(0)
+        while True:
+            line = json.dumps({'value': '%x' % rand.getrandbits(800)})
+            compressed = zlib.compress(line)
+            if compressed.find(ZLIB_END, 2) != -1:
+                break
+
+        filename = os.path.join(self.tmp, '1-db.json')
+        with open(filename, 'wb') as f:
+            for i in range(3):
+                f.write(zlib.compress(line) + ZLIB_END)
+            # a truncated record
+            f.write(compressed[:-4])
+
+        lines = [line_ for record, line_ in read_zfile(filename)]
+        self.assertEqual(lines, [line] * 3)
+
+        open(filename, 'w').close()
+        self.assertEqual(list(read_zfile(filename)), [])
+
+    def test_read_segment(self):
+        self.db.block_size = 2
+        for i in range(5):
+            self.db.add({'run_id': '1', 'data_type': 'add_hit', 'number': i})
+        self.db.flush()
+
+        path = self.db._get_store('1').get_segment_path(0)
+        records = [self.db._uncompress_headers('1', record)['number']
+                   for record in read_segment(path)]
+        self.assertEqual(records, range(5))
+
     def test_metadata(self):
         self.assertEqual(self.db.get_metadata('1'), {})
         self.db.save_metadata('1', {'hey': 'ho'})
@@ -151,6 +257,154 @@ class TestBrokerDB(unittest2.TestCase):
         urls = self.db.get_urls('1')
         self.assertEqual(urls, {'http://127.0.0.1:9200/': 2})
 
+    def test_get_timings(self):
+        hits = [{'data_type': 'add_hit', 'run_id': '1', 'url': 'http://one',
+                 'timings': {'dns': 0, 'connect': 0.1, 'tls': 0, 'ttfb': 0.2,
+                             'download': 0}, 'sent': 10, 'received': 30},
+                {'data_type': 'add_hits', 'run_id': '1', 'url': 'http://one',
+                 'histogram': {'count': 1, 'buckets': {}},
+                 'timings': {'count': 1, 'connect': 0.1, 'ttfb': 0.4,
+                             'sent': 10, 'received': 10}},
+                {'data_type': 'add_hit', 'run_id': '1', 'url': 'http://two'}]
+
+        def add_data():
+            for data in hits:
+                self.db.add(dict(data))
+
+        self.loop.add_callback(add_data)
+        self.loop.add_timeout(time.time() + .5, self.loop.stop)
+        self.loop.start()
+
+        timings = self.db.get_timings('1')
+        self.assertEqual(timings.keys(), ['http://one'])
+        self.assertAlmostEqual(timings['http://one']['connect'], 0.1)
+        self.assertAlmostEqual(timings['http://one']['ttfb'], 0.3)
+        self.assertEqual(timings['http://one']['received'], 20)
+        self.assertEqual(self.db.get_timings('2'), {})
+
+    def test_get_rollups(self):
+        hit = {'data_type': 'add_hit', 'run_id': '1', 'url': 'http://one',
+               'status': 200, 'elapsed': 0.1}
+
+        with mock.patch('loads.db._python.time.time') as now:
+            now.return_value = 1000.5
+            self.db.add(dict(hit))
+            self.db.add(dict(hit, status=500))
+            self.db.flush()
+
+            # a late hit for the same second
+            self.db.add(dict(hit))
+            now.return_value = 1001.1
+            self.db.add(dict(hit, url='http://two'))
+
+        rollups = self.db.get_rollups('1')
+        self.assertEqual([(rollup['second'], rollup['url'], rollup['hits'],
+                           rollup['errors']) for rollup in rollups],
+                         [(1000, 'http://one', 3, 1),
+                          (1001, 'http://two', 1, 0)])
+        self.assertEqual(len(self.db.get_rollups('1', url='http://two')), 1)
+        self.assertEqual(len(self.db.get_rollups('1', start=1001)), 1)
+        self.assertEqual(self.db.get_rollups('2'), [])
+
+        # the rollups are kept once the details are gone
+        self.db.summarize_run('1')
+        rollups = self.db.get_rollups('1', step=10)
+        self.assertEqual([rollup['hits'] for rollup in rollups], [3, 1])
+        self.db.delete_run('1')
+        self.assertEqual(self.db.get_rollups('1'), [])
+
+    def test_writer(self):
+        self.db.queue_size = 10
+        for i in range(25):
+            self.db.add({'run_id': '1', 'data_type': 'add_hit', 'number': i})
+
+        # the records are handed to the writer every 10 records
+        self.assertEqual(self.db.get_metrics()['pending'], 5)
+        self.db.flush()
+        metrics = self.db.get_metrics()
+        self.assertEqual((metrics['writes'], metrics['pending']), (3, 0))
+        self.assertTrue(metrics['flush_duration']['max'] > 0)
+        self.assertTrue(metrics['ingest_latency']['max'] > 0)
+        self.assertEqual(len(list(self.db.get_data('1'))), 25)
+
+    def test_writer_thread(self):
+        get_ident = monkey.get_original('thread', 'get_ident')
+        write_files = self.db._write_files
+        threads = []
+
+        def _write_files(data):
+            threads.append(get_ident())
+            write_files(data)
+
+        self.db._write_files = _write_files
+        self.db.add({'run_id': '1', 'data_type': 'add_hit'})
+        self.db._write()
+
+        # the store and the schema of the run are not left to the writer
+        self.assertTrue('1' in self.db._stores)
+        self.assertTrue('1' in self.db._schemas)
+
+        self.db._wait()
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], get_ident())
+
+    def test_writer_error(self):
+        def write(data):
+            raise ValueError(data)
+
+        writer = Writer(write, 'data')
+        self.assertRaises(ValueError, writer.get)
+        self.assertTrue(writer.ready())
+
+    def test_busy_writer(self):
+        sleep = monkey.get_original('time', 'sleep')
+        write_files = self.db._write_files
+
+        def _write_files(data):
+            sleep(.2)
+            write_files(data)
+
+        self.db._write_files = _write_files
+        self.db.add({'run_id': '1', 'data_type': 'add_hit'})
+        self.db._write()
+
+        # the writer is busy: the next records are kept meanwhile
+        start = time.time()
+        self.db.add({'run_id': '1', 'data_type': 'add_hit'})
+        self.db._write()
+        self.assertTrue(time.time() - start < .1)
+        self.assertEqual(self.db.get_metrics()['pending'], 1)
+
+        self.db.flush()
+        self.assertEqual(self.db.get_counts('1'), {'add_hit': 2})
+        self.assertEqual(len(list(self.db.get_data('1'))), 2)
+
+    def test_summaries(self):
+        summaries = [
+            {'agent_id': _AGENT_ID, 'data_type': 'add_hits', 'run_id': '1',
+             'url': 'http://127.0.0.1:9200/', 'method': 'GET', 'status': 200,
+             'series': 1, 'histogram': {'count': 10, 'buckets': {}}},
+            {'agent_id': _AGENT_ID, 'data_type': 'add_tests', 'run_id': '1',
+             'test': 'test_es', 'series': 1, 'count': 5, 'success': 4,
+             'duration': 1.2},
+            {'agent_id': _AGENT_ID, 'data_type': 'relay_stats', 'run_id': '1',
+             'dropped': 3, 'delayed': 2}]
+
+        def add_data():
+            for data in summaries:
+                self.db.add(dict(data))
+
+        self.loop.add_callback(add_data)
+        self.loop.add_timeout(time.time() + .5, self.loop.stop)
+        self.loop.start()
+
+        self.assertEqual(self.db.get_urls('1'),
+                         {'http://127.0.0.1:9200/': 10})
+        self.assertEqual(self.db.get_counts('1'),
+                         {'add_hit': 10, 'startTest': 5, 'stopTest': 5,
+                          'addSuccess': 4, 'relay_stats': 1,
+                          'relay_dropped': 3, 'relay_delayed': 2})
+
     def test_get_errors(self):
         def add_data():
             for line in ONE_RUN:
@@ -174,31 +428,38 @@ class TestBrokerDB(unittest2.TestCase):
         self.assertEqual(len(errors), 2, errors)
 
     def test_compression(self):
-        headers_f = os.path.join(self.db.directory, 'run-id-headers.json')
-        headers = {"1": 'one', "2": 'two'}
-
-        with open(headers_f, 'w') as f:
-            f.write(json.dumps(headers))
-
+        schema_f = os.path.join(self.db.directory, 'run-id-schema.json')
         data = {'one': 'ok', 'two': 3, 'three': 'blah'}
-        self.db._update_headers('run-id')
+        self.db.add(dict(data, run_id='run-id'))
+        self.db.add(dict(data, run_id='run-id', two=4))
+        self.db.flush()
 
-        self.db.add({'run_id': 'run-id', 'one': 'ok', 'two': 3,
-                     'three': 'blah'})
+        # the keys are only saved once, and share a single layout
+        with open(schema_f) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(sorted(lines[0]['keys']),
+                         ['one', 'run_id', 'three', 'two'])
+        self.assertEqual(lines[0]['layouts'], [[0, 1, 2, 3]])
 
         result = self.db._compress_headers('run-id', data)
-        result = result.items()
-        result.sort()
-        self.assertEqual(result, [(1, 'ok'), (2, 3), (3, 'blah')])
-        self.db.flush()
+        self.assertEqual(result[0], 1)
+        self.assertEqual(self.db._uncompress_headers('run-id', result), data)
 
-        with open(headers_f) as f:
-            new_headers = json.loads(f.read())
-
-        wanted = [(1, u'one'), (2, u'two'), (3, u'three'), (4, u'run_id')]
-        new_headers = [(int(key), value) for key, value in new_headers.items()]
-        new_headers.sort()
-        self.assertEquals(new_headers, wanted)
+        self.db.add({'run_id': 'run-id', 'four': 4})
+        self.db.flush()
+        with open(schema_f) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1]['keys'], ['four'])
+        self.assertEqual(len(lines[1]['layouts']), 2)
+
+        # the schema is reloaded from the disk
+        db2 = BrokerDB(self.loop, db='python', directory=self.tmp)
+        records = sorted(record.get('two') for record in
+                         db2.get_data('run-id'))
+        self.assertEqual(records, [None, 3, 4])
+        self.assertEqual(db2._compress_headers('run-id', data)[0], 1)
 
     @unittest2.skipIf('TRAVIS' in os.environ, '')
     def test_max_size(self):
@@ -0,0 +1,45 @@
+import os
+import tempfile
+from unittest2 import TestCase
+
+from loads.runners.ramp import RampProfile, get_profile
+
+
+class TestRampProfiles(TestCase):
+
+    def test_linear(self):
+        profile = get_profile('linear')
+        self.assertEqual(profile.get_offsets(4, 2), [0, .5, 1, 1.5])
+        self.assertEqual(profile.get_time(1), 1)
+
+    def test_exponential(self):
+        offsets = get_profile('exponential').get_offsets(10, 1)
+        self.assertEqual(offsets[0], 0)
+        self.assertTrue(offsets[-1] < 1)
+
+        # the users are started more and more often
+        intervals = [b - a for a, b in zip(offsets, offsets[1:])]
+        self.assertEqual(intervals, sorted(intervals, reverse=True))
+
+    def test_file(self):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, '# a slow start\n0 0\n0.5 0.1\n\n1 1\n')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        profile = get_profile(path)
+        self.assertEqual(profile.points, [(0, 0), (.5, .1), (1, 1)])
+        self.assertEqual(profile.get_time(.1), .5)
+        self.assertEqual(profile.get_time(.55), .75)
+
+        with open(path, 'w') as f:
+            f.write('0 0\nfoo\n')
+        self.assertRaises(ValueError, get_profile, path)
+
+    def test_flat_parts(self):
+        profile = RampProfile([(.5, 0), (.5, 1)])
+        self.assertEqual(profile.get_offsets(2, 1), [0, .5])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, RampProfile, [(.5, .8), (.6, .2)])
+        self.assertRaises(ValueError, RampProfile, [(.5, 2)])
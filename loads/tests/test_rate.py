@@ -0,0 +1,51 @@
+import math
+from unittest2 import TestCase
+
+from loads.runners.rate import parse_rates, get_launch_times
+
+
+class TestRates(TestCase):
+
+    def test_parse_rates(self):
+        self.assertEqual(parse_rates('10'), [(10., 10.)])
+        self.assertEqual(parse_rates(5), [(5., 5.)])
+        self.assertEqual(parse_rates('10-50:50'), [(10., 50.), (50., 50.)])
+        self.assertEqual(parse_rates([(0, 10)]), [(0., 10.)])
+
+        for rates in ('0', 'foo', '10:-', '1-2-3'):
+            self.assertRaises(ValueError, parse_rates, rates)
+
+    def test_fixed_rate(self):
+        times = list(get_launch_times(4, 4, duration=1))
+        self.assertEqual(times, [0, .25, .5, .75])
+
+        times = list(get_launch_times(2, 2, count=3))
+        self.assertEqual(times, [0, .5, 1.])
+
+    def test_ramped_rate(self):
+        times = list(get_launch_times(0, 20, duration=2))
+        # 20 launches in all, more and more often.
+        self.assertEqual(len(times), 20)
+        intervals = [b - a for a, b in zip(times, times[1:])]
+        self.assertEqual(intervals, sorted(intervals, reverse=True))
+
+        times = list(get_launch_times(20, 0, duration=2))
+        self.assertEqual(len(times), 20)
+        self.assertTrue(times[-1] < 2)
+        intervals = [b - a for a, b in zip(times, times[1:])]
+        self.assertEqual(intervals, sorted(intervals))
+
+    def test_decreasing_rate(self):
+        # 1.5 launches in all: the second one is at 1 - sqrt(1 / 3)
+        times = list(get_launch_times(3., 0., duration=1))
+        self.assertEqual(len(times), 2)
+        self.assertEqual(times[0], 0)
+        self.assertAlmostEqual(times[1], 1 - math.sqrt(1 / 3.))
+
+        times = list(get_launch_times(5, 2, duration=3))
+        self.assertEqual(len(times), 11)
+        self.assertTrue(times[-1] < 3)
+
+    def test_ramped_rate_needs_a_duration(self):
+        self.assertRaises(ValueError, list, get_launch_times(1, 2, count=3))
+        self.assertRaises(ValueError, list, get_launch_times(1, 1))
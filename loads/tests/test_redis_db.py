@@ -1,6 +1,7 @@
 import unittest2
 import time
 
+import mock
 from zmq.green.eventloop import ioloop
 try:
     from loads.db._redis import RedisDB
@@ -14,16 +15,20 @@ from loads.tests.test_python_db import ONE_RUN
 from loads.util import json
 
 
-_KEYS = ['errors:1', 'errors:2', 'data:1', 'data:2', 'counters:1',
-         'counters:2', 'bcounters:1',
-         'bcounters:2', 'metadata:1', 'metadata:2',
-         'urls:1', 'urls:2']
+_KEYS = ['events:1', 'events:2', 'nevents:1', 'nevents:2', 'counts:1',
+         'counts:2', 'bcounts:1', 'bcounts:2', 'bvalues:1', 'bvalues:2',
+         'metadata:1', 'metadata:2', 'urls:1', 'urls:2']
 
 
-for type_ in ('addSuccess', 'stopTestRun', 'stopTest',
-              'startTest', 'startTestRun', 'add_hit'):
-    _KEYS.append('count:1:%s' % type_)
-    _KEYS.append('count:2:%s' % type_)
+for type_ in ('addSuccess', 'addError', 'stopTestRun', 'stopTest',
+              'startTest', 'startTestRun', 'add_hit', 'unknown'):
+    _KEYS.append('index:1:%s' % type_)
+    _KEYS.append('index:2:%s' % type_)
+
+# the keys of the runs stored before the events were numbered
+_OLD_KEYS = ['data:3', 'errors:3', 'counters:3', 'count:3:add_hit',
+             'count:3:addError', 'urls:3', 'url:3:http://one',
+             'bcounters:3']
 
 
 @unittest2.skipIf(NO_TEST, 'No redis')
@@ -33,26 +38,24 @@ class TestRedisDB(unittest2.TestCase):
         self.loop = ioloop.IOLoop()
         self.db = RedisDB(self.loop)
         self._redis = redis.StrictRedis()
+        self._hashes = []
 
     def tearDown(self):
+        self.db.close()
         self.loop.close()
-        for md5 in self._redis.smembers('bcounters:1'):
-            self._redis.delete('bcount:1:%s' % md5)
-
-        for md5 in self._redis.smembers('bcounters:2'):
-            self._redis.delete('bcount:1:%s' % md5)
 
-        for url in self._redis.smembers('urls:2'):
-            self._redis.delete('url:2:%s' % url)
+        for run in ('1', '2'):
+            for member in self._redis.smembers('rollups:%s' % run):
+                self._redis.delete('rollup:%s:%s' % (run, member))
+            self._redis.delete('rollups:%s' % run)
 
-        for url in self._redis.smembers('urls:1'):
-            self._redis.delete('url:1:%s' % url)
+        for url in self._redis.hkeys('urls:1'):
+            self._redis.delete('timings:1:%s' % url)
 
-        for key in _KEYS:
+        for key in _KEYS + _OLD_KEYS:
             self._redis.delete(key)
-
-        self.db.flush()
-        self.db.close()
+        for hash in self._hashes:
+            self._redis.delete('bcount:3:%s' % hash, 'bvalue:3:%s' % hash)
 
     def test_brokerdb(self):
         self.assertEqual(list(self.db.get_data('swwqqsw')), [])
@@ -73,12 +76,10 @@ class TestRedisDB(unittest2.TestCase):
         self.loop.start()
 
         # let's check if we got the data in the file
-        data = [json.loads(self._redis.lindex('data:1', i))
-                for i in range(self._redis.llen('data:1'))]
+        data = [json.loads(line) for line in self._redis.hvals('events:1')]
         data.sort()
 
-        data2 = [json.loads(self._redis.lindex('data:2', i))
-                 for i in range(self._redis.llen('data:2'))]
+        data2 = [json.loads(line) for line in self._redis.hvals('events:2')]
         data2.sort()
 
         self.assertEqual(len(data), 14)
@@ -121,6 +122,99 @@ class TestRedisDB(unittest2.TestCase):
         batch = list(self.db.get_data('1', start=2, size=5000))
         self.assertEqual(len(batch), 12)
 
+    def test_batches(self):
+        self.db.batch_size = 10
+        execute = mock.Mock(wraps=redis.client.Pipeline.execute)
+
+        with mock.patch.object(redis.client.Pipeline, 'execute',
+                               lambda pipeline: execute(pipeline)):
+            for i in range(25):
+                self.db.add({'run_id': '1', 'data_type': 'add_hit',
+                             'url': 'http://one', 'status': 200})
+
+            # the events are sent every 10 events, and when they are read
+            self.assertEqual(execute.call_count, 2)
+            self.assertEqual(self._redis.hlen('events:1'), 20)
+            self.assertEqual(self.db.get_counts('1'), {'add_hit': 25})
+            self.assertEqual(execute.call_count, 3)
+
+        self.assertEqual(self.db.get_urls('1'), {'http://one': 25})
+        res = list(self.db.get_data('1', groupby=True))
+        self.assertEqual([line['count'] for line in res], [25])
+
+    def test_read_chunks(self):
+        self.db.read_size = 3
+        for i in range(10):
+            data_type = i % 2 and 'add_hit' or 'addError'
+            self.db.add({'run_id': '1', 'data_type': data_type, 'number': i})
+
+        with mock.patch.object(self.db._redis, 'hmget',
+                               wraps=self.db._redis.hmget) as hmget:
+            # the newest events come first
+            data = list(self.db.get_data('1'))
+            self.assertEqual([line['number'] for line in data],
+                             range(9, -1, -1))
+            self.assertEqual(hmget.call_count, 4)
+
+            data = list(self.db.get_data('1', start=2, size=4))
+            self.assertEqual([line['number'] for line in data], [7, 6, 5, 4])
+            self.assertEqual(hmget.call_count, 6)
+
+        # the events of a type are found with their index
+        data = list(self.db.get_data('1', data_type='add_hit', start=1,
+                                     size=2))
+        self.assertEqual([line['number'] for line in data], [7, 5])
+        self.assertEqual(self._redis.hlen('events:1'), 10)
+        errors = list(self.db.get_errors('1', start=4))
+        self.assertEqual([line['number'] for line in errors], [0])
+
+        with mock.patch.object(self.db._redis, 'hmget',
+                               wraps=self.db._redis.hmget) as hmget:
+            groups = list(self.db.get_data('1', groupby=True))
+            self.assertEqual(sorted(line['number'] for line in groups),
+                             range(10))
+            self.assertEqual(hmget.call_count, 4)
+
+        groups = list(self.db.get_data('1', data_type='add_hit',
+                                       groupby=True))
+        self.assertEqual(len(groups), 5)
+        self.assertEqual(list(self.db.get_data('2')), [])
+
+    def test_old_runs(self):
+        # a run stored before the events were numbered
+        hit = {'run_id': '3', 'data_type': 'add_hit', 'url': 'http://one'}
+        error = {'run_id': '3', 'data_type': 'addError'}
+        for data in (hit, error, hit):
+            dumped = json.dumps(data)
+            self._redis.lpush('data:3', dumped)
+            if data is error:
+                self._redis.lpush('errors:3', dumped)
+
+            counter = 'count:3:%s' % data['data_type']
+            self._redis.sadd('counters:3', counter)
+            self._redis.incrby(counter, 1)
+
+            hash = str(len(dumped))
+            self._hashes.append(hash)
+            self._redis.sadd('bcounters:3', hash)
+            self._redis.incrby('bcount:3:%s' % hash, 1)
+            self._redis.set('bvalue:3:%s' % hash, dumped)
+        self._redis.sadd('urls:3', 'http://one')
+        self._redis.incrby('url:3:http://one', 2)
+
+        self.assertEqual(self.db.get_counts('3'),
+                         {'add_hit': 2, 'addError': 1})
+        self.assertEqual(self.db.get_urls('3'), {'http://one': 2})
+        self.assertEqual(self.db.get_timings('3'), {})
+        self.assertEqual(len(list(self.db.get_data('3'))), 3)
+        self.assertEqual(list(self.db.get_data('3', data_type='addError')),
+                         [error])
+        self.assertEqual(list(self.db.get_errors('3')), [error])
+
+        groups = list(self.db.get_data('3', data_type='add_hit',
+                                       groupby=True))
+        self.assertEqual([group['count'] for group in groups], [2])
+
     def test_metadata(self):
         self.assertEqual(self.db.get_metadata('1'), {})
         self.db.save_metadata('1', {'hey': 'ho'})
@@ -148,6 +242,29 @@ class TestRedisDB(unittest2.TestCase):
         urls = self.db.get_urls('1')
         self.assertEqual(urls, {'http://127.0.0.1:9200/': 2})
 
+    def test_get_timings(self):
+        hit = {'data_type': 'add_hit', 'run_id': '1', 'url': 'http://one',
+               'timings': {'dns': 0, 'connect': 0.1, 'tls': 0, 'ttfb': 0.2,
+                           'download': 0}, 'sent': 10, 'received': 30}
+        self.db.add(dict(hit))
+        hit['timings'] = dict(hit['timings'], ttfb=0.4)
+        self.db.add(dict(hit))
+
+        timings = self.db.get_timings('1')
+        self.assertAlmostEqual(timings['http://one']['ttfb'], 0.3)
+        self.assertEqual(timings['http://one']['received'], 30)
+
+    def test_get_rollups(self):
+        hit = {'data_type': 'add_hit', 'run_id': '1', 'url': 'http://one',
+               'status': 200, 'elapsed': 0.1}
+        self.db.add(dict(hit))
+        self.db.add(dict(hit, status=500, elapsed=0.3))
+
+        rollups = self.db.get_rollups('1', url='http://one')
+        self.assertEqual(sum([rollup['hits'] for rollup in rollups]), 2)
+        self.assertEqual(sum([rollup['errors'] for rollup in rollups]), 1)
+        self.assertEqual(self.db.get_rollups('1', url='http://two'), [])
+
     def test_get_errors(self):
         def add_data():
             for line in ONE_RUN:
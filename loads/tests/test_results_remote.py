@@ -26,3 +26,38 @@ class TestRemoteTestResult(TestCase):
         remote = RemoteTestResult(args=args)
         self.assertEqual(list(remote.errors), [])
         self.assertEqual(list(remote.failures), [])
+
+    def test_sync(self):
+        client = remote.Client.return_value
+        client.get_counts_since.side_effect = [
+            {'version': 'v1', 'counts': {'add_hit': 2, 'startTest': 1},
+             'delta': False},
+            {'version': 'v2', 'counts': {'add_hit': 3}, 'delta': True},
+            {'version': 'v3', 'counts': {'add_hit': 1}, 'delta': False}]
+
+        args = {'agents': 1, 'broker': 'tcp://example.com:999'}
+        result = RemoteTestResult(args=args)
+        result.sync('run')
+        result.sync('run')
+        self.assertEqual(result.nb_hits, 5)
+        self.assertEqual(result.nb_tests, 1)
+        client.get_counts_since.assert_called_with('run', 'v1')
+
+        # the counts are replaced when they are not a delta
+        result.sync('other')
+        client.get_counts_since.assert_called_with('other', None)
+        self.assertEqual(result.nb_hits, 1)
+        self.assertEqual(result.nb_tests, 0)
+
+    def test_relay_stats(self):
+        client = remote.Client.return_value
+        client.get_counts_since.return_value = {
+            'version': 'v1', 'delta': False,
+            'counts': {'relay_stats': 2, 'relay_dropped': 5,
+                       'relay_delayed': 3}}
+
+        args = {'agents': 1, 'broker': 'tcp://example.com:999'}
+        result = RemoteTestResult(args=args)
+        result.sync('run')
+        self.assertEqual(result.relay_dropped, 5)
+        self.assertEqual(result.relay_delayed, 3)
@@ -1,15 +1,31 @@
 from unittest2 import TestCase
+import os
 import traceback
+import socket
+import tempfile
 from StringIO import StringIO
 import zmq.green as zmq
+import gevent
 
-from loads.results import ZMQTestResult
+from loads.results import ZMQTestResult, ZMQSummarizedTestResult
+from loads.transport import codec
+from loads.transport.ring import RingBuffer
 from loads.tests.support import get_tb, hush
 from loads.util import json
 
 import mock
 
 
+class _OverloadedRelay(ZMQTestResult):
+    def _init_socket(self):
+        self._push = self.context.socket(zmq.PUSH)
+        # don't queue the messages until the receiver is there.
+        self._push.setsockopt(zmq.IMMEDIATE, 1)
+        self._push.connect(self.args['zmq_receiver'])
+        self._poller = zmq.Poller()
+        self._poller.register(self._push, zmq.POLLOUT)
+
+
 class TestZmqRelay(TestCase):
 
     def setUp(self):
@@ -139,3 +155,193 @@ class TestZmqRelay(TestCase):
         self.context.destroy()
         args = {'foo': 'bar', 'baz': 'foobar'}
         self.assertRaises(zmq.ZMQError, self.relay.add_hit, **args)
+
+    def test_binary_encoding(self):
+        relay = ZMQTestResult(args={'zmq_receiver': 'inproc://ok',
+                                    'zmq_context': self.context,
+                                    'zmq_encoding': 'binary',
+                                    'agent_id': 'agent'})
+        relay.add_hit(url='http://127.0.0.1', method='GET', status=200,
+                      started=None, elapsed=0.1, loads_status=(1, 1, 1, 1))
+
+        recv = self._pull.recv()
+        self.assertTrue(codec.is_binary(recv))
+        wanted = {'url': 'http://127.0.0.1', 'status': 200,
+                  'data_type': 'add_hit', 'agent_id': 'agent'}
+        self.assertDictContainsSubset(wanted, codec.decode(recv))
+
+    def test_unknown_encoding(self):
+        self.assertRaises(ValueError, ZMQTestResult,
+                          args={'zmq_receiver': 'inproc://ok2',
+                                'zmq_context': self.context,
+                                'zmq_encoding': 'xml'})
+
+    def test_summarized_hits(self):
+        relay = ZMQSummarizedTestResult(args={'zmq_receiver': 'inproc://ok',
+                                              'zmq_context': self.context,
+                                              'aggregate_hits': True})
+        for i in range(10):
+            relay.add_hit(url='http://127.0.0.1', method='GET', status=200,
+                          started=None, elapsed=0.1,
+                          loads_status=(1, 1, i, 1))
+        relay._dump_data(loop=False)
+
+        recv = json.loads(self._pull.recv())
+        self.assertEqual(recv['data_type'], 'batch')
+        hits, = recv['counts']['add_hits']
+        self.assertEqual(hits['histogram']['count'], 10)
+        self.assertFalse('add_hit' in recv['counts'])
+
+    def test_summarized_lags_and_connections(self):
+        relay = ZMQSummarizedTestResult(args={'zmq_receiver': 'inproc://ok',
+                                              'zmq_context': self.context,
+                                              'aggregate_hits': True})
+        for i in range(10):
+            relay.add_lag(i / 100., (1, 1, i, 1))
+            relay.connection_open()
+        relay._dump_data(loop=False)
+
+        # only the summaries are sent
+        recv = json.loads(self._pull.recv())
+        self.assertEqual(sorted(recv['counts']),
+                         ['add_lags', 'connection_open'])
+        lags, = recv['counts']['add_lags']
+        self.assertEqual(lags['histogram']['count'], 10)
+        self.assertEqual(recv['counts']['connection_open'], [{'count': 10}])
+
+    def _get_overloaded_relay(self, **args):
+        # nobody is listening on this endpoint yet, so the relay can't send.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.endpoint = 'tcp://127.0.0.1:%d' % sock.getsockname()[1]
+        sock.close()
+
+        args.update({'zmq_receiver': self.endpoint,
+                     'zmq_context': self.context})
+        return _OverloadedRelay(args=args)
+
+    def test_overload_block(self):
+        relay = self._get_overloaded_relay()
+        pull = self.context.socket(zmq.PULL)
+        gevent.spawn_later(.1, pull.bind, self.endpoint)
+
+        relay.startTestRun()
+        self.assertEqual(json.loads(pull.recv())['data_type'],
+                         'startTestRun')
+        self.assertEqual((relay.dropped, relay.delayed), (0, 1))
+
+    def test_overload_drop(self):
+        relay = self._get_overloaded_relay(zmq_overload='drop',
+                                           zmq_spill_size=5)
+        for i in range(10):
+            relay.socket_message(i)
+        self.assertEqual((relay.dropped, relay.delayed), (5, 5))
+
+        pull = self.context.socket(zmq.PULL)
+        pull.bind(self.endpoint)
+
+        # the spilled events are sent first, then the counters
+        relay._flush_spill(block=True)
+        sizes = [json.loads(pull.recv())['size'] for i in range(5)]
+        self.assertEqual(sizes, range(5))
+
+        relay.stopTestRun()
+        recv = json.loads(pull.recv())
+        self.assertEqual((recv['data_type'], recv['dropped'],
+                          recv['delayed']), ('relay_stats', 5, 5))
+        self.assertEqual(json.loads(pull.recv())['data_type'],
+                         'stopTestRun')
+
+    def test_overload_sample(self):
+        relay = self._get_overloaded_relay(zmq_overload='sample',
+                                           zmq_spill_size=2,
+                                           zmq_sample_rate=3)
+        waited = []
+        relay._try_send = lambda message: False
+        relay._wait_send = waited.append
+
+        for i in range(10):
+            relay.socket_message(i)
+
+        # the sampled events replace the oldest ones, without waiting
+        self.assertEqual(waited, [])
+        sizes = [json.loads(message)['size'] for message in relay._spill]
+        self.assertEqual(sizes, [5, 8])
+        self.assertEqual((relay.dropped, relay.delayed), (8, 5))
+
+    def test_report_not_lost(self):
+        relay = self._get_overloaded_relay(zmq_overload='drop',
+                                           zmq_spill_size=5)
+        for i in range(10):
+            relay.socket_message(i)
+
+        pull = self.context.socket(zmq.PULL)
+        pull.bind(self.endpoint)
+        relay._flush_spill(block=True)
+        for i in range(5):
+            pull.recv()
+
+        # a report that can't be sent is kept for later
+        try_send = relay._try_send
+        relay._try_send = lambda message: False
+        self.assertFalse(relay._report())
+        relay._try_send = try_send
+        self.assertEqual(relay._reported, (0, 0))
+
+        # and goes with the next event sent
+        relay._last_report = 0
+        relay.socket_message(10)
+        self.assertEqual(json.loads(pull.recv())['size'], 10)
+        recv = json.loads(pull.recv())
+        self.assertEqual((recv['data_type'], recv['dropped'],
+                          recv['delayed']), ('relay_stats', 5, 5))
+
+        # the counters are not reported twice
+        relay.stopTestRun()
+        self.assertEqual(json.loads(pull.recv())['data_type'],
+                         'stopTestRun')
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, self._get_overloaded_relay,
+                          zmq_overload='panic')
+
+    def test_shared_memory(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        ring = RingBuffer(path, create=True)
+        self.addCleanup(ring.unlink)
+
+        relay = ZMQTestResult(args={'zmq_receiver': ring.endpoint,
+                                    'agent_id': 'agent'})
+        relay.socket_message(123)
+        relay.stopTestRun()
+        relay.close()
+
+        messages = ring.read()
+        self.assertTrue(all(codec.is_binary(message) for message in messages))
+        events = [codec.decode(message) for message in messages]
+        self.assertEqual([event['data_type'] for event in events],
+                         ['socket_message', 'stopTestRun'])
+        self.assertEqual(events[0]['size'], 123)
+
+    def test_shared_memory_big_event(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        ring = RingBuffer(path, slots=8, slot_size=64, create=True)
+        self.addCleanup(ring.unlink)
+
+        # the event takes more than half of the ring buffer
+        relay = ZMQTestResult(args={'zmq_receiver': ring.endpoint,
+                                    'agent_id': 'agent'})
+        relay.addFailure('test', ('x' * 300, ValueError, None),
+                         (1, 1, 1, 1))
+        relay.close()
+
+        event, = [codec.decode(message) for message in ring.read()]
+        self.assertEqual(event['data_type'], 'addFailure')
+        self.assertEqual(event['exc_info'][0], 'x' * 300)
+
+    def test_detach(self):
+        self.relay.detach()
+        self.relay.socket_message(123)
+        self.assertRaises(zmq.Again, self._pull.recv, zmq.NOBLOCK)
@@ -0,0 +1,97 @@
+import os
+import tempfile
+from unittest2 import TestCase
+
+from loads.transport.ring import RingBuffer
+
+
+class TestRingBuffer(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.ring = RingBuffer(self.path, slots=4, slot_size=16, create=True)
+
+    def tearDown(self):
+        self.ring.unlink()
+
+    def test_write_read(self):
+        self.assertEqual(self.ring.read(), [])
+        self.assertTrue(self.ring.write('foo'))
+        self.assertTrue(self.ring.write('b' * 20))
+        self.assertEqual(len(self.ring), 3)
+
+        self.assertEqual(self.ring.read(), ['foo', 'b' * 20])
+        self.assertEqual(len(self.ring), 0)
+        self.assertEqual(self.ring.read(), [])
+
+    def test_full(self):
+        for i in range(4):
+            self.assertTrue(self.ring.write(str(i)))
+        self.assertFalse(self.ring.write('4'))
+
+        self.assertEqual(self.ring.read(), ['0', '1', '2', '3'])
+        self.assertTrue(self.ring.write('4'))
+
+    def test_wraparound(self):
+        for i in range(3):
+            self.ring.write(str(i))
+        self.ring.read()
+
+        # the last slot is skipped, since the message needs two.
+        self.assertTrue(self.ring.write('x' * 20))
+        self.assertEqual(len(self.ring), 3)
+        self.assertTrue(self.ring.write('y'))
+        self.assertFalse(self.ring.write('z'))
+        self.assertEqual(self.ring.read(), ['x' * 20, 'y'])
+
+    def test_big_message(self):
+        # more than half of the slots, and more than the whole buffer
+        message = ''.join(chr(ord('a') + i % 26) for i in range(100))
+        self.assertTrue(self.ring.write(message[:40]))
+        self.assertEqual(self.ring.read(), [message[:40]])
+
+        # the first parts are written, the reader waits for the others
+        writes = 1
+        while not self.ring.write(message):
+            self.assertEqual(self.ring.read(), [])
+            writes += 1
+        self.assertEqual(writes, 3)
+        self.assertEqual(self.ring.read(), [message])
+        self.assertTrue(self.ring.write('foo'))
+        self.assertEqual(self.ring.read(), ['foo'])
+
+    def test_big_message_replaced(self):
+        message = 'x' * 100
+        self.assertFalse(self.ring.write(message))
+        self.ring.read()
+
+        # a message partly written is finished before the next one
+        self.assertFalse(self.ring.write('foo'))
+        self.assertEqual(self.ring.read(), [message])
+        self.assertTrue(self.ring.write('foo'))
+        self.assertEqual(self.ring.read(), ['foo'])
+
+    def test_biggest_message_always_fits(self):
+        for start in range(4):
+            for i in range(start):
+                self.ring.write(str(i))
+            self.ring.read()
+
+            self.assertTrue(self.ring.write('x' * 28))
+            self.assertEqual(self.ring.read(), ['x' * 28])
+
+    def test_from_endpoint(self):
+        self.assertEqual(self.ring.endpoint, 'shm://' + self.path)
+        writer = RingBuffer.from_endpoint(self.ring.endpoint)
+        self.assertEqual((writer.slots, writer.slot_size), (4, 16))
+        writer.write('foo')
+        writer.close()
+        self.assertEqual(self.ring.read(), ['foo'])
+
+        self.assertRaises(ValueError, RingBuffer.from_endpoint, self.path)
+
+    def test_not_a_ring(self):
+        with open(self.path, 'wb') as f:
+            f.write('x' * 1024)
+        self.assertRaises(ValueError, RingBuffer, self.path)
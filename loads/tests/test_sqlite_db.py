@@ -0,0 +1,228 @@
+import unittest2
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import mock
+from zmq.green.eventloop import ioloop
+
+from loads.db._sqlite import SQLiteDB
+from loads.tests.test_python_db import ONE_RUN
+
+
+class TestSQLiteDB(unittest2.TestCase):
+
+    def setUp(self):
+        self.loop = ioloop.IOLoop()
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'loads.db')
+        self.db = SQLiteDB(self.loop, path=self.path)
+
+    def tearDown(self):
+        self.db.close()
+        self.loop.close()
+        shutil.rmtree(self.tmp)
+
+    def _add_data(self):
+        for line in ONE_RUN:
+            data = dict(line)
+            data['run_id'] = '1'
+            self.db.add(data)
+            data['run_id'] = '2'
+            self.db.add(data)
+
+    def test_brokerdb(self):
+        self.assertEqual(list(self.db.get_data('swwqqsw')), [])
+        self.assertTrue(self.db.ping())
+
+        self.loop.add_callback(self._add_data)
+        self.loop.add_callback(self._add_data)
+        self.loop.add_timeout(time.time() + .5, self.loop.stop)
+        self.loop.start()
+
+        # the events were inserted by the periodic flush
+        conn = sqlite3.connect(self.path)
+        count, = conn.execute('SELECT COUNT(*) FROM events '
+                              'WHERE run_id = "1"').fetchone()
+        self.assertEqual(count, 14)
+        conn.close()
+
+        counts = self.db.get_counts('1')
+        for type_ in ('addSuccess', 'stopTestRun', 'stopTest',
+                      'startTest', 'startTestRun', 'add_hit'):
+            self.assertEqual(counts[type_], 2)
+
+        batch = list(self.db.get_data('1', size=2))
+        self.assertEqual(len(batch), 2)
+
+        batch = list(self.db.get_data('1', start=2))
+        self.assertEqual(len(batch), 12)
+
+        batch = list(self.db.get_data('1', start=2, size=5))
+        self.assertEqual(len(batch), 5)
+
+        # filtered
+        data = list(self.db.get_data('1', data_type='add_hit'))
+        self.assertEqual(len(data), 2)
+
+        # group by
+        res = list(self.db.get_data('1', groupby=True))
+        self.assertEqual(len(res), 7)
+        self.assertEqual(res[0]['count'], 2)
+        self.assertEqual(res[0]['data_type'], 'startTestRun')
+
+        res = list(self.db.get_data('1', data_type='add_hit', groupby=True))
+        self.assertEqual(res[0]['count'], 2)
+
+        # the events of the window are grouped
+        res = list(self.db.get_data('1', groupby=True, start=0, size=8))
+        self.assertEqual([line['count'] for line in res], [2] + [1] * 6)
+
+        self.assertEqual(self.db.get_runs(), ['1', '2'])
+        self.assertEqual(len(list(self.db.get_errors('2'))), 2)
+        self.assertEqual(self.db.get_urls('1'),
+                         {'http://127.0.0.1:9200/': 2})
+
+    def test_batches(self):
+        self.db.batch_size = 10
+        for i in range(25):
+            self.db.add({'run_id': '1', 'data_type': 'add_hit',
+                         'url': 'http://one', 'status': 200, 'number': i})
+
+        # the events are inserted every 10 events, and when they are read
+        count, = self.db._query('SELECT COUNT(*) FROM events').fetchone()
+        self.assertEqual(count, 20)
+        self.assertEqual(self.db.get_counts('1'), {'add_hit': 25})
+
+        self.db.read_size = 3
+        data = list(self.db.get_data('1', start=20))
+        self.assertEqual([line['number'] for line in data], range(20, 25))
+
+    def test_groupby(self):
+        first = {'run_id': '1', 'data_type': 'add_hit',
+                 'url': 'http://one', 'status': 200}
+        # the same event, with its keys in another order
+        second = {}
+        for key in ('status', 'url', 'data_type', 'run_id'):
+            second[key] = first[key]
+        self.assertNotEqual(first.keys(), second.keys())
+
+        third = {'run_id': '1', 'url': 'http://one'}
+
+        self.db.add(first)
+        self.db.add(second)
+        self.db.add(third)
+
+        groups = list(self.db.get_data('1', groupby=True))
+        self.assertEqual([group['count'] for group in groups], [2, 1])
+        self.assertEqual(groups[1]['data_type'], 'unknown')
+
+        # the events of the caller are not changed
+        self.assertEqual(third, {'run_id': '1', 'url': 'http://one'})
+
+    def test_metadata(self):
+        self.assertEqual(self.db.get_metadata('1'), {})
+        self.db.save_metadata('1', {'hey': 'ho'})
+        self.assertEqual(self.db.get_metadata('1'), {'hey': 'ho'})
+
+        self.db.update_metadata('1', one=2)
+        meta = self.db.get_metadata('1').items()
+        meta.sort()
+        self.assertEqual(meta, [('hey', 'ho'), ('one', 2)])
+
+    def test_get_timings(self):
+        hit = {'data_type': 'add_hit', 'run_id': '1', 'url': 'http://one',
+               'timings': {'dns': 0, 'connect': 0.1, 'tls': 0, 'ttfb': 0.2,
+                           'download': 0}, 'sent': 10, 'received': 30}
+        self.db.add(dict(hit))
+        self.db.flush()
+        hit['timings'] = dict(hit['timings'], ttfb=0.4)
+        self.db.add(dict(hit))
+
+        timings = self.db.get_timings('1')
+        self.assertAlmostEqual(timings['http://one']['ttfb'], 0.3)
+        self.assertEqual(timings['http://one']['received'], 30)
+        self.assertEqual(self.db.get_timings('2'), {})
+
+    def test_get_rollups(self):
+        hit = {'data_type': 'add_hit', 'run_id': '1', 'url': 'http://one',
+               'status': 200, 'elapsed': 0.1}
+
+        with mock.patch('loads.db._sqlite.time.time') as now:
+            now.return_value = 1000.5
+            self.db.add(dict(hit))
+            self.db.add(dict(hit, status=500))
+            self.db.flush()
+
+            # a late hit for the same second
+            self.db.add(dict(hit))
+            now.return_value = 1001.1
+            self.db.add(dict(hit, url='http://two'))
+
+        rollups = self.db.get_rollups('1')
+        self.assertEqual([(rollup['second'], rollup['url'], rollup['hits'],
+                           rollup['errors']) for rollup in rollups],
+                         [(1000, 'http://one', 3, 1),
+                          (1001, 'http://two', 1, 0)])
+        self.assertEqual(len(self.db.get_rollups('1', url='http://two')), 1)
+        self.assertEqual(len(self.db.get_rollups('1', start=1001)), 1)
+        self.assertEqual(len(self.db.get_rollups('1', end=1000)), 1)
+
+        # the hits have their own columns
+        rows = self.db._query('SELECT second, status, elapsed FROM events '
+                              'WHERE run_id = ? AND url = ?', '1',
+                              'http://one').fetchall()
+        self.assertEqual(rows, [(1000, 200, 0.1), (1000, 500, 0.1),
+                                (1000, 200, 0.1)])
+
+        # the rollups are kept once the details are gone
+        self.assertFalse(self.db.is_summarized('1'))
+        self.db.summarize_run('1')
+        self.assertTrue(self.db.is_summarized('1'))
+        self.assertEqual(list(self.db.get_data('1')), [])
+        rollups = self.db.get_rollups('1', step=10)
+        self.assertEqual([rollup['hits'] for rollup in rollups], [3, 1])
+
+        self.db.delete_run('1')
+        self.assertEqual(self.db.get_rollups('1'), [])
+        self.assertEqual(self.db.get_counts('1'), {})
+        self.assertEqual(self.db.get_runs(), [])
+
+    def test_get_rollups_per_agent(self):
+        hit = {'data_type': 'add_hit', 'run_id': '1', 'url': 'http://one',
+               'status': 200, 'elapsed': 0.1}
+
+        with mock.patch('loads.db._sqlite.time.time') as now:
+            now.return_value = 1000.5
+            self.db.add(dict(hit, agent_id=1))
+            self.db.add(dict(hit, agent_id=1, status=500))
+            self.db.add(dict(hit, agent_id=2))
+
+        rollups = self.db.get_rollups('1')
+        self.assertEqual([(rollup['hits'], rollup['errors'])
+                          for rollup in rollups], [(3, 1)])
+        rollups = self.db.get_rollups('1', agent_id=1)
+        self.assertEqual([(rollup['hits'], rollup['errors'])
+                          for rollup in rollups], [(2, 1)])
+        rollups = self.db.get_rollups('1', agent_id=2)
+        self.assertEqual([rollup['hits'] for rollup in rollups], [1])
+        self.assertEqual(self.db.get_rollups('1', agent_id=3), [])
+
+    def test_reads_while_writing(self):
+        self.db.add({'run_id': '1', 'data_type': 'add_hit', 'number': 0})
+        self.db.flush()
+        self.assertEqual(self.db._query('PRAGMA journal_mode').fetchone(),
+                         ('wal',))
+
+        # a transaction is in progress
+        self.db._conn.execute('INSERT INTO runs (run_id) VALUES ("2")')
+        data = self.db.get_data('1')
+        self.assertEqual(data.next()['number'], 0)
+
+        self.db._conn.commit()
+        self.db.add({'run_id': '1', 'data_type': 'add_hit', 'number': 1})
+        self.db.flush()
+        self.assertEqual(list(data), [])
+        self.assertEqual(len(list(self.db.get_data('1'))), 2)
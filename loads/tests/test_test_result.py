@@ -1,9 +1,13 @@
 from unittest2 import TestCase
+from collections import defaultdict
 from datetime import datetime, timedelta
 
 from mock import Mock
+import unittest2
 
 from loads.results.base import TestResult, Hit, Test
+from loads.results.aggregate import EventsSummary
+from loads.util import get_quantiles, HAS_NUMPY
 
 
 TIME1 = datetime(2013, 5, 14, 0, 51, 8)
@@ -33,6 +37,16 @@ class TestTestResult(TestCase):
         test_result.add_hit(**self._get_data())
         self.assertEquals(len(test_result.hits), 1)
 
+    def test_hits_share_strings(self):
+        test_result = TestResult()
+        test_result.add_hit(**self._get_data(url=''.join(['http://', 'a'])))
+        test_result.add_hit(**self._get_data(url=''.join(['http://', 'a'])))
+        one, two = test_result.hits
+        self.assertTrue(one.url is two.url)
+
+        # the strings are kept by the result, not across results
+        self.assertEqual(TestResult()._strings, {})
+
     def test_nb_hits(self):
         test_result = TestResult()
         test_result.add_hit(**self._get_data())
@@ -162,6 +176,40 @@ class TestTestResult(TestCase):
         self.assertEquals(len(test_result._get_tests(name='bacon', series=2)),
                           1)
 
+    def test_get_tests_filters_finished(self):
+        test_result = TestResult()
+        self.assertEquals(test_result._get_tests(finished=True), [])
+
+        test_result.startTest('bacon', (1, 1, 1, 1))
+        test_result.startTest('bacon', (1, 1, 2, 1))
+        test_result.startTest('spam', (2, 1, 1, 1))
+        test_result.stopTest('bacon', (1, 1, 1, 1))
+
+        self.assertEquals(test_result.nb_finished_tests, 1)
+        self.assertEquals(len(test_result._get_tests(finished=False)), 2)
+        self.assertEquals(len(test_result._get_tests(name='bacon',
+                                                     finished=False)), 1)
+        self.assertEquals(len(test_result._get_tests(series=2)), 1)
+        self.assertEquals(test_result._get_tests(name='eggs'), [])
+
+    def test_tests_counts(self):
+        test_result = TestResult()
+        loads_status = (1, 1, 1, 1)
+        test_result.addSuccess('bacon', loads_status)
+        test_result.addSuccess('bacon', loads_status)
+        test_result.addError('bacon', 'An error', loads_status)
+        test_result.addFailure('spam', 'A failure', loads_status)
+        test_result.tests['eggs', 1] = Test(name='eggs', success=3)
+
+        self.assertEquals(test_result.nb_success, 5)
+        self.assertEquals(test_result.nb_errors, 1)
+        self.assertEquals(test_result.nb_failures, 1)
+        self.assertEquals(list(test_result.errors), [['An error']])
+        self.assertEquals(list(test_result.failures), [['A failure']])
+
+        del test_result.tests['eggs', 1]
+        self.assertEquals(test_result.nb_success, 2)
+
     def test_test_success_rate_when_not_started(self):
         # it should be none if no tests had been collected yet.
         test_result = TestResult()
@@ -213,6 +261,47 @@ class TestTestResult(TestCase):
         self.assertEqual(test_result.get_counter('bacon', 'xxxx'), 0)
         self.assertEqual(test_result.get_counter('xxx', 'xxxx'), 0)
 
+    def test_connection_count(self):
+        test_result = TestResult()
+        for i in range(5):
+            test_result.add_hit(**self._get_data())
+        test_result.connection_open()
+        test_result.connection_open()
+
+        self.assertEquals(test_result.opened_connections, 2)
+        self.assertEquals(test_result.reused_connections, 3)
+
+    def test_timings(self):
+        test_result = TestResult()
+        for user, ttfb in ((1, 0.1), (1, 0.3), (2, 0.8)):
+            data = self._get_data(user=user)
+            data['timings'] = {'dns': 0, 'connect': 0, 'tls': 0,
+                               'ttfb': ttfb, 'download': 0.1}
+            data['sent'], data['received'] = 100, 1000
+            test_result.add_hit(**data)
+        test_result.add_hit(**self._get_data(user=3))
+
+        self.assertEqual(test_result.timed_users, [1, 2])
+        self.assertAlmostEqual(test_result.get_timings(users=1)['ttfb'], 0.2)
+        self.assertAlmostEqual(test_result.get_timings(users=2)['ttfb'], 0.8)
+        self.assertEqual(test_result.get_timings()['received'], 1000)
+        self.assertEqual(test_result.hits[0].sent, 100)
+
+        test_result.add_hits('http://notmyidea.org', 'GET', 200, 1,
+                             {'count': 1, 'total': 0.2, 'min': 0.2,
+                              'max': 0.2, 'buckets': {}}, users=3,
+                             timings={'count': 1, 'ttfb': 0.4})
+        self.assertAlmostEqual(test_result.get_timings(users=3)['ttfb'], 0.4)
+
+    def test_address_counts(self):
+        test_result = TestResult()
+        for url in ('http://1.1.1.1:80/', 'http://1.1.1.1:80/foo',
+                    'http://2.2.2.2:80/'):
+            test_result.add_hit(**self._get_data(url=url))
+
+        self.assertEqual(test_result.get_address_counts(),
+                         {'1.1.1.1': 2, '2.2.2.2': 1})
+
     def test_socket_count(self):
         test_result = TestResult()
 
@@ -231,6 +320,203 @@ class TestTestResult(TestCase):
         self.assertEquals(test_result.opened_sockets, 5)
         self.assertEquals(test_result.closed_sockets, 4)
 
+    def test_aggregated_hits(self):
+        test_result = TestResult(args={'aggregate_hits': True})
+        test_result.add_hit(**self._get_data(elapsed=_1))
+        test_result.add_hit(**self._get_data(elapsed=_3, status=500))
+        test_result.add_hit(**self._get_data(url='http://another-one',
+                                             elapsed=_2, series=2))
+
+        # the hits themselves are not kept
+        self.assertEquals(len(test_result.hits), 0)
+        self.assertEquals(test_result.nb_hits, 3)
+        self.assertEquals(test_result.urls,
+                          set(['http://notmyidea.org', 'http://another-one']))
+        self.assertEquals(test_result.average_request_time(), 2)
+        self.assertEquals(test_result.average_request_time(series=2), 2)
+        self.assertEquals(test_result.hits_success_rate(
+            url='http://notmyidea.org'), 0.5)
+        self.assertEquals(test_result.get_status_codes(), {200: 2, 500: 1})
+
+        quantiles = test_result.get_request_time_quantiles()
+        self.assertEquals(quantiles[0], 1)
+        self.assertEquals(quantiles[-1], 3)
+        self.assertTrue(abs(quantiles[2] - 2) < 0.02)
+
+    def test_summaries(self):
+        events = EventsSummary()
+        for elapsed in (1, 2, 3):
+            events.add('add_hit', self._get_data(elapsed=elapsed))
+        for current in range(4):
+            for data_type in ('startTest', 'addSuccess', 'stopTest'):
+                events.add(data_type, {'test': 'test',
+                                       'loads_status': [1, 1, current, 1]})
+
+        counts = defaultdict(list)
+        for data_type, data in events.flush():
+            counts[data_type].append(data)
+
+        test_result = TestResult()
+        test_result.batch(agent_id=1, counts=counts)
+        test_result.startTest('test', [1, 1, 4, 1])
+        test_result.stopTest('test', [1, 1, 4, 1])
+
+        self.assertEquals(len(test_result.hits), 0)
+        self.assertEquals(test_result.nb_hits, 3)
+        self.assertEquals(test_result.average_request_time(), 2)
+        self.assertEquals(test_result.get_request_time_quantiles()[-1], 3)
+
+        self.assertEquals(test_result.nb_tests, 5)
+        self.assertEquals(test_result.nb_finished_tests, 5)
+        self.assertEquals(test_result.nb_success, 4)
+        self.assertEquals(test_result.test_success_rate(), 1)
+        self.assertTrue(test_result.average_test_duration() is not None)
+
+    def test_summaries_phases_and_lag(self):
+        events = EventsSummary()
+        for phase, elapsed, lag in (('up', 1, None), ('steady', 2, 1),
+                                    ('steady', 3, 3)):
+            data = self._get_data(elapsed=elapsed)
+            data['loads_status'] = list(data['loads_status']) + [phase]
+            if lag is not None:
+                data['lag'] = lag
+            events.add('add_hit', data)
+
+        counts = defaultdict(list)
+        for data_type, data in events.flush():
+            counts[data_type].append(data)
+
+        test_result = TestResult()
+        test_result.batch(agent_id=1, counts=counts)
+
+        self.assertEquals(test_result.nb_hits, 3)
+        self.assertEquals(test_result.phases, set(['up', 'steady']))
+        self.assertEquals(test_result.average_request_time(phase='up'), 1)
+        self.assertEquals(test_result.average_request_time(phase='steady'),
+                          2.5)
+        self.assertEquals(test_result.get_status_codes(phase='steady'),
+                          {200: 2})
+        # only the lagged hits have a corrected latency
+        self.assertEquals(test_result.average_corrected_request_time(), 4.5)
+
+    def test_summaries_lags_and_connections(self):
+        events = EventsSummary()
+        for lag in (1, 2, 3):
+            events.add('add_lag', {'lag': lag, 'loads_status': [1, 1, 1, 1]})
+            events.add('connection_open', {})
+
+        counts = defaultdict(list)
+        for data_type, data in events.flush():
+            counts[data_type].append(data)
+
+        test_result = TestResult()
+        test_result.batch(agent_id=1, counts=counts)
+        self.assertEquals(test_result.nb_lags, 3)
+        self.assertEquals(test_result.average_lag(), 2)
+        self.assertEquals(test_result.opened_connections, 3)
+
+    def test_relay_stats(self):
+        test_result = TestResult()
+        test_result.relay_stats(dropped=2, delayed=3, agent_id=1)
+        test_result.relay_stats(dropped=1, delayed=0, agent_id=2)
+        self.assertEquals((test_result.relay_dropped,
+                           test_result.relay_delayed), (3, 3))
+
+    def test_phases(self):
+        test_result = TestResult()
+        self.assertEquals(test_result.phases, set())
+
+        for phase, elapsed in (('up', _1), ('steady', _2), ('steady', _3)):
+            data = self._get_data(elapsed=elapsed)
+            data['loads_status'] = list(data['loads_status']) + [phase]
+            test_result.add_hit(**data)
+            test_result.startTest('test', data['loads_status'])
+
+        self.assertEquals(test_result.phases, set(['up', 'steady']))
+        self.assertEquals(test_result.average_request_time(), 2)
+        self.assertEquals(test_result.average_request_time(phase='up'), 1)
+        self.assertEquals(test_result.average_request_time(phase='steady'),
+                          2.5)
+        self.assertEquals(
+            test_result.get_request_time_quantiles(phase='steady'),
+            get_quantiles([2, 3], (0, 0.1, 0.5, 0.9, 1)))
+        self.assertEquals(test_result.hits[0].phase, 'up')
+        self.assertEquals(test_result.hits[0].series, 1)
+        self.assertEquals(sorted(test.phase for test in
+                                 test_result._get_tests()),
+                          ['steady', 'up'])
+
+    def test_lags(self):
+        test_result = TestResult()
+        self.assertEquals(test_result.nb_lags, 0)
+
+        for lag in (0, .5, 1):
+            test_result.add_lag(lag, [1, 1, 1, 1])
+            data = self._get_data(elapsed=_1)
+            data['lag'] = lag
+            test_result.add_hit(**data)
+
+        self.assertEquals(test_result.nb_lags, 3)
+        self.assertEquals(test_result.average_lag(), .5)
+        self.assertEquals(test_result.average_request_time(), 1)
+        self.assertEquals(test_result.average_corrected_request_time(), 1.5)
+        quantiles = test_result.get_corrected_request_time_quantiles()
+        self.assertEquals((quantiles[0], quantiles[-1]), (1, 2))
+        self.assertEquals(test_result.hits[1].lag, .5)
+
+    def test_quantiles_are_exact_when_keeping_hits(self):
+        test_result = TestResult()
+        for elapsed in (_1, _2, _3):
+            test_result.add_hit(**self._get_data(elapsed=elapsed))
+
+        self.assertEquals(test_result.get_request_time_quantiles(),
+                          get_quantiles([1, 2, 3], (0, 0.1, 0.5, 0.9, 1)))
+
+    @unittest2.skipIf(not HAS_NUMPY, 'No numpy')
+    def test_vectorized_queries(self):
+        test_result = TestResult()
+        for i in range(3000):
+            test_result.add_hit(**self._get_data(elapsed=i % 10,
+                                                 series=i % 3,
+                                                 url='http://%d' % (i % 2)))
+
+        self.assertEquals(len(test_result._arrays), 3000)
+        hits = test_result._get_hits(url='http://1', series=2)
+        self.assertEquals(len(hits), 500)
+        for hit in hits:
+            self.assertEquals((hit.url, hit.series), ('http://1', 2))
+        self.assertEquals(test_result._get_hits(url='http://3'), [])
+
+        quantiles = test_result.get_request_time_quantiles(url='http://0')
+        elapsed = [h.elapsed_seconds for h in
+                   test_result._get_hits(url='http://0')]
+        self.assertEquals(quantiles,
+                          get_quantiles(elapsed, (0, 0.1, 0.5, 0.9, 1)))
+
+    def test_observers(self):
+        test_result = TestResult()
+        # no observer, no dispatching
+        self.assertFalse('add_hit' in test_result.__dict__)
+
+        observer = Mock()
+        test_result.add_observer(observer)
+        test_result.add_hit(**self._get_data())
+        test_result.addSuccess('bacon', (1, 1, 1, 1))
+
+        observer.push.assert_any_call('add_hit', **self._get_data())
+        observer.push.assert_any_call('addSuccess', 'bacon', (1, 1, 1, 1))
+        # the implicit startTest is pushed as well.
+        observer.push.assert_any_call('startTest', 'bacon', (1, 1, 1, 1),
+                                      None)
+        self.assertEquals(test_result.nb_hits, 1)
+        self.assertEquals(test_result.nb_success, 1)
+
+        other = Mock()
+        test_result.add_observer(other)
+        test_result.socket_open()
+        observer.push.assert_called_with('socket_open')
+        other.push.assert_called_with('socket_open')
+
 
 class TestHits(TestCase):
 
@@ -259,6 +545,21 @@ class TestHits(TestCase):
         self.assertEquals(h.user, 2)
         self.assertEquals(h.current_hit, 3)
 
+    def test_elapsed(self):
+        h = Hit(url='http://notmyidea.org', method='GET', status=200,
+                started=None, elapsed=_2, loads_status=None)
+        self.assertEquals(h.elapsed_seconds, 2)
+        self.assertEquals(h.elapsed, _2)
+
+        h = Hit(url='http://notmyidea.org', method='GET', status=200,
+                started=None, elapsed=0.5, loads_status=None)
+        self.assertEquals(h.elapsed, timedelta(seconds=0.5))
+
+    def test_no_instance_dict(self):
+        h = Hit(url='http://notmyidea.org', method='GET', status=200,
+                started=None, elapsed=0.5, loads_status=None)
+        self.assertFalse(hasattr(h, '__dict__'))
+
 
 class TestTest(TestCase):
 
@@ -272,6 +573,14 @@ class TestTest(TestCase):
         test.end = TIME2
         self.assertEquals(test.duration, 120)
 
+    def test_counters(self):
+        test = Test()
+        self.assertEquals(test.get_counter('sent'), 0)
+        self.assertEquals(test.get_counters(), {})
+        test.incr_counter('sent')
+        self.assertEquals(test.get_counter('sent'), 1)
+        self.assertFalse(hasattr(test, '__dict__'))
+
     def test_success_rate_when_none(self):
         test = Test()
         self.assertEquals(test.success_rate, 1)
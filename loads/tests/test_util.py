@@ -206,6 +206,17 @@ class TestUtil(unittest2.TestCase):
         res = get_quantiles(data, quantiles)
         self.assertEqual(len(res), 5)
 
+    @unittest2.skipIf(not util.HAS_NUMPY, 'No numpy')
+    def test_get_quantiles_numpy(self):
+        quantiles = 0, 0.1, 0.25, 0.5, 0.9, 1
+        for data in ([3, 1, 2], [1.5], [0.1 * i for i in range(97, 0, -1)]):
+            res = get_quantiles(data, quantiles)
+            with mock.patch('loads.util.HAS_NUMPY', False):
+                expected = get_quantiles(data, quantiles)
+
+            for value, expected_value in zip(res, expected):
+                self.assertAlmostEqual(value, expected_value)
+
     def test_nullstreams(self):
         stream = StringIO.StringIO()
         null_streams([stream, sys.stdout])
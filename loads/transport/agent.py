@@ -80,6 +80,8 @@ class Agent(object):
         # this will timeout in case the broker is unreachable
         result = client.ping()
         self.endpoints = result['endpoints']
+        # brokers not advertising their encodings only read JSON.
+        self.encodings = result.get('encodings', ['json'])
 
         # Setup the zmq sockets
         self.loop = ioloop.IOLoop()
@@ -122,6 +124,11 @@ class Agent(object):
         args['agent_id'] = self.agent_id
         args['zmq_receiver'] = self.endpoints['receiver']
         args['run_id'] = run_id
+        if args.get('zmq_encoding') not in self.encodings:
+            if 'binary' in self.encodings:
+                args['zmq_encoding'] = 'binary'
+            else:
+                args['zmq_encoding'] = 'json'
 
         cmd = 'from loads.main import run;'
         cmd += 'run(%s)' % str(args)
@@ -17,6 +17,7 @@ from loads.transport.util import (register_ipc_file, DEFAULT_FRONTEND,
                                   DEFAULT_PUBLISHER,
                                   DEFAULT_AGENT_TIMEOUT)
 from loads.transport.heartbeat import Heartbeat
+from loads.transport import codec
 from loads.transport.exc import DuplicateBrokerError
 from loads.db import get_backends
 from loads.transport.brokerctrl import BrokerController
@@ -114,9 +115,13 @@ class Broker(object):
         self.web_root = web_root
 
     def _handle_recv(self, msg):
-        # publishing all the data received from agents
-        self._publisher.send(msg[0])
-        data = json.loads(msg[0])
+        data = codec.decode(msg[0])
+
+        # publishing all the data received from agents, always in JSON
+        if codec.is_binary(msg[0]):
+            self._publisher.send(json.dumps(data))
+        else:
+            self._publisher.send(msg[0])
         agent_id = str(data.get('agent_id'))
 
         # saving the data locally
@@ -181,7 +186,9 @@ class Broker(object):
         elif cmd == 'PING':
             res = {'result': {'pid': os.getpid(),
                               'endpoints': self.endpoints,
-                              'agents': self.ctrl.agents}}
+                              'encodings': codec.ENCODINGS,
+                              'agents': self.ctrl.agents,
+                              'metrics': self.ctrl.get_metrics()}}
             self.send_json(target, res)
         elif cmd == 'LIST':
             # we return a list of agent ids and their status
@@ -3,16 +3,22 @@ import random
 import time
 import sys
 import traceback
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import datetime
+from itertools import islice
 from uuid import uuid4
 
 from loads.db import get_database
-from loads.transport.util import DEFAULT_AGENT_TIMEOUT
+from loads.transport.util import (DEFAULT_AGENT_TIMEOUT,
+                                  DEFAULT_CURSOR_TIMEOUT)
 from loads.util import logger, resolve_name, json, unbatch
 from loads.results import RemoteTestResult
 
 
+# the counts of each run kept to send the changes since their version
+COUNTS_SNAPSHOTS = 10
+
+
 class NotEnoughWorkersError(Exception):
     pass
 
@@ -21,6 +27,10 @@ class NoDetailedDataError(Exception):
     pass
 
 
+class UnknownCursorError(Exception):
+    pass
+
+
 def _compute_observers(observers):
     """Reads the arguments and returns an observers list"""
     def _resolver(name):
@@ -37,10 +47,23 @@ def _compute_observers(observers):
 
 class BrokerController(object):
     def __init__(self, broker, loop, db='python', dboptions=None,
-                 agent_timeout=DEFAULT_AGENT_TIMEOUT):
+                 agent_timeout=DEFAULT_AGENT_TIMEOUT,
+                 cursor_timeout=DEFAULT_CURSOR_TIMEOUT):
         self.broker = broker
         self.loop = loop
 
+        # the data being read by the clients, by cursor id
+        self._cursors = {}
+        self.cursor_timeout = cursor_timeout
+
+        # the number of events added to each run versions its counts, and
+        # the last counts sent for each run, by version, give the changes
+        # since then.
+        self._epoch = uuid4().hex
+        self._added = defaultdict(int)
+        self._counts = defaultdict(OrderedDict)
+        self.counts_snapshots = COUNTS_SNAPSHOTS
+
         # agents registration and timers
         self._agents = {}
         self._agent_times = {}
@@ -143,9 +166,16 @@ class BrokerController(object):
         - send a _STATUS command to all active agents to refresh their status
         - detect agents that have not responded for a while and discard them
           from the run and from the agents list
+        - close the cursors the clients stopped reading
         """
         now = time.time()
 
+        for cursor_id, (records, chunk_size, when) in self._cursors.items():
+            if now - when > self.cursor_timeout:
+                logger.debug('Closing the idle cursor %s' % cursor_id)
+                records.close()
+                del self._cursors[cursor_id]
+
         for agent_id, (run_id, when) in self._runs.items():
             # when was the last time we've got a response ?
             last_contact = self._agent_times.get(agent_id)
@@ -253,41 +283,134 @@ class BrokerController(object):
         if data.get('data_type') == 'batch':
             for data_type, message in unbatch(data):
                 message['data_type'] = data_type
-                callback = functools.partial(self._db.add, message)
+                callback = functools.partial(self._add_data, message)
                 self.loop.add_callback(callback)
         else:
-            self._db.add(data)
+            self._add_data(data)
+
+    def _add_data(self, data):
+        self._db.add(data)
+        self._added[data['run_id']] += 1
 
     def get_urls(self, msg, data):
         run_id = data['run_id']
         return self._db.get_urls(run_id)
 
-    def get_data(self, msg, data):
-        # XXX stream ?
+    def get_timings(self, msg, data):
+        run_id = data['run_id']
+        return self._db.get_timings(run_id)
+
+    def get_rollups(self, msg, data):
         run_id = data['run_id']
+        options = {'url': data.get('url'), 'step': int(data.get('step', 1))}
+        for option in ('start', 'end'):
+            if data.get(option) is not None:
+                options[option] = int(data[option])
+        # only some DBs keep the rollups of each agent
+        if data.get('agent_id') is not None:
+            options['agent_id'] = data['agent_id']
+        return self._db.get_rollups(run_id, **options)
+
+    def get_metrics(self, msg=None, data=None):
+        return self._db.get_metrics()
+
+    def get_data(self, msg, data):
+        """Returns the data of a run.
+
+        When a *chunk_size* is given, only the first *chunk_size* records
+        are returned, along with the id of a cursor. Calling get_data again
+        with that *cursor* returns the next records, until the cursor is
+        None.
+        """
+        cursor_id = data.get('cursor')
+
+        if cursor_id is None:
+            run_id = data['run_id']
 
-        if self._db.is_summarized(run_id):
-            raise NoDetailedDataError(run_id)
+            if self._db.is_summarized(run_id):
+                raise NoDetailedDataError(run_id)
 
-        start = data.get('start')
-        if start is not None:
-            start = int(start)
+            start = data.get('start')
+            if start is not None:
+                start = int(start)
 
-        size = data.get('size')
-        if size is not size:
-            size = int(size)
+            size = data.get('size')
+            if size is not None:
+                size = int(size)
 
-        options = {'data_type': data.get('data_type'),
-                   'groupby': data.get('groupby', False),
-                   'start': start,
-                   'size': size}
+            options = {'data_type': data.get('data_type'),
+                       'groupby': data.get('groupby', False),
+                       'start': start,
+                       'size': size}
 
-        return list(self._db.get_data(run_id, **options))
+            chunk_size = data.get('chunk_size')
+            if chunk_size is not None:
+                chunk_size = int(chunk_size)
+                if chunk_size <= 0:
+                    raise ValueError('Invalid chunk size: %d' % chunk_size)
+
+            records = self._db.get_data(run_id, **options)
+            if chunk_size is None:
+                return list(records)
+
+            cursor_id = uuid4().hex
+            self._cursors[cursor_id] = [records, chunk_size, None]
+
+        cursor = self._cursors.get(cursor_id)
+        if cursor is None:
+            raise UnknownCursorError(cursor_id)
+
+        records, chunk_size = cursor[:2]
+        chunk = list(islice(records, chunk_size))
+        if len(chunk) < chunk_size:
+            del self._cursors[cursor_id]
+            cursor_id = None
+        else:
+            cursor[2] = time.time()
+
+        return {'cursor': cursor_id, 'data': chunk}
 
     def get_counts(self, msg, data):
         run_id = data['run_id']
         return self._db.get_counts(run_id)
 
+    def get_counts_since(self, msg, data):
+        """Returns the counts of a run that changed since a given version.
+
+        The DB is not read when no event was added to the run since that
+        *version*, or when the current counts were already sent. The last
+        *counts_snapshots* versions sent are kept: when the version is not
+        one of them, all the counts are returned, with *delta* set to False.
+        """
+        run_id = data['run_id']
+        since = data.get('since')
+        version = '%s-%d' % (self._epoch, self._added.get(run_id, 0))
+
+        if since == version:
+            return {'version': version, 'counts': {}, 'delta': True}
+
+        # the least recently used versions are dropped first
+        snapshots = self._counts[run_id]
+        sent = snapshots.pop(since, None)
+        if sent is not None:
+            snapshots[since] = sent
+
+        counts = snapshots.pop(version, None)
+        if counts is None:
+            counts = self._db.get_counts(run_id)
+        snapshots[version] = counts
+
+        while len(snapshots) > self.counts_snapshots:
+            snapshots.popitem(last=False)
+
+        if sent is None:
+            return {'version': version, 'counts': counts, 'delta': False}
+
+        changes = dict([(name, count - sent.get(name, 0))
+                        for name, count in counts.items()
+                        if count != sent.get(name, 0)])
+        return {'version': version, 'counts': changes, 'delta': True}
+
     def flush_db(self):
         return self._db.flush()
 
@@ -386,6 +509,9 @@ class BrokerController(object):
     # Observers
     #
     def test_ended(self, run_id):
+        # the counts won't change much from here
+        self._counts.pop(run_id, None)
+
         # first of all, we want to mark it done in the DB
         logger.debug('test %s ended marking the metadata' % run_id)
         self.update_metadata(run_id, stopped=True, active=False,
@@ -13,7 +13,7 @@ from loads.util import logger, pack_include_files
 from loads.transport.util import (send, recv, DEFAULT_FRONTEND,
                                   timed, DEFAULT_TIMEOUT,
                                   DEFAULT_TIMEOUT_MOVF,
-                                  DEFAULT_TIMEOUT_OVF)
+                                  DEFAULT_TIMEOUT_OVF, DEFAULT_CHUNK_SIZE)
 
 
 class Client(object):
@@ -166,6 +166,15 @@ class Client(object):
     def get_urls(self, run_id):
         return self.execute({'command': 'CTRL_GET_URLS', 'run_id': run_id})
 
+    def get_timings(self, run_id):
+        return self.execute({'command': 'CTRL_GET_TIMINGS',
+                             'run_id': run_id})
+
+    def get_rollups(self, run_id, **kw):
+        cmd = {'command': 'CTRL_GET_ROLLUPS', 'run_id': run_id}
+        cmd.update(kw)
+        return self.execute(cmd)
+
     def stop_run(self, run_id):
         return self.execute({'command': 'CTRL_STOP_RUN', 'run_id': run_id})
 
@@ -176,13 +185,38 @@ class Client(object):
             return res.items()
         return res
 
+    def get_counts_since(self, run_id, version=None):
+        return self.execute({'command': 'CTRL_GET_COUNTS_SINCE',
+                             'run_id': run_id, 'since': version})
+
     def get_metadata(self, run_id):
         return self.execute({'command': 'CTRL_GET_METADATA', 'run_id': run_id})
 
-    def get_data(self, run_id, **kw):
-        cmd = {'command': 'CTRL_GET_DATA', 'run_id': run_id}
+    def get_data(self, run_id, chunk_size=DEFAULT_CHUNK_SIZE, **kw):
+        """Returns an iterator on the data of the run.
+
+        The broker sends the data by chunks of *chunk_size* records, and the
+        next chunk is only asked for once the previous one is consumed. The
+        first chunk is asked for right away, so the errors are raised by
+        this call.
+        """
+        if chunk_size <= 0:
+            raise ValueError('Invalid chunk size: %r' % (chunk_size,))
+        cmd = {'command': 'CTRL_GET_DATA', 'run_id': run_id,
+               'chunk_size': chunk_size}
         cmd.update(kw)
-        return self.execute(cmd)
+        return self._read_cursor(self.execute(cmd))
+
+    def _read_cursor(self, res):
+        while True:
+            for line in res['data']:
+                yield line
+
+            if res['cursor'] is None:
+                return
+
+            res = self.execute({'command': 'CTRL_GET_DATA',
+                                'cursor': res['cursor']})
 
     def status(self, agent_id):
         return self.execute({'command': 'CTRL_AGENT_STATUS',
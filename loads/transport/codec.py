@@ -0,0 +1,359 @@
+""" Compact binary encoding for the events sent by the runners.
+
+The JSON encoding repeats every key, the agent id, hostname and run id in every
+event, and renders the dates as ISO strings. The binary encoding uses fixed
+struct layouts for the most common events and carries the timestamps as floats.
+
+A message is made of:
+
+- a 2 bytes prefix: MAGIC and VERSION. JSON messages always start with "{",
+  so the receivers can tell the two encodings apart with the first byte.
+- the kind of message: a single event or a batch of events.
+- the constants of the sender (agent id, hostname, run id). They are encoded
+  once by the sender and prepended as-is to every message.
+- a table of the strings (urls, methods, test names...) used by the records,
+  so a batch carries each of them only once.
+- the records.
+
+Events that don't fit a fixed layout are encoded as JSON records.
+"""
+import calendar
+import math
+import struct
+from datetime import datetime, timedelta
+
+from loads.util import json, total_seconds, DateTimeJSONEncoder
+from loads.results.aggregate import TIMING_PHASES
+
+
+MAGIC = '\x00'
+VERSION = 2
+ENCODINGS = ('json', 'binary')
+
+_SINGLE = 1
+_BATCH = 2
+
+# record types
+_GENERIC = 0
+_ADD_HIT = 1
+_START_TEST = 2
+_STOP_TEST = 3
+_ADD_SUCCESS = 4
+_ADD_ERROR = 5
+_ADD_FAILURE = 6
+_SOCKET_MESSAGE = 7
+_ADD_TIMED_HIT = 8
+
+_TEST_TYPES = {'startTest': _START_TEST, 'stopTest': _STOP_TEST,
+               'addSuccess': _ADD_SUCCESS}
+_EXC_TYPES = {'addError': _ADD_ERROR, 'addFailure': _ADD_FAILURE}
+_NAMES = {_ADD_HIT: 'add_hit', _START_TEST: 'startTest',
+          _STOP_TEST: 'stopTest', _ADD_SUCCESS: 'addSuccess',
+          _ADD_ERROR: 'addError', _ADD_FAILURE: 'addFailure',
+          _SOCKET_MESSAGE: 'socket_message', _ADD_TIMED_HIT: 'add_hit'}
+
+_HIT_FIELDS = set(['started', 'elapsed', 'status', 'method', 'url',
+                   'loads_status'])
+_TIMING_FIELDS = set(['timings', 'sent', 'received'])
+_TEST_FIELDS = set(['test', 'loads_status'])
+_EXC_FIELDS = set(['test', 'loads_status', 'exc_info'])
+
+_NONE = -2 ** 31
+# the ramp phases of loads.runners.ramp, the first one standing for no phase
+_PHASES = (None, 'up', 'steady', 'down')
+_LEN = struct.Struct('!I')
+_PREFIX = struct.Struct('!cBB')
+_RECORD = struct.Struct('!BI')
+_STATUS = struct.Struct('!iiiiB')
+_HIT = struct.Struct('!ddHII')
+_TIMINGS = struct.Struct('!' + 'd' * len(TIMING_PHASES) + 'qq')
+_TEST = struct.Struct('!I')
+_SIZE = struct.Struct('!q')
+_ENCODER = DateTimeJSONEncoder()
+
+
+class EncodingError(ValueError):
+    pass
+
+
+def _timestamp(value):
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+def _from_timestamp(value):
+    if math.isnan(value):
+        return None
+    return datetime.utcfromtimestamp(value).isoformat()
+
+
+def _pack_str(value):
+    if value is None:
+        return _LEN.pack(0xFFFFFFFF)
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    else:
+        value = str(value)
+    return _LEN.pack(len(value)) + value
+
+
+def _unpack_str(data, pos):
+    size, = _LEN.unpack_from(data, pos)
+    pos += _LEN.size
+    if size == 0xFFFFFFFF:
+        return None, pos
+    return data[pos:pos + size].decode('utf8'), pos + size
+
+
+def encode_header(agent_id=None, hostname=None, run_id=None):
+    """Encodes the constants of a sender. Done once per sender."""
+    return ''.join([_pack_str(agent_id), _pack_str(hostname),
+                    _pack_str(run_id)])
+
+
+class _Strings(object):
+    """The strings table of a message."""
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def __call__(self, value):
+        id_ = self.ids.get(value)
+        if id_ is None:
+            id_ = self.ids[value] = len(self.strings)
+            self.strings.append(_pack_str(value))
+        return id_
+
+    def dump(self):
+        return _LEN.pack(len(self.strings)) + ''.join(self.strings)
+
+
+def _pack_status(loads_status):
+    if loads_status is None:
+        loads_status = (None, None, None, None)
+    if len(loads_status) == 4:
+        phase = None
+    elif len(loads_status) == 5 and loads_status[4] in _PHASES[1:]:
+        phase = loads_status[4]
+    else:
+        raise EncodingError(loads_status)
+
+    values = []
+    for value in loads_status[:4]:
+        if value is None:
+            value = _NONE
+        elif not isinstance(value, (int, long)) or isinstance(value, bool):
+            raise EncodingError(loads_status)
+        values.append(value)
+    values.append(_PHASES.index(phase))
+
+    try:
+        return _STATUS.pack(*values)
+    except struct.error:
+        raise EncodingError(loads_status)
+
+
+def _unpack_status(data, pos):
+    values = _STATUS.unpack_from(data, pos)
+    status = [None if value == _NONE else value for value in values[:4]]
+    if values[4]:
+        status.append(_PHASES[values[4]])
+    return status, pos + _STATUS.size
+
+
+def _is_timed(data):
+    timings = data['timings']
+    return (isinstance(timings, dict) and len(timings) == len(TIMING_PHASES)
+            and all([phase in timings for phase in TIMING_PHASES]) and
+            isinstance(data['sent'], (int, long)) and
+            isinstance(data['received'], (int, long)))
+
+
+def _encode_record(data_type, data, strings):
+    """Returns the binary payload of the event."""
+    keys = set(data)
+
+    if data_type == 'add_hit' and _HIT_FIELDS <= keys:
+        started = data['started']
+        if started is None:
+            started = float('nan')
+        elif isinstance(started, datetime):
+            started = _timestamp(started)
+        else:
+            raise EncodingError(started)
+
+        elapsed = data['elapsed']
+        if isinstance(elapsed, timedelta):
+            elapsed = total_seconds(elapsed)
+
+        fields = _HIT_FIELDS
+        type_ = _ADD_HIT
+        timings = ''
+        if _TIMING_FIELDS <= keys and _is_timed(data):
+            # the hits of loads.measure.Session
+            fields = _HIT_FIELDS | _TIMING_FIELDS
+            type_ = _ADD_TIMED_HIT
+            values = [data['timings'][phase] for phase in TIMING_PHASES]
+            timings = _TIMINGS.pack(*(values + [data['sent'],
+                                                data['received']]))
+
+        extra = dict([(key, data[key]) for key in keys - fields])
+        if extra:
+            extra = _ENCODER.encode(extra)
+        else:
+            extra = None
+
+        return type_, ''.join([
+            _HIT.pack(started, elapsed, data['status'],
+                      strings(data['method']), strings(data['url'])),
+            _pack_status(data['loads_status']), timings, _pack_str(extra)])
+
+    elif data_type in _TEST_TYPES and keys == _TEST_FIELDS:
+        return _TEST_TYPES[data_type], (_TEST.pack(strings(data['test'])) +
+                                        _pack_status(data['loads_status']))
+
+    elif data_type in _EXC_TYPES and keys == _EXC_FIELDS:
+        exc_info = data['exc_info']
+        if len(exc_info) != 3:
+            raise EncodingError(exc_info)
+        return _EXC_TYPES[data_type], ''.join(
+            [_TEST.pack(strings(data['test'])),
+             _pack_status(data['loads_status'])] +
+            [_pack_str(value) for value in exc_info])
+
+    elif data_type == 'socket_message' and keys == set(['size']):
+        return _SOCKET_MESSAGE, _SIZE.pack(data['size'])
+
+    raise EncodingError(data_type)
+
+
+def _encode_records(events, strings):
+    records = []
+    for data_type, data in events:
+        try:
+            type_, payload = _encode_record(data_type, data, strings)
+        except (EncodingError, TypeError, KeyError, struct.error):
+            type_ = _GENERIC
+            payload = (_TEST.pack(strings(data_type)) +
+                       _pack_str(_ENCODER.encode(data)))
+
+        records.append(_RECORD.pack(type_, len(payload)) + payload)
+
+    return records
+
+
+def _encode(kind, header, events):
+    strings = _Strings()
+    records = _encode_records(events, strings)
+    return ''.join([_PREFIX.pack(MAGIC, VERSION, kind), header,
+                    strings.dump(), _LEN.pack(len(records))] + records)
+
+
+def encode_event(header, data_type, data):
+    """Encodes a single event. *header* comes from encode_header."""
+    return _encode(_SINGLE, header, [(data_type, data)])
+
+
+def encode_batch(header, counts):
+    """Encodes a batch of events, given as a mapping of data types to the
+    list of their events.
+    """
+    events = [(data_type, data) for data_type, messages in counts.items()
+              for data in messages]
+    return _encode(_BATCH, header, events)
+
+
+def _decode_record(type_, data, pos, strings):
+    if type_ == _GENERIC:
+        data_type = strings[_TEST.unpack_from(data, pos)[0]]
+        payload, pos = _unpack_str(data, pos + _TEST.size)
+        return data_type, json.loads(payload)
+
+    data_type = _NAMES[type_]
+
+    if type_ in (_ADD_HIT, _ADD_TIMED_HIT):
+        started, elapsed, status, method, url = _HIT.unpack_from(data, pos)
+        loads_status, pos = _unpack_status(data, pos + _HIT.size)
+
+        record = {'started': _from_timestamp(started), 'elapsed': elapsed,
+                  'status': status, 'method': strings[method],
+                  'url': strings[url], 'loads_status': loads_status}
+
+        if type_ == _ADD_TIMED_HIT:
+            values = _TIMINGS.unpack_from(data, pos)
+            pos += _TIMINGS.size
+            record['timings'] = dict(zip(TIMING_PHASES, values))
+            record['sent'], record['received'] = values[-2:]
+
+        extra, pos = _unpack_str(data, pos)
+        if extra is not None:
+            record.update(json.loads(extra))
+        return data_type, record
+
+    elif type_ == _SOCKET_MESSAGE:
+        return data_type, {'size': _SIZE.unpack_from(data, pos)[0]}
+
+    test = strings[_TEST.unpack_from(data, pos)[0]]
+    loads_status, pos = _unpack_status(data, pos + _TEST.size)
+    record = {'test': test, 'loads_status': loads_status}
+
+    if type_ in (_ADD_ERROR, _ADD_FAILURE):
+        exc_info = []
+        for i in range(3):
+            value, pos = _unpack_str(data, pos)
+            exc_info.append(value)
+        record['exc_info'] = exc_info
+
+    return data_type, record
+
+
+def is_binary(message):
+    return message[:1] == MAGIC
+
+
+def decode(message):
+    """Decodes a message sent by a runner, whatever its encoding.
+
+    Returns the same mapping as the JSON encoding would.
+    """
+    if not is_binary(message):
+        return json.loads(message)
+
+    magic, version, kind = _PREFIX.unpack_from(message, 0)
+    if version != VERSION:
+        raise ValueError('Unsupported version %d' % version)
+
+    pos = _PREFIX.size
+    constants = {}
+    for name in ('agent_id', 'hostname', 'run_id'):
+        constants[name], pos = _unpack_str(message, pos)
+
+    strings = []
+    size, = _LEN.unpack_from(message, pos)
+    pos += _LEN.size
+    for i in range(size):
+        value, pos = _unpack_str(message, pos)
+        strings.append(value)
+
+    size, = _LEN.unpack_from(message, pos)
+    pos += _LEN.size
+    events = []
+    for i in range(size):
+        type_, length = _RECORD.unpack_from(message, pos)
+        pos += _RECORD.size
+        events.append(_decode_record(type_, message, pos, strings))
+        pos += length
+
+    if kind == _SINGLE:
+        data_type, data = events[0]
+        data.update(constants)
+        data['data_type'] = data_type
+        return data
+
+    counts = {}
+    for data_type, data in events:
+        counts.setdefault(data_type, []).append(data)
+
+    constants['data_type'] = 'batch'
+    constants['counts'] = counts
+    return constants
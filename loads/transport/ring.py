@@ -0,0 +1,182 @@
+""" Ring buffer in a memory-mapped file.
+
+Used to send the results of a worker process to its parent on the same
+machine without going through a socket: the worker writes the messages into
+the buffer, and the parent reads them all at once every now and then.
+
+The file starts with a header, and is followed by *slots* slots of
+*slot_size* bytes. Each message is written in one or several consecutive
+slots, prefixed by its length. A part takes at most half of the slots so it
+always fits once the reader caught up: bigger messages are split in several
+parts, flagged in their length, that the reader joins back. The header
+contains the total number of slots written and read so far: the writer only
+updates the first one and the reader only updates the second one, so one
+writer and one reader can use the buffer without any lock.
+"""
+import mmap
+import os
+import struct
+
+
+SCHEME = 'shm://'
+DEFAULT_SLOTS = 4096
+DEFAULT_SLOT_SIZE = 256
+
+_MAGIC = 'LRB1'
+_HEADER = struct.Struct('!4sII')
+_INDEX = struct.Struct('Q')
+_LENGTH = struct.Struct('I')
+_PADDING = 0xFFFFFFFF
+# set in the length of the parts of a message that are followed by others.
+_MORE = 0x80000000
+
+# the two indexes are kept on separate cache lines.
+_WRITE_INDEX = 64
+_READ_INDEX = 128
+_DATA = 192
+
+
+class RingBuffer(object):
+    """A ring buffer in the file at *path*.
+
+    The file is created by the reader, with *create=True*. The writer opens
+    it and gets the sizes from its header.
+    """
+    def __init__(self, path, slots=DEFAULT_SLOTS,
+                 slot_size=DEFAULT_SLOT_SIZE, create=False):
+        self.path = path
+
+        if create:
+            with open(path, 'wb') as f:
+                f.write(_HEADER.pack(_MAGIC, slots, slot_size))
+                f.truncate(_DATA + slots * slot_size)
+
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+        magic, self.slots, self.slot_size = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC:
+            raise ValueError('%r is not a ring buffer' % path)
+
+        # a part can't be bigger than half of the slots, see write()
+        self._max_part = (self.slots // 2) * self.slot_size - _LENGTH.size
+        # the message being written and its size written so far, when it
+        # did not fit at once.
+        self._pending = None
+        # the parts read of the message being read.
+        self._parts = []
+
+    @classmethod
+    def from_endpoint(cls, endpoint):
+        """Opens the ring buffer of a *shm://path* endpoint."""
+        if not endpoint.startswith(SCHEME):
+            raise ValueError(endpoint)
+        return cls(endpoint[len(SCHEME):])
+
+    @property
+    def endpoint(self):
+        return SCHEME + self.path
+
+    def _get_index(self, offset):
+        return _INDEX.unpack_from(self._map, offset)[0]
+
+    def _set_index(self, offset, value):
+        _INDEX.pack_into(self._map, offset, value)
+
+    def __len__(self):
+        """Returns the number of slots used."""
+        return self._get_index(_WRITE_INDEX) - self._get_index(_READ_INDEX)
+
+    def write(self, message):
+        """Writes the message.
+
+        Returns False if there's not enough room left in the buffer. A big
+        message may then be partly written: the next call goes on with it,
+        so the writer just has to call it again, like for the other ones.
+        """
+        if self._pending is not None:
+            pending, offset = self._pending
+            if not self._write_parts(pending, offset):
+                return False
+            if pending is message:
+                return True
+        return self._write_parts(message, 0)
+
+    def _write_parts(self, message, offset):
+        while True:
+            part = message[offset:offset + self._max_part]
+            more = offset + len(part) < len(message)
+            if not self._write_part(part, more):
+                self._pending = (message, offset) if offset else None
+                return False
+            if not more:
+                self._pending = None
+                return True
+            offset += len(part)
+
+    def _write_part(self, message, more):
+        needed = (_LENGTH.size + len(message) - 1) // self.slot_size + 1
+        written = self._get_index(_WRITE_INDEX)
+        free = self.slots - (written - self._get_index(_READ_INDEX))
+        position = written % self.slots
+
+        padding = 0
+        if position + needed > self.slots:
+            # the message does not fit before the end of the buffer, so it
+            # will start at the beginning.
+            padding = self.slots - position
+
+        if padding + needed > free:
+            return False
+
+        if padding:
+            _LENGTH.pack_into(self._map, _DATA + position * self.slot_size,
+                              _PADDING)
+            position = 0
+
+        offset = _DATA + position * self.slot_size
+        _LENGTH.pack_into(self._map, offset,
+                          len(message) | _MORE if more else len(message))
+        start = offset + _LENGTH.size
+        self._map[start:start + len(message)] = message
+
+        # the message is only visible to the reader from here
+        self._set_index(_WRITE_INDEX, written + padding + needed)
+        return True
+
+    def read(self):
+        """Returns all the messages written since the last read."""
+        read = self._get_index(_READ_INDEX)
+        written = self._get_index(_WRITE_INDEX)
+        messages = []
+
+        while read < written:
+            position = read % self.slots
+            offset = _DATA + position * self.slot_size
+            length, = _LENGTH.unpack_from(self._map, offset)
+
+            if length == _PADDING:
+                read += self.slots - position
+                continue
+
+            more = length & _MORE
+            length &= ~_MORE
+            start = offset + _LENGTH.size
+            self._parts.append(self._map[start:start + length])
+            read += (_LENGTH.size + length - 1) // self.slot_size + 1
+
+            if not more:
+                messages.append(''.join(self._parts))
+                self._parts = []
+
+        self._set_index(_READ_INDEX, read)
+        return messages
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def unlink(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -26,6 +26,8 @@ DEFAULT_BROKER_RECEIVER = "ipc:///tmp/loads-broker-receiver.ipc"
 
 
 DEFAULT_AGENT_TIMEOUT = 60.
+DEFAULT_CURSOR_TIMEOUT = 60.
+DEFAULT_CHUNK_SIZE = 1000
 DEFAULT_TIMEOUT = 5.
 DEFAULT_TIMEOUT_MOVF = 20.
 DEFAULT_TIMEOUT_OVF = 1
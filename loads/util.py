@@ -8,10 +8,10 @@ import sys
 import urlparse
 import math
 import fnmatch
-import random
 import zipfile
 from cStringIO import StringIO
 import hashlib
+import imp
 import subprocess
 from tempfile import mkdtemp
 
@@ -20,6 +20,13 @@ try:
 except ImportError:
     gevent_socket = None
 
+# NumPy is only imported when it's used (see loads.results.arrays).
+try:
+    imp.find_module('numpy')
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
 
 logger = logging.getLogger('loads')
 
@@ -88,39 +95,28 @@ def split_endpoint(endpoint):
     return res
 
 
-_DNS_CACHE = {}
-
-
-def dns_resolve(url):
+def dns_resolve(url, resolver=None):
     """Resolve hostname in the given url, using cached results where possible.
 
     Given a url, this function does DNS resolution on the contained hostname
     and returns a 3-tuple giving:  the URL with hostname replace by IP addr,
     the original hostname string, and the resolved IP addr string.
 
-    The results of DNS resolution are cached to make sure this doesn't become
-    a bottleneck for the loadtest.  If the hostname resolves to multiple
-    addresses then a random address is chosen.
+    The results of DNS resolution are cached by the *resolver* to make sure
+    this doesn't become a bottleneck for the loadtest, see loads.dns. If the
+    hostname resolves to multiple addresses then they are used in turn.
     """
+    if resolver is None:
+        from loads.dns import get_resolver
+        resolver = get_resolver()
+
     parts = urlparse.urlparse(url)
     netloc = parts.netloc.rsplit(':')
     if len(netloc) == 1:
         netloc.append('80')
 
     original = netloc[0]
-    addrs = _DNS_CACHE.get(original)
-    if addrs is None:
-        try:
-            addrs = gevent_socket.gethostbyname_ex(original)[2]
-        except AttributeError:
-            # gethostbyname_ex was introduced by gevent 1.0,
-            # fallback on gethostbyname instead.
-            logger.info('gevent.socket.gethostbyname_ex is not present, '
-                        'Falling-back on gevent.socket.gethostbyname')
-            addrs = [gevent_socket.gethostbyname(original)]
-        _DNS_CACHE[original] = addrs
-
-    resolved = random.choice(addrs)
+    resolved = resolver.resolve(original)
     netloc = resolved + ':' + netloc[1]
     parts = (parts.scheme, netloc) + parts[2:]
     return urlparse.urlunparse(parts), original, resolved
@@ -184,9 +180,8 @@ def get_quantiles(data, quantiles):
     This is an adapted version of an implementation by Ernesto P.Adorio Ph.D.
     UP Extension Program in Pampanga, Clark Field.
 
-    Warning: this implentation is probably slow. We are using this atm to avoid
-    depending on scipy, who have a much better and faster version, see
-    scipy.stats.mstats.mquantiles
+    When NumPy is installed, the sort and the interpolations are vectorized.
+    Otherwise, we fall back on a pure Python version, which is much slower.
 
     References:
        http://reference.wolfram.com/mathematica/ref/Quantile.html
@@ -194,6 +189,9 @@ def get_quantiles(data, quantiles):
        http://adorio-research.org/wordpress/?p=125
 
     """
+    if HAS_NUMPY:
+        return _get_np_quantiles(data, quantiles)
+
     def _get_quantile(q, data_len):
         a, b, c, d = (1.0 / 3, 1.0 / 3, 0, 1)
         g, j = math.modf(a + (data_len + b) * q - 1)
@@ -214,6 +212,28 @@ def get_quantiles(data, quantiles):
     return [_get_quantile(q, data_len) for q in quantiles]
 
 
+def _get_np_quantiles(data, quantiles):
+    """NumPy version of get_quantiles, giving the same results."""
+    import numpy
+    a, b, c, d = (1.0 / 3, 1.0 / 3, 0, 1)
+    data = numpy.sort(numpy.asarray(data, dtype=numpy.float64))
+    data_len = len(data)
+    if data_len == 0:
+        raise IndexError('No data')
+
+    g, j = numpy.modf(a + (data_len + b) *
+                      numpy.asarray(quantiles, dtype=numpy.float64) - 1)
+    index = numpy.clip(numpy.floor(j).astype(int), 0, data_len - 1)
+    next_index = numpy.minimum(index + 1, data_len - 1)
+
+    values = data[index] + (data[next_index] - data[index]) * (c + d * g)
+    values = numpy.where((g == 0) | (index == data_len - 1), data[index],
+                         values)
+    values = numpy.where(j < 0, data[0], values)
+    values = numpy.where(j >= data_len, data[-1], values)
+    return values.tolist()
+
+
 def try_import(*packages):
     failed_packages = []
     for package in packages: